@@ -0,0 +1,168 @@
+"""
+chat_bench.py
+
+Offline end-to-end benchmark of chat.handle_message. It starts a fake OpenAI-compatible streaming server and a
+fake Bot API server in process, then drives N concurrent simulated users through handle_message against a
+local Redis, and reports:
+
+- time to first edit (from the update arriving until the "..." placeholder is first edited), p50 / p99
+- total reply time, p50 / p99
+- Bot API edits per reply, and how many calls were answered with 429
+- Redis round trips per message (commands sent outside pipelines)
+
+Needs a Redis you don't mind the benchmark writing to, e.g. `docker run --rm -p 6379:6379 redis`. Only the keys of
+the simulated users (user:{BENCH_USER_ID_BASE + i}:*) are touched, they are removed before and after the run.
+
+python bench/chat_bench.py --users 20 --messages 3 --ttft 0.5 --token-rate 50
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+
+os.environ.setdefault("REDIS_HOST", "127.0.0.1")
+os.environ.setdefault("REDIS_DB", "15")
+os.makedirs("logs", exist_ok=True)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder, CallbackContext  # noqa: E402
+
+from fake_openai import FakeOpenAI  # noqa: E402
+from fake_telegram import FakeTelegram  # noqa: E402
+
+BENCH_USER_ID_BASE = 9_000_000_000
+BENCH_TOKEN = "123456:bench"
+PROMPT = "Summarize the plot of a long novel in a few paragraphs."
+
+
+def percentile(values: list[float], q: float) -> str:
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    return f"{values[min(len(values) - 1, max(0, round(q / 100 * len(values) + 0.5) - 1))]:.3f}s"
+
+
+async def start_server(app: web.Application) -> tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+async def clear_users(redis_client, user_ids: list[int]) -> None:
+    for user_id in user_ids:
+        keys = [key async for key in redis_client.scan_iter(f"user:{user_id}:*")]
+        if keys:
+            await redis_client.delete(*keys)
+
+
+async def run(args: argparse.Namespace) -> None:
+    # imported late so the environment above is in place when core creates the Redis client
+    from chat import handle_message
+    from core import redis_client
+    from metrics import REDIS_COMMAND_DURATION
+
+    fake_openai = FakeOpenAI(args.ttft, args.token_rate, args.reply_tokens)
+    fake_telegram = FakeTelegram(args.chat_limit)
+    openai_runner, openai_port = await start_server(fake_openai.build_app())
+    telegram_runner, telegram_port = await start_server(fake_telegram.build_app())
+
+    app = ApplicationBuilder().token(BENCH_TOKEN).base_url(f"http://127.0.0.1:{telegram_port}/bot").build()
+    await app.initialize()
+
+    user_ids = [BENCH_USER_ID_BASE + i for i in range(args.users)]
+    await clear_users(redis_client, user_ids)
+    for user_id in user_ids:
+        await redis_client.set(f"user:{user_id}:openai_api_key", "bench")
+        await redis_client.set(f"user:{user_id}:openai_api_endpoint", f"http://127.0.0.1:{openai_port}/v1")
+        await redis_client.set(f"user:{user_id}:openai_model", "bench-model")
+
+    first_edit_latencies: list[float] = []
+    reply_latencies: list[float] = []
+    edits_per_reply: list[int] = []
+    failures = 0
+    update_id = 0
+
+    async def simulate_user(user_id: int) -> None:
+        nonlocal failures, update_id
+
+        reply_to = None
+        for _ in range(args.messages):
+            update_id += 1
+            message = {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                "text": PROMPT
+            }
+            if reply_to is not None:
+                # continue the conversation, like a user replying to the bot's last message
+                message["reply_to_message"] = {**reply_to, "from": {"id": 1, "is_bot": True, "first_name": "bench"}}
+            update = Update.de_json({"update_id": update_id, "message": message}, app.bot)
+            context = CallbackContext.from_update(update, app)
+
+            start = time.perf_counter()
+            try:
+                await handle_message(update, context)
+            except Exception as e:
+                failures += 1
+                print(f"user {user_id}: {type(e).__name__}: {e}", file=sys.stderr)
+                continue
+            end = time.perf_counter()
+
+            calls = [call for call in fake_telegram.calls_for(user_id) if start <= call.at <= end and not call.rate_limited]
+            edits = [call for call in calls if call.method == "editMessageText"]
+            reply_latencies.append(end - start)
+            edits_per_reply.append(len(edits))
+            if edits:
+                first_edit_latencies.append(edits[0].at - start)
+
+            sent = [call for call in calls if call.method == "sendMessage"]
+            if sent:
+                reply_to = {"message_id": sent[-1].message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}}
+
+    redis_commands_before = REDIS_COMMAND_DURATION.total_count()
+    bench_start = time.perf_counter()
+    await asyncio.gather(*[simulate_user(user_id) for user_id in user_ids])
+    elapsed = time.perf_counter() - bench_start
+    redis_commands = REDIS_COMMAND_DURATION.total_count() - redis_commands_before
+
+    total = args.users * args.messages
+    rate_limited = sum(1 for call in fake_telegram.calls if call.rate_limited)
+
+    print(f"messages: {total} ({failures} failed) from {args.users} users in {elapsed:.2f}s ({total / elapsed:.2f} msg/s)")
+    print(f"time to first edit: p50={percentile(first_edit_latencies, 50)} p99={percentile(first_edit_latencies, 99)}")
+    print(f"reply time: p50={percentile(reply_latencies, 50)} p99={percentile(reply_latencies, 99)}")
+    print(f"edits per reply: mean={sum(edits_per_reply) / max(1, len(edits_per_reply)):.1f} max={max(edits_per_reply, default=0)}")
+    print(f"bot api calls: {len(fake_telegram.calls)} ({rate_limited} answered with 429)")
+    print(f"redis round trips per message: {redis_commands / max(1, total):.1f}")
+    print(f"llm requests: {fake_openai.requests}, prompt chars per request: {fake_openai.prompt_chars / max(1, fake_openai.requests):.0f}")
+
+    await clear_users(redis_client, user_ids)
+    await app.shutdown()
+    await openai_runner.cleanup()
+    await telegram_runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of chat.handle_message")
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--messages", type=int, default=3, help="messages per user, each replying to the previous answer (at most 10, the rate limit)")
+    parser.add_argument("--ttft", type=float, default=0.5, help="fake LLM time to first token, seconds")
+    parser.add_argument("--token-rate", type=float, default=50, help="fake LLM tokens per second")
+    parser.add_argument("--reply-tokens", type=int, default=300, help="fake LLM reply length in tokens")
+    parser.add_argument("--chat-limit", type=int, default=3, help="Bot API calls allowed per chat per second before 429")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+extract_bench.py
+
+Benchmark of extract.extract_content. By default it generates news / forum / docs style pages of increasing
+size (navigation, sidebars, comment threads, inline scripts and styles around the article, plus some unbalanced
+markup), and pages of paragraphs that are never closed between stray end tags, whose stack of open elements only
+grows. Real pages can be added as files:
+
+python bench/extract_bench.py
+python bench/extract_bench.py --sizes 100 1000 4000 --repeat 5 saved_page.html another.html
+
+For every page it reports input size, extraction time, throughput and how much of the page is left, time per MB
+should stay flat as pages grow.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from extract import extract_content  # noqa: E402
+
+WORDS = ("the of and to in is was for on that with as by at from his her it an are were which this be or has had "
+         "not but first also new one two after who their they have been its more other time year people into "
+         "government city school during university series world state between century season film group").split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    text = " ".join(rng.choice(WORDS) for _ in range(words))
+    return text[0].upper() + text[1:] + rng.choice([".", ",", ";"])
+
+
+def paragraph(rng: random.Random) -> str:
+    return " ".join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(2, 6)))
+
+
+def navigation(rng: random.Random, links: int) -> str:
+    items = "".join(f'<li class="menu-item"><a href="/section/{i}">{rng.choice(WORDS).title()}</a></li>' for i in range(links))
+    return f'<nav class="site-nav"><ul>{items}</ul></nav>'
+
+
+def generate_page(target_bytes: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    head = ('<head><title>Benchmark article</title><meta charset="utf-8">'
+            f'<style>{"body{margin:0;padding:0}" * 200}</style>'
+            f'<script>{"window.dataLayer=window.dataLayer||[];" * 200}</script></head>')
+
+    parts = ["<!DOCTYPE html><html>", head, "<body>", navigation(rng, 40), '<div class="layout">']
+    parts.append('<aside class="sidebar"><div class="widget">' + "".join(
+        f'<p><a href="/related/{i}">{sentence(rng, 6)}</a></p>' for i in range(30)) + "</div></aside>")
+    parts.append('<main><article class="post-content"><h1>Benchmark article</h1>')
+
+    size = sum(len(part) for part in parts)
+    section = 0
+    while size < target_bytes * 0.7:
+        section += 1
+        chunk = f"<h2>Section {section}</h2>" + "".join(f"<p>{paragraph(rng)}</p>" for _ in range(5))
+        if section % 3 == 0:
+            chunk += "<ul>" + "".join(f"<li>{sentence(rng, 10)}</li>" for _ in range(5)) + "</ul>"
+        if section % 5 == 0:
+            chunk += f"<pre>def f(x):\n    return x * {section}\n</pre>"
+        if section % 7 == 0:
+            # sloppy markup seen in the wild
+            chunk += f"<div><p>{paragraph(rng)}</span></b></font><p>{paragraph(rng)}</div>"
+        parts.append(chunk)
+        size += len(chunk)
+
+    parts.append("</article></main>")
+    comments = []
+    while size < target_bytes:
+        comment = f'<div class="comment"><a href="/user/{rng.randint(1, 999)}">user</a><p>{paragraph(rng)}</p></div>'
+        comments.append(comment)
+        size += len(comment)
+    parts.append(f'<section id="comments">{"".join(comments)}</section>')
+    parts.append(f'</div><footer class="site-footer">{navigation(rng, 20)}<p>Copyright notice, all rights reserved.</p></footer>')
+    parts.append("</body></html>")
+    return "".join(parts)
+
+
+def generate_unclosed_page(target_bytes: int, seed: int = 0) -> str:
+    """Unclosed paragraphs between stray end tags, the worst case for closing unbalanced markup."""
+    rng = random.Random(seed)
+    parts = ["<html><head><title>Unclosed paragraphs</title></head><body><div>"]
+    size = len(parts[0])
+    while size < target_bytes:
+        chunk = f"<p>{sentence(rng, rng.randint(4, 12))}</b></span></font>"
+        parts.append(chunk)
+        size += len(chunk)
+    return "".join(parts)
+
+
+def bench(name: str, html: str, repeat: int) -> None:
+    timings = []
+    output = ""
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = extract_content(html)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    megabytes = len(html.encode()) / 1024 / 1024
+    print(f"{name:>24}: {megabytes:7.2f}MB in {best * 1000:8.1f}ms "
+          f"({megabytes / best:5.1f}MB/s, {best * 1000 / megabytes:6.1f}ms/MB), "
+          f"output {len(output) / max(1, len(html)):6.1%} of input")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of extract.extract_content")
+    parser.add_argument("files", nargs="*", help="saved HTML pages to benchmark in addition to the generated ones")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 200, 1000, 4000], help="generated page sizes, KB")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per page, the best one is reported")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        bench(f"generated {size}KB", generate_page(size * 1024), args.repeat)
+        bench(f"unclosed {size}KB", generate_unclosed_page(size * 1024), args.repeat)
+
+    for path in args.files:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            bench(os.path.basename(path)[:24], f.read(), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
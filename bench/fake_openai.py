@@ -0,0 +1,107 @@
+"""
+fake_openai.py
+
+A local OpenAI-compatible chat completions server for benchmarks. Replies are made of `reply_tokens` filler
+tokens, the first one after `ttft` seconds and the rest at `token_rate` tokens per second. Both streaming
+(SSE, including the `stream_options.include_usage` chunk) and plain responses are supported.
+
+Run standalone with:
+
+python bench/fake_openai.py --port 8001 --ttft 0.5 --token-rate 50
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from aiohttp import web
+
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore".split()
+
+
+class FakeOpenAI:
+    def __init__(self, ttft: float = 0.5, token_rate: float = 50, reply_tokens: int = 300):
+        self.ttft = ttft
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.requests = 0
+        self.prompt_chars = 0
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        return app
+
+    def _chunk(self, model: str, delta: dict, finish_reason: str | None = None) -> bytes:
+        payload = {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(payload)}\n\n".encode()
+
+    async def handle_chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body.get("model", "bench")
+        self.requests += 1
+        prompt_chars = sum(len(message.get("content") or "") for message in body.get("messages", []))
+        self.prompt_chars += prompt_chars
+        usage = {
+            "prompt_tokens": prompt_chars // 4,
+            "completion_tokens": self.reply_tokens,
+            "total_tokens": prompt_chars // 4 + self.reply_tokens
+        }
+
+        await asyncio.sleep(self.ttft)
+        tokens = [FILLER[i % len(FILLER)] + " " for i in range(self.reply_tokens)]
+
+        if not body.get("stream"):
+            await asyncio.sleep(max(0, len(tokens) - 1) / self.token_rate)
+            return web.json_response({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        start = time.perf_counter()
+        await response.write(self._chunk(model, {"role": "assistant", "content": ""}))
+        for i, token in enumerate(tokens):
+            # pace against the start time so scheduling delays don't accumulate
+            delay = start + i / self.token_rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await response.write(self._chunk(model, {"content": token}))
+        await response.write(self._chunk(model, {}, "stop"))
+
+        if (body.get("stream_options") or {}).get("include_usage"):
+            payload = {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": int(time.time()), "model": model, "choices": [], "usage": usage}
+            await response.write(f"data: {json.dumps(payload)}\n\n".encode())
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible streaming server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds until the first token")
+    parser.add_argument("--token-rate", type=float, default=50, help="tokens per second after the first one")
+    parser.add_argument("--reply-tokens", type=int, default=300)
+    args = parser.parse_args()
+
+    web.run_app(FakeOpenAI(args.ttft, args.token_rate, args.reply_tokens).build_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
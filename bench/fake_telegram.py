@@ -0,0 +1,97 @@
+"""
+fake_telegram.py
+
+A local Bot API server for benchmarks. It answers the handful of methods the chat path uses, records every
+call with a timestamp, and enforces a per-chat flood limit like Telegram does: more than `chat_limit` calls
+within one second in the same chat are answered with 429 and a retry_after.
+
+Point python-telegram-bot at it with ApplicationBuilder().base_url(f"http://{host}:{port}/bot").
+"""
+
+import time
+from collections import defaultdict, deque
+from dataclasses import dataclass
+
+from aiohttp import web
+
+
+@dataclass
+class RecordedCall:
+    method: str
+    chat_id: int | None
+    message_id: int | None
+    at: float
+    text_length: int = 0
+    rate_limited: bool = False
+
+
+class FakeTelegram:
+    def __init__(self, chat_limit: int = 1, retry_after: int = 1):
+        self.chat_limit = chat_limit
+        self.retry_after = retry_after
+        self.calls: list[RecordedCall] = []
+        self._next_message_id = 1000
+        self._recent: dict[int, deque[float]] = defaultdict(deque)
+
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    def _message(self, chat_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"},
+            "text": text
+        }
+
+    def _flooded(self, chat_id: int, now: float) -> bool:
+        recent = self._recent[chat_id]
+        while recent and now - recent[0] > 1:
+            recent.popleft()
+        if len(recent) >= self.chat_limit:
+            return True
+        recent.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+
+        now = time.perf_counter()
+        chat_id = int(data["chat_id"]) if "chat_id" in data else None
+        message_id = int(data["message_id"]) if "message_id" in data else None
+        text = str(data.get("text", ""))
+
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}})
+
+        if chat_id is not None and method in ("sendMessage", "editMessageText") and self._flooded(chat_id, now):
+            self.calls.append(RecordedCall(method, chat_id, message_id, now, len(text), rate_limited=True))
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+
+        if method == "sendMessage":
+            self._next_message_id += 1
+            message_id = self._next_message_id
+            self.calls.append(RecordedCall(method, chat_id, message_id, now, len(text)))
+            return web.json_response({"ok": True, "result": self._message(chat_id, message_id, text)})
+
+        if method == "editMessageText":
+            self.calls.append(RecordedCall(method, chat_id, message_id, now, len(text)))
+            return web.json_response({"ok": True, "result": self._message(chat_id, message_id, text)})
+
+        self.calls.append(RecordedCall(method, chat_id, message_id, now))
+        return web.json_response({"ok": True, "result": True})
+
+    def calls_for(self, chat_id: int, method: str | None = None) -> list[RecordedCall]:
+        return [call for call in self.calls if call.chat_id == chat_id and (method is None or call.method == method)]
@@ -1,18 +1,23 @@
 import json
 import re
-from datetime import datetime, timedelta
+from datetime import timedelta
 from typing import List
 
 import openai
 from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
-from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
 from telegram import Update, Message
 from telegram.ext import CallbackContext
 
+from compaction import compact_messages
 from core import logger, redis_client
-from pixiv import send_pixiv_novel
-from tweet import send_tweet
-from utils import clean_html, get_web_content, rate_limit, get_redis_value
+from metrics import LLMRequestTracker, timed
+from tools import run_tool_calls, tool_definitions
+from tracing import span, traced
+from usage import billed_failure, quota_exceeded, record_response_usage, stream_options
+from utils import clean_html, rate_limit, get_redis_value, lazy_function
+
+send_pixiv_novel = lazy_function("pixiv", "send_pixiv_novel")
+send_tweet = lazy_function("tweet", "send_tweet")
 
 INTERACTION_LIMIT = 10
 TIME_WINDOW = timedelta(minutes=1)
@@ -20,37 +25,6 @@ TELEGRAM_MESSAGE_MAX_LENGTH = 2000
 MESSAGE_SEND_BUFFER_MAX = 200
 CUT_CHARACTERS = [' ', '\n']
 MAX_RETRIES = 10
-TOOLS: List[ChatCompletionToolParam] = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_time",
-            "description": "Get the current time",
-            "parameters": {
-                "type": "object",
-                "properties": {
-
-                },
-                "required": [],
-                "additionalProperties": False
-            },
-        }
-    }, {
-        "type": "function",
-        "function": {
-            "name": "get_web_content",
-            "description": "Get the content of a web page",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "url": {"type": "string", "description": "The URL of the web page to get the content from"}
-                },
-                "required": ["url"],
-                "additionalProperties": False
-            }
-        }
-    }
-]
 DEFAULT_SYSTEM_PROMPT = """
 Output in HTML instead of markdown, format the text with these tags: <b/>(bold), <i/>(italics), <code/>, <s/>(strike), <pre language="python">code</pre>; NO <p> or <br/> tags. (Only use tag when it helps the structure, don't overuse it).
 Notice you'll have to escape the < and > characters (that are not part of tag) with \\ in the output.
@@ -60,6 +34,8 @@ TWITTER_URL_REGEX = re.compile(r"https://(x|twitter)\.com/[^/]+/status/\d+/?.*")
 PIXIV_NOVEL_URL_REGEX = re.compile(r"https://www.pixiv.net/novel/show.php\?id=(\d+).*")
 
 
+@traced("handle_message", root=True)
+@timed("handle_message")
 @rate_limit(time_window=TIME_WINDOW, limit=INTERACTION_LIMIT)
 async def handle_message(update: Update, context: CallbackContext) -> None:
     """
@@ -111,6 +87,11 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
                 await update.message.reply_text('DM me to setup your OpenAI keys/endpoint/model first.')
         return
 
+    if quota_message := await quota_exceeded(user_id):
+        logger.info(f"Token quota exceeded for user {user_id}")
+        await update.message.reply_text(quota_message, reply_to_message_id=message_id)
+        return
+
     client = openai.AsyncOpenAI(
         api_key=openai_api_key,
         base_url=openai_api_endpoint
@@ -139,35 +120,10 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
         "role": "user",
         "content": update.message.text
     })
+    messages = await compact_messages(client, openai_api_endpoint, openai_model, messages, user_id)
 
     await redis_client.hset(user_key, str(message_id), json.dumps(messages))
 
-    async def add_tool_calls_results(tool_calls: dict[int, ChoiceDeltaToolCall]):
-        nonlocal messages
-        logger.debug(f"Processing tool calls: {len(tool_calls)} calls")
-
-        for tool_call in tool_calls.values():
-            arguments = json.loads(tool_call.function.arguments)
-            if tool_call.function and tool_call.function.name == "get_current_time":
-                logger.debug("Executing get_current_time tool")
-
-                time = datetime.now()
-                time_str = time.strftime("%Y-%m-%d %H:%M:%S")
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": f"The current time is {time_str}. (UTC)"
-                })
-            elif tool_call.function and tool_call.function.name == "get_web_content":
-                logger.debug(f"Executing get_web_content tool for URL: {arguments['url']}")
-                url = arguments["url"]
-                content = await get_web_content(url)
-                messages.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": content
-                })
-
     async def update_reply_msg_to_user():
         nonlocal reply_msg_start, reply_msg_last_sent_end_pos, current_reply_obj, replies
         logger.debug(f"Updating reply message: start={reply_msg_start}, last_sent_end={reply_msg_last_sent_end_pos}")
@@ -212,33 +168,57 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
         nonlocal reply_msg, messages, replies
         logger.debug("Getting assistant reply with OpenAI")
 
-        if openai_enable_tools:
-            stream = await client.chat.completions.create(
-                model=openai_model,
-                messages=messages,
-                tools=TOOLS,
-                stream=True
-            )
-        else:
-            stream = await client.chat.completions.create(
-                model=openai_model,
-                messages=messages,
-                stream=True
-            )
-
-        tool_calls: dict[int, ChoiceDeltaToolCall] = {}
-
-        async for chunk in stream:
-            for tool_call in chunk.choices[0].delta.tool_calls or []:
-                if (index := tool_call.index) not in tool_calls:
-                    tool_calls[index] = tool_call
+        with span("llm.chat_completion", model=openai_model):
+            tracker = LLMRequestTracker(openai_model, openai_api_endpoint)
+            tool_calls: dict[int, ChoiceDeltaToolCall] = {}
+            usage = None
+            try:
+                if openai_enable_tools:
+                    stream = await client.chat.completions.create(
+                        model=openai_model,
+                        messages=messages,
+                        tools=tool_definitions(),
+                        stream=True,
+                        **stream_options()
+                    )
                 else:
-                    tool_calls[index].function.arguments += tool_call.function.arguments or ""
-
-            reply_msg += chunk.choices[0].delta.content or ""
+                    stream = await client.chat.completions.create(
+                        model=openai_model,
+                        messages=messages,
+                        stream=True,
+                        **stream_options()
+                    )
 
-            if len(reply_msg[reply_msg_last_sent_end_pos:]) > MESSAGE_SEND_BUFFER_MAX:
-                await update_reply_msg_to_user()
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        # the usage chunk at the end of the stream has no choices
+                        continue
+
+                    for tool_call in chunk.choices[0].delta.tool_calls or []:
+                        if (index := tool_call.index) not in tool_calls:
+                            tool_calls[index] = tool_call
+                        else:
+                            tool_calls[index].function.arguments += tool_call.function.arguments or ""
+
+                    if chunk.choices[0].delta.content:
+                        tracker.token()
+                    reply_msg += chunk.choices[0].delta.content or ""
+
+                    if len(reply_msg[reply_msg_last_sent_end_pos:]) > MESSAGE_SEND_BUFFER_MAX:
+                        await update_reply_msg_to_user()
+
+                tracker.finish(usage.completion_tokens if usage else None)
+            except Exception as e:
+                tracker.fail()
+                completion = reply_msg + "".join(tool_call.function.arguments or "" for tool_call in tool_calls.values())
+                if billed_failure(e, completion):
+                    await record_response_usage(user_id, openai_model, usage, messages, completion)
+                raise
+
+        completion = reply_msg + "".join(tool_call.function.arguments or "" for tool_call in tool_calls.values())
+        await record_response_usage(user_id, openai_model, usage, messages, completion)
 
         if reply_msg[reply_msg_last_sent_end_pos:].strip(" \n\t"):
             await update_reply_msg_to_user()
@@ -262,7 +242,8 @@ async def handle_message(update: Update, context: CallbackContext) -> None:
                 "content": reply_msg,
                 "tool_calls": tool_calls_json
             })
-            await add_tool_calls_results(tool_calls)
+            with span("tool_calls", count=len(tool_calls)):
+                messages.extend(await run_tool_calls(list(tool_calls.values())))
             return False
         else:
             messages.append({
@@ -1,3 +1,4 @@
+import math
 import os
 from typing import Callable, Coroutine
 
@@ -5,10 +6,16 @@ from telegram import Update
 from telegram.ext import CallbackContext
 
 from core import redis_client, logger
-from tweet import subscribe_twitter_user, unsubscribe_twitter_user, list_twitter_subscription
-from utils import get_redis_value, admin_required, ADMIN_CHAT_ID_LIST
+from keyspace import take_snapshot
+from lang import LANG_SKIP_THRESHOLD
+from pixiv_jobs import complete_request, unfinished_requests, PIXIV_REQUEST_MAX_ATTEMPTS
+from redis_browser import render_key_list, render_key_value, parse_callback_data
+from usage import format_usage
+from utils import get_redis_value, admin_required, lazy_function, ADMIN_CHAT_ID_LIST
 
 ADMIN_CHAT_ID_LIST = [int(id) for id in os.getenv('ADMIN_CHAT_ID_LIST', '').split(',') if id]
+SUBSCRIPTION_FILE_MAX_BYTES = 256 * 1024
+TWITTER_DIGEST_MAX_MINUTES = 7 * 24 * 60
 
 
 async def start_command(update: Update, context: CallbackContext) -> None:
@@ -28,12 +35,18 @@ Available commands:
 /set_openai_model <your_openai_model>
 /set_openai_enable_tools <true/false>
 /set_twitter_translation <true/false>
+/set_twitter_digest <minutes> - Collect this chat's tweets and send them as a digest every this many minutes, 0 sends them right away
 /set_pixiv_translation <true/false>
 /set_pixiv_direct_translation <true/false>
 /set_pixiv_streaming_translation <true/false>
+/set_translation_skip_threshold <0-1> - Skip translating Simplified Chinese detected with at least this confidence
+/resume_pixiv - Resume Pixiv translations interrupted by a failure or restart
 /subscribe_twitter_user <twitter_username>
 /unsubscribe_twitter_user <twitter_username>
 /list_twitter_subscription
+/subscribe_twitter_users <twitter_username> ... - Subscribe to many users, or reply with it to a text/CSV file
+/unsubscribe_twitter_users <twitter_username> ... - Unsubscribe from many users, or reply with it to a text/CSV file
+/export_twitter_subscription - Export your subscriptions as a file
 /set_system_prompt <your_system_prompt> - Set your custom system prompt
 /reset_system_prompt - Reset to default system prompt
 /show_system_prompt - Show your current system prompt
@@ -45,7 +58,8 @@ Admin commands:
 /get_redis <key> - Get Redis key value
 /set_redis <key> <value> - Set Redis key value
 /del_redis <key> - Delete Redis key
-/list_redis <pattern> - List Redis keys matching pattern
+/list_redis <pattern> - List Redis keys matching pattern, page by page
+/redis_stats - Estimate memory usage per key family
 """
 
     await update.effective_message.reply_text(help_text, reply_to_message_id=update.effective_message.message_id)
@@ -55,18 +69,24 @@ Send this to BotFather for command autocompletion:
 
 start - Start a conversation with the bot
 help - Show available commands
-status - Show your current settings and configuration
+status - Show your current settings, configuration and token usage
 set_openai_key - <your_openai_api_key> - Set your OpenAI API key
 set_openai_endpoint - <your_openai_api_endpoint> - Set your OpenAI API endpoint
 set_openai_model - <your_openai_model> - Set your OpenAI model
 set_openai_enable_tools - <true/false> - Enable or disable OpenAI tools
 set_twitter_translation - <true/false> - Enable or disable Twitter translation
+set_twitter_digest - <minutes> - Send tweets as a digest every this many minutes, 0 to send them right away
 set_pixiv_translation - <true/false> - Enable or disable Pixiv translation
 set_pixiv_direct_translation - <true/false> - Enable or disable direct Pixiv translation
 set_pixiv_streaming_translation - <true/false> - Enable or disable streaming Pixiv translation
+set_translation_skip_threshold - <0-1> - Skip translating text detected as Simplified Chinese with at least this confidence
+resume_pixiv - Resume Pixiv translations interrupted by a failure or restart
 subscribe_twitter_user - <twitter_username> - Subscribe to a Twitter user's updates
 unsubscribe_twitter_user - <twitter_username> - Unsubscribe from a Twitter user's updates
 list_twitter_subscription - List all your subscribed Twitter users
+subscribe_twitter_users - <twitter_username> ... - Subscribe to many Twitter users, or reply with it to a text/CSV file
+unsubscribe_twitter_users - <twitter_username> ... - Unsubscribe from many Twitter users, or reply with it to a text/CSV file
+export_twitter_subscription - Export your subscribed Twitter users as a file
 set_system_prompt - <your_system_prompt> - Set your custom system prompt for the AI
 reset_system_prompt - Reset to default system prompt
 show_system_prompt - Show your current system prompt
@@ -82,9 +102,11 @@ async def status_command(update: Update, context: CallbackContext) -> None:
     openai_model = await get_redis_value(f"user:{user_id}:openai_model")
     openai_enable_tools = await get_redis_value(f"user:{user_id}:openai_enable_tools")
     twitter_translation = await get_redis_value(f"user:{user_id}:twitter_translation", "false")
+    twitter_digest = await get_redis_value(f"user:{chat_id}:twitter_digest", "0")
     pixiv_translation = await get_redis_value(f"user:{user_id}:pixiv_translation", "false")
     pixiv_direct_translation = await get_redis_value(f"user:{user_id}:pixiv_direct_translation", "true")
     pixiv_streaming_translation = await get_redis_value(f"user:{user_id}:pixiv_streaming_translation", "true")
+    translation_skip_threshold = await get_redis_value(f"user:{user_id}:translation_skip_threshold", LANG_SKIP_THRESHOLD)
 
     await update.effective_message.reply_text(f"""
 Status:
@@ -95,9 +117,13 @@ Status:
 - OpenAI model: {openai_model}
 - OpenAI enable tools: {openai_enable_tools}
 - Twitter translation: {twitter_translation}
+- Twitter digest (this chat): {twitter_digest} minutes
 - Pixiv translation: {pixiv_translation}
 - Pixiv direct translation: {pixiv_direct_translation}
 - Pixiv streaming translation: {pixiv_streaming_translation}
+- Translation skip threshold: {translation_skip_threshold}
+Usage:
+{await format_usage(user_id)}
 """, reply_to_message_id=update.effective_message.message_id)
 
 
@@ -114,6 +140,26 @@ def set_key_command(key: str):
     return set_key
 
 
+def set_number_command(key: str, minimum: float, maximum: float, per_chat: bool = False):
+    """Like set_key_command, for a number in [minimum, maximum]. With per_chat it's a setting of the chat, not the user."""
+    async def set_number(update: Update, context: CallbackContext) -> None:
+        try:
+            value = float(context.args[0]) if context.args and len(context.args) == 1 else math.nan
+        except ValueError:
+            value = math.nan
+        # also rejects nan and inf
+        if not minimum <= value <= maximum:
+            await update.effective_message.reply_text(f'Usage: /set_{key} <{minimum:g}-{maximum:g}>',
+                                                      reply_to_message_id=update.effective_message.message_id)
+            return
+
+        owner_id = update.effective_message.chat.id if per_chat else update.effective_message.from_user.id
+        await redis_client.set(f"user:{owner_id}:{key}", f"{value:g}")
+        await update.effective_message.set_reaction("👌")
+
+    return set_number
+
+
 def call_function_with_one_param_command(function: Callable[[str, int], Coroutine]):
     async def call_function(update: Update, context: CallbackContext) -> None:
         if not context.args or len(context.args) != 1:
@@ -171,18 +217,81 @@ def call_function_command(function: Callable[[int], Coroutine]):
     return call_function
 
 
+def bulk_subscription_command(function: Callable[[str, int, str], Coroutine]):
+    """
+    A command taking many Twitter users: as arguments (one per word or line), and/or from a text/CSV file the
+    command replies to. Text files list users like the arguments, CSV files are read by column (see parse_usernames).
+    """
+    async def call_function(update: Update, context: CallbackContext) -> None:
+        message = update.effective_message
+        text = " ".join(context.args or [])
+        table = ""
+
+        document = message.reply_to_message.document if message.reply_to_message else None
+        if document:
+            if document.file_size and document.file_size > SUBSCRIPTION_FILE_MAX_BYTES:
+                await message.reply_text(
+                    f"The file is too large, at most {SUBSCRIPTION_FILE_MAX_BYTES // 1024} KB are read.",
+                    reply_to_message_id=message.message_id
+                )
+                return
+            file = await document.get_file()
+            content = (await file.download_as_bytearray()).decode("utf-8-sig", errors="replace")
+            if (document.file_name or "").lower().endswith(".csv") or document.mime_type == "text/csv":
+                table = content
+            else:
+                text += "\n" + content
+
+        if not text.strip() and not table.strip():
+            await message.reply_text(
+                f'Usage: /{function.__name__} <twitter_username> [<twitter_username> ...], or reply with it to a text/CSV file',
+                reply_to_message_id=message.message_id
+            )
+            return
+
+        try:
+            result = await function(text, message.chat.id, table)
+            await message.reply_text(result, reply_to_message_id=message.message_id)
+        except Exception as e:
+            await message.reply_text('Something went wrong!', reply_to_message_id=message.message_id)
+            logger.exception(e)
+
+    return call_function
+
+
 set_openai_key_command = set_key_command("openai_api_key")
 set_openai_endpoint_command = set_key_command("openai_api_endpoint")
 set_openai_model_command = set_key_command("openai_model")
 set_openai_enable_tools_command = set_key_command("openai_enable_tools")
 set_twitter_translation_command = set_key_command("twitter_translation")
+set_twitter_digest_command = set_number_command("twitter_digest", 0, TWITTER_DIGEST_MAX_MINUTES, per_chat=True)
 set_pixiv_translation_command = set_key_command("pixiv_translation")
 set_pixiv_direct_translation_command = set_key_command('pixiv_direct_translation')
 set_pixiv_streaming_translation_command = set_key_command('pixiv_streaming_translation')
+set_translation_skip_threshold_command = set_number_command('translation_skip_threshold', 0, 1)
+
+subscribe_twitter_user_command = call_function_with_one_param_command(lazy_function("tweet", "subscribe_twitter_user"))
+unsubscribe_twitter_user_command = call_function_with_one_param_command(lazy_function("tweet", "unsubscribe_twitter_user"))
+list_twitter_subscription_command = call_function_command(lazy_function("tweet", "list_twitter_subscription"))
+subscribe_twitter_users_command = bulk_subscription_command(lazy_function("tweet", "subscribe_twitter_users"))
+unsubscribe_twitter_users_command = bulk_subscription_command(lazy_function("tweet", "unsubscribe_twitter_users"))
+export_twitter_subscription = lazy_function("tweet", "export_twitter_subscription")
+send_pixiv_novel = lazy_function("pixiv", "send_pixiv_novel")
+
+
+async def export_twitter_subscription_command(update: Update, context: CallbackContext) -> None:
+    message = update.effective_message
+    exported = await export_twitter_subscription(message.chat.id)
+    if not exported:
+        await message.reply_text("You are not subscribed to any Twitter users.", reply_to_message_id=message.message_id)
+        return
 
-subscribe_twitter_user_command = call_function_with_one_param_command(subscribe_twitter_user)
-unsubscribe_twitter_user_command = call_function_with_one_param_command(unsubscribe_twitter_user)
-list_twitter_subscription_command = call_function_command(list_twitter_subscription)
+    await message.reply_document(
+        document=exported.encode(),
+        filename="twitter_subscriptions.txt",
+        caption=f"{len(exported.splitlines())} Twitter users, reply /subscribe_twitter_users to this file to import them",
+        reply_to_message_id=message.message_id
+    )
 
 
 async def set_system_prompt_command(update: Update, context: CallbackContext) -> None:
@@ -216,41 +325,45 @@ async def show_system_prompt_command(update: Update, context: CallbackContext) -
     )
 
 
-@admin_required
-async def get_redis_command(update: Update, context: CallbackContext) -> None:
-    if not context.args or len(context.args) != 1:
-        await update.effective_message.reply_text('Usage: /get_redis <key>', reply_to_message_id=update.effective_message.message_id)
+async def resume_pixiv_command(update: Update, context: CallbackContext) -> None:
+    """Run the user's Pixiv requests again that a failure or restart cut short, finished chunks are reused."""
+    user_id = update.effective_message.from_user.id
+    requests = await unfinished_requests(user_id)
+    if not requests:
+        await update.effective_message.reply_text("No interrupted Pixiv translations.", reply_to_message_id=update.effective_message.message_id)
         return
 
-    key = context.args[0]
+    await update.effective_message.reply_text(
+        f"Resuming {len(requests)} Pixiv translation(s): {', '.join(requests)}",
+        reply_to_message_id=update.effective_message.message_id
+    )
+    for novel_id, request in requests.items():
+        if request.get("attempts", 1) >= PIXIV_REQUEST_MAX_ATTEMPTS:
+            await complete_request(user_id, novel_id)
+            await update.effective_message.reply_text(
+                f"Gave up on {novel_id} after {request['attempts']} attempts.",
+                reply_to_message_id=update.effective_message.message_id
+            )
+            continue
 
-    # Check key type
-    key_type = await redis_client.type(key)
-    if key_type == "none":
-        await update.effective_message.reply_text(f"Key '{key}' not found", reply_to_message_id=update.effective_message.message_id)
-        return
+        try:
+            await send_pixiv_novel(request["url"], context, user_id, request["chat_id"], request["message_id"])
+        except Exception as e:
+            logger.error(f"Failed to resume pixiv novel {novel_id} of user {user_id}: {e}", exc_info=True)
+            await update.effective_message.reply_text(
+                f"Failed to resume {novel_id}, try /resume_pixiv again later: {e}",
+                reply_to_message_id=update.effective_message.message_id
+            )
 
-    message = f"Key: {key}\nType: {key_type}\nValue(s):\n"
 
-    if key_type == "string":
-        value = await redis_client.get(key)
-        message += f"- {value}"
-    elif key_type == "list":
-        values = await redis_client.lrange(key, 0, -1)
-        for i, value in enumerate(values):
-            message += f"- [{i}] {value}\n"
-    elif key_type == "set":
-        values = await redis_client.smembers(key)
-        for value in values:
-            message += f"- {value}\n"
-    elif key_type == "hash":
-        values = await redis_client.hgetall(key)
-        for field, value in values.items():
-            message += f"- {field}: {value}\n"
-    else:
-        message += f"Unsupported type: {key_type}"
+@admin_required
+async def get_redis_command(update: Update, context: CallbackContext) -> None:
+    if not context.args or len(context.args) != 1:
+        await update.effective_message.reply_text('Usage: /get_redis <key>', reply_to_message_id=update.effective_message.message_id)
+        return
 
-    await update.effective_message.reply_text(message, reply_to_message_id=update.effective_message.message_id)
+    message, reply_markup = await render_key_value(context.args[0])
+    await update.effective_message.reply_text(message, reply_markup=reply_markup, reply_to_message_id=update.effective_message.message_id)
 
 
 @admin_required
@@ -305,40 +418,71 @@ async def del_redis_command(update: Update, context: CallbackContext) -> None:
 
 @admin_required
 async def list_redis_command(update: Update, context: CallbackContext) -> None:
-    # Get pattern and check for batch mode
-    pattern = context.args[0] if context.args else "*"
-    is_batch_mode = pattern.startswith(';')
+    # ; used to select the old batch mode, every listing is paginated now
+    pattern = context.args[0].lstrip(';') if context.args else "*"
 
-    # Remove ; from pattern if in batch mode
-    if is_batch_mode:
-        pattern = pattern[1:]
+    message, reply_markup = await render_key_list(pattern or "*")
+    await update.effective_message.reply_text(message, reply_markup=reply_markup, reply_to_message_id=update.effective_message.message_id)
 
-    keys = await redis_client.keys(pattern)
 
-    if not keys:
-        await update.effective_message.reply_text(f"No keys found matching pattern '{pattern}'", reply_to_message_id=update.effective_message.message_id)
-        return
+@admin_required
+async def redis_stats_command(update: Update, context: CallbackContext) -> None:
+    report = await take_snapshot(baseline=False)
+    await update.effective_message.reply_text(report, reply_to_message_id=update.effective_message.message_id)
 
-    if is_batch_mode:
-        # In batch mode, send keys in batches of 20
-        batch_size = 20
-        total_keys = len(keys)
-        for i in range(0, total_keys, batch_size):
-            batch = keys[i:i + batch_size]
-            message = f"Keys matching pattern '{pattern}' (batch {i // batch_size + 1}/{(total_keys - 1) // batch_size + 1}):\n\n"
-            for key in batch:
-                key_type = await redis_client.type(key)
-                message += f"• ({key_type}) {key}\n"
-            await update.effective_message.reply_text(message, reply_to_message_id=update.effective_message.message_id)
-    else:
-        # In normal mode, limit to first 20 keys
-        keys = keys[:20]
-        message = f"Keys matching pattern '{pattern}' (showing first 20):\n\n"
-        for key in keys:
-            key_type = await redis_client.type(key)
-            message += f"• ({key_type}) {key}\n"
 
-        if len(keys) >= 20:
-            message += "\nNote: Showing first 20 keys. Use /list_redis ;<pattern> to see all keys in batches."
+@admin_required
+async def redis_browser_callback(update: Update, context: CallbackContext) -> None:
+    """Next page buttons of /list_redis and /get_redis."""
+    query = update.callback_query
+    action, cursor, carried, target = await parse_callback_data(query.data)
 
-        await update.effective_message.reply_text(message, reply_to_message_id=update.effective_message.message_id)
+    if target is None:
+        await query.answer("This page expired, run the command again.")
+        return
+
+    if action == "rl":
+        message, reply_markup = await render_key_list(target, cursor, carried)
+    else:
+        message, reply_markup = await render_key_value(target, cursor, carried)
+
+    await query.answer()
+    await query.edit_message_text(message, reply_markup=reply_markup)
+
+
+# Every command the bot answers to, drives both the CommandHandler registrations and the channel post dispatch in main.py
+COMMANDS: dict[str, Callable[[Update, CallbackContext], Coroutine]] = {
+    "start": start_command,
+    "help": help_command,
+    "status": status_command,
+    "set_openai_key": set_openai_key_command,
+    "set_openai_endpoint": set_openai_endpoint_command,
+    "set_openai_model": set_openai_model_command,
+    "set_openai_enable_tools": set_openai_enable_tools_command,
+    "set_twitter_translation": set_twitter_translation_command,
+    "set_twitter_digest": set_twitter_digest_command,
+    "set_pixiv_translation": set_pixiv_translation_command,
+    "set_pixiv_direct_translation": set_pixiv_direct_translation_command,
+    "set_pixiv_streaming_translation": set_pixiv_streaming_translation_command,
+    "set_translation_skip_threshold": set_translation_skip_threshold_command,
+    "resume_pixiv": resume_pixiv_command,
+    "subscribe_twitter_user": subscribe_twitter_user_command,
+    "unsubscribe_twitter_user": unsubscribe_twitter_user_command,
+    "set_system_prompt": set_system_prompt_command,
+    "reset_system_prompt": reset_system_prompt_command,
+    "show_system_prompt": show_system_prompt_command,
+    "list_twitter_subscription": list_twitter_subscription_command,
+    "subscribe_twitter_users": subscribe_twitter_users_command,
+    "unsubscribe_twitter_users": unsubscribe_twitter_users_command,
+    "export_twitter_subscription": export_twitter_subscription_command,
+    "get_redis": get_redis_command,
+    "set_redis": set_redis_command,
+    "del_redis": del_redis_command,
+    "list_redis": list_redis_command,
+    "redis_stats": redis_stats_command,
+}
+
+# Inline keyboard callbacks, keyed by the callback data pattern they handle
+CALLBACK_QUERY_HANDLERS: dict[str, Callable[[Update, CallbackContext], Coroutine]] = {
+    r"^r[lg]\|": redis_browser_callback,
+}
@@ -0,0 +1,141 @@
+"""
+compaction.py
+
+Keeps the prompt of long reply chains within a token budget, so every turn doesn't resend (and pay for) the whole
+history. Once a conversation grows past its threshold (COMPACTION_THRESHOLD_TOKENS, capped by the model's context
+window) it is compacted in two stages, stopping as soon as it fits:
+
+1. tool outputs of earlier turns (e.g. whole web pages) are replaced by a short placeholder
+2. all but the last COMPACTION_KEEP_TURNS turns are summarized by the model into a single summary node right after
+   the system prompt; an existing summary node is folded into the next summary
+
+Compacted histories are what gets stored for the reply, so a chain is only summarized again once it has grown past
+the threshold again.
+
+Redis key structure:
+- user:{user_id}:summary:{digest} -> summary of a run of messages  # Expires after a week
+"""
+
+import hashlib
+import json
+import os
+
+import openai
+
+from core import logger, redis_client
+from metrics import LLMRequestTracker
+from tokens import context_window, count_message_tokens, count_tokens, trim_to_token_budget
+from tracing import traced
+from usage import billed_failure, record_response_usage
+
+COMPACTION_THRESHOLD_TOKENS = int(os.getenv('COMPACTION_THRESHOLD_TOKENS', 16000))
+COMPACTION_KEEP_TURNS = int(os.getenv('COMPACTION_KEEP_TURNS', 2))
+# share of the context window a prompt may take before compaction kicks in, the rest is left for the reply
+CONTEXT_WINDOW_RATIO = 0.6
+SUMMARY_MESSAGE_MAX_TOKENS = 2000
+SUMMARY_TTL = 7 * 24 * 60 * 60
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:"
+STALE_TOOL_OUTPUT = "[tool output from an earlier turn omitted, about {tokens} tokens]"
+SUMMARY_PROMPT = """
+Summarize the conversation below for your own future reference. Keep every fact, decision, name, number, URL and
+open question the user may come back to, drop pleasantries and formatting. Write in the language of the conversation.
+Output only the summary.
+"""
+
+
+def compaction_threshold(model: str) -> int:
+    return min(COMPACTION_THRESHOLD_TOKENS, int(context_window(model) * CONTEXT_WINDOW_RATIO))
+
+
+def is_summary(message: dict) -> bool:
+    return message["role"] == "system" and (message.get("content") or "").startswith(SUMMARY_PREFIX)
+
+
+def drop_stale_tool_outputs(messages: list[dict], model: str) -> list[dict]:
+    """Replace the tool outputs before the last user message, those of the current turn are kept."""
+    last_user = max((i for i, message in enumerate(messages) if message["role"] == "user"), default=len(messages))
+    compacted = []
+    for i, message in enumerate(messages):
+        if i < last_user and message["role"] == "tool" and not message["content"].startswith("[tool output"):
+            tokens = count_tokens(message["content"], model)
+            message = {**message, "content": STALE_TOOL_OUTPUT.format(tokens=tokens)}
+        compacted.append(message)
+    return compacted
+
+
+def transcript(messages: list[dict], model: str) -> str:
+    lines = []
+    for message in messages:
+        if message["role"] == "tool":
+            continue
+        content = message.get("content") or ""
+        if is_summary(message):
+            lines.append(content)
+        elif content:
+            lines.append(f"{message['role']}: {trim_to_token_budget(content, SUMMARY_MESSAGE_MAX_TOKENS, model)}")
+        for tool_call in message.get("tool_calls") or []:
+            lines.append(f"{message['role']} called {tool_call['function']['name']}({tool_call['function']['arguments']})")
+    return "\n\n".join(lines)
+
+
+async def summarize(client: openai.AsyncOpenAI, openai_api_endpoint: str, model: str, messages: list[dict], user_id: int) -> str:
+    digest = hashlib.sha1(json.dumps([model, messages], ensure_ascii=False).encode()).hexdigest()
+    cache_key = f"user:{user_id}:summary:{digest}"
+    summary = await redis_client.get(cache_key)
+    if summary is not None:
+        return summary
+
+    conversation = trim_to_token_budget(transcript(messages, model), int(context_window(model) * CONTEXT_WINDOW_RATIO), model)
+    summary_messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": conversation}
+    ]
+    tracker = LLMRequestTracker(model, openai_api_endpoint)
+    try:
+        response = await client.chat.completions.create(model=model, messages=summary_messages)
+    except Exception as e:
+        tracker.fail()
+        if billed_failure(e):
+            await record_response_usage(user_id, model, None, summary_messages, "")
+        raise
+    tracker.finish(response.usage.completion_tokens if response.usage else None)
+
+    summary = response.choices[0].message.content or ""
+    await record_response_usage(user_id, model, response.usage, summary_messages, summary)
+    await redis_client.set(cache_key, summary, ex=SUMMARY_TTL)
+    return summary
+
+
+@traced("compact_messages")
+async def compact_messages(client: openai.AsyncOpenAI, openai_api_endpoint: str, model: str, messages: list[dict], user_id: int) -> list[dict]:
+    threshold = compaction_threshold(model)
+    tokens = count_message_tokens(messages, model)
+    if tokens <= threshold:
+        return messages
+
+    compacted = drop_stale_tool_outputs(messages, model)
+    compacted_tokens = count_message_tokens(compacted, model)
+    logger.debug(f"Compaction for user {user_id}: {tokens} tokens, {compacted_tokens} without stale tool outputs (threshold {threshold})")
+    if compacted_tokens <= threshold:
+        return compacted
+
+    head = 1 if compacted[0]["role"] == "system" and not is_summary(compacted[0]) else 0
+    user_turns = [i for i, message in enumerate(compacted) if message["role"] == "user"]
+    if len(user_turns) <= COMPACTION_KEEP_TURNS:
+        # nothing old enough to summarize
+        return compacted
+    keep_from = user_turns[-COMPACTION_KEEP_TURNS]
+    if keep_from <= head:
+        return compacted
+
+    try:
+        summary = await summarize(client, openai_api_endpoint, model, compacted[head:keep_from], user_id)
+    except Exception as e:
+        # without a summary the older turns are dropped, which still beats overflowing the context window
+        logger.warning(f"Failed to summarize conversation of user {user_id}: {e!r}")
+        return compacted[:head] + compacted[keep_from:]
+
+    compacted = compacted[:head] + [{"role": "system", "content": f"{SUMMARY_PREFIX}\n{summary}"}] + compacted[keep_from:]
+    logger.info(f"Compacted conversation of user {user_id} from {tokens} to {count_message_tokens(compacted, model)} tokens")
+    return compacted
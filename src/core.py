@@ -1,16 +1,87 @@
+import atexit
+import json
 import logging
 import os
+import queue
+import random
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
 
 import redis.asyncio as redis
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# imported after load_dotenv, both read their settings from the environment at import time
+from metrics import REDIS_COMMAND_DURATION  # noqa: E402
+from tracing import span  # noqa: E402
+
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_ROTATION = os.getenv('LOG_ROTATION', 'size').lower()  # size / time
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', 'midnight')
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 7))
+LOG_JSON = os.getenv('LOG_JSON', 'false').lower() == 'true'
+LOG_MAX_PAYLOAD = int(os.getenv('LOG_MAX_PAYLOAD', 4000))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 1))
+# per logger overrides, e.g. "bot.translate=500:0.1,bot.twitter=200"
+LOG_PAYLOAD_OVERRIDES = os.getenv('LOG_PAYLOAD_OVERRIDES', 'bot.trace=0')
+
 logging.getLogger('httpx').setLevel(logging.WARNING)
 logging.getLogger('httpcore').setLevel(logging.WARNING)
 logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
 
 
+class PayloadFilter(logging.Filter):
+    """
+    Truncates records longer than the logger's payload limit, and keeps only a sample of them.
+
+    Limits are looked up by the longest matching logger name prefix, a limit of 0 disables truncation.
+    """
+
+    def __init__(self, max_length: int, sample_rate: float, overrides: str = ''):
+        super().__init__()
+        self.limits: dict[str, tuple[int, float]] = {'': (max_length, sample_rate)}
+        for override in filter(None, overrides.split(',')):
+            name, _, limit = override.partition('=')
+            max_length_str, _, sample_rate_str = limit.partition(':')
+            self.limits[name.strip()] = (int(max_length_str), float(sample_rate_str or 1))
+
+    def limits_for(self, name: str) -> tuple[int, float]:
+        while name not in self.limits:
+            name = name.rpartition('.')[0]
+        return self.limits[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        max_length, sample_rate = self.limits_for(record.name)
+        if not max_length:
+            return True
+
+        message = record.getMessage()
+        if len(message) <= max_length:
+            return True
+
+        if sample_rate < 1 and random.random() >= sample_rate:
+            return False
+
+        record.msg = f"{message[:max_length]}... [{len(message) - max_length} chars truncated]"
+        record.args = None
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            'time': self.formatTime(record),
+            'name': record.name,
+            'level': record.levelname,
+            'message': record.getMessage()
+        }, ensure_ascii=False)
+
+
+os.makedirs(LOG_DIR, exist_ok=True)
+
 logger = logging.getLogger('bot')
 
 logger.setLevel(logging.DEBUG)
@@ -18,14 +89,57 @@ formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(messag
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(formatter)
-file_handler = logging.FileHandler('logs/bot.log')
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
+
+
+def create_file_handler(log_file: str) -> logging.Handler:
+    # delay: the file is only opened by the first record, worker processes switch files before logging anything
+    if LOG_ROTATION == 'time':
+        handler = TimedRotatingFileHandler(os.path.join(LOG_DIR, log_file), when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    else:
+        handler = RotatingFileHandler(os.path.join(LOG_DIR, log_file), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    handler.setLevel(logging.DEBUG)
+    handler.setFormatter(JsonFormatter() if LOG_JSON else formatter)
+    return handler
+
+
+file_handler = create_file_handler(LOG_FILE)
+
+# Records are formatted on the caller's thread and written by a background thread, so disk I/O never blocks the event loop
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(PayloadFilter(LOG_MAX_PAYLOAD, LOG_PAYLOAD_SAMPLE_RATE, LOG_PAYLOAD_OVERRIDES))
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 logger.handlers = []
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(queue_handler)
+
+
+def set_log_file(log_file: str) -> None:
+    """Write the log to another file in LOG_DIR, used by worker processes, as several processes rotating one file would race."""
+    global file_handler
+    log_listener.stop()
+    file_handler.close()
+    file_handler = create_file_handler(log_file)
+    log_listener.handlers = (console_handler, file_handler)
+    log_listener.start()
+
+
+class InstrumentedRedis(redis.Redis):
+    """Redis client recording the latency of every command sent outside a pipeline, and tracing it."""
+
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).lower()
+        start = time.perf_counter()
+        try:
+            with span(f"redis.{command}"):
+                return await super().execute_command(*args, **options)
+        finally:
+            REDIS_COMMAND_DURATION.observe(time.perf_counter() - start, command=command)
+
 
-redis_client = redis.Redis(
+redis_client = InstrumentedRedis(
     host=os.getenv('REDIS_HOST', 'redis'),
     port=int(os.getenv('REDIS_PORT', 6379)),
     db=int(os.getenv('REDIS_DB', 0)),
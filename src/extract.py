@@ -0,0 +1,241 @@
+"""
+extract.py
+
+Single-pass main content extraction for web pages handed to the LLM (get_web_content).
+
+The page is parsed once with HTMLParser into a flat list of text blocks (paragraphs, headings, list items, ...).
+Scripts, styles, forms and friends are skipped while parsing, nav / aside / footer and elements whose class or id
+look like boilerplate (menu, sidebar, comments, share, ...) are marked. Every block then scores its enclosing
+containers readability-style (text length, commas, link density), and the blocks of the best scoring container
+are rendered as compact text or Markdown.
+
+Blocks are emitted in document order, so each container only has to remember the range of blocks it spans, which
+keeps the whole extraction linear in the size of the page.
+"""
+
+import re
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+
+SKIP_TAGS = {"script", "style", "noscript", "template", "svg", "math", "iframe", "object", "canvas", "head",
+             "form", "button", "select", "textarea", "dialog"}
+BOILERPLATE_TAGS = {"nav", "aside", "footer"}
+CONTAINER_TAGS = {"body", "div", "section", "article", "main", "td", "table", "tbody", "ul", "ol", "blockquote", "header"}
+BLOCK_TAGS = {"p", "h1", "h2", "h3", "h4", "h5", "h6", "li", "pre", "dt", "dd", "th", "td", "tr", "figcaption",
+              "caption", "blockquote", "hr"} | CONTAINER_TAGS
+# anything else opening while <head> is the innermost open element implies </head>
+HEAD_TAGS = {"title", "meta", "link", "style", "script", "noscript", "base", "template"}
+VOID_TAGS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+BOILERPLATE_HINT_REGEX = re.compile(
+    r"nav|menu|footer|sidebar|comment|share|social|breadcrumb|banner|advert|promo|related|cookie|popup|"
+    r"subscribe|newsletter|signup|login|masthead|widget|sponsor|disqus", re.I)
+CONTENT_HINT_REGEX = re.compile(r"article|content|post|entry|main|story|text|body|blog", re.I)
+WHITESPACE_REGEX = re.compile(r"\s+")
+
+MIN_BLOCK_LENGTH = 25
+MAX_LINK_DENSITY = 0.5
+
+
+@dataclass
+class Block:
+    tag: str
+    text: str
+    link_chars: int
+    boilerplate: bool
+
+
+@dataclass
+class Container:
+    tag: str
+    parent: int
+    weight: float
+    first_block: int
+    end_block: int = -1
+    score: float = 0
+    blocks: list[int] = field(default_factory=list)
+
+
+@dataclass
+class Element:
+    tag: str
+    container: int
+    boilerplate: bool
+    skip: bool
+
+
+class ContentExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title_parts: list[str] = []
+        self.blocks: list[Block] = []
+        self.containers: list[Container] = [Container("root", -1, 0, 0)]
+        self.stack: list[Element] = [Element("root", 0, False, False)]
+        # open elements per tag, so end tags without an open match are dropped without searching the stack
+        self.open_tags: dict[str, int] = {}
+        self.parts: list[str] = []
+        self.block_tag = "p"
+        self.link_chars = 0
+        self.link_depth = 0
+        self.in_title = False
+
+    def flush(self, next_tag: str | None = None) -> None:
+        if self.parts:
+            text = "".join(self.parts)
+            text = text.strip("\n") if self.block_tag == "pre" else WHITESPACE_REGEX.sub(" ", text).strip()
+            if text:
+                top = self.stack[-1]
+                self.blocks.append(Block(self.block_tag, text, min(self.link_chars, len(text)), top.boilerplate))
+                self.containers[top.container].blocks.append(len(self.blocks) - 1)
+            self.parts = []
+            self.link_chars = 0
+        if next_tag is not None:
+            self.block_tag = next_tag
+
+    def handle_starttag(self, tag, attrs):
+        if self.stack[-1].tag == "head" and tag not in HEAD_TAGS:
+            # </head> is optional, <body> or any body content closes the head
+            self.handle_endtag("head")
+
+        top = self.stack[-1]
+        if tag == "title":
+            # the head is skipped content itself, but a <title> of e.g. an inline <svg> icon isn't the page's
+            self.in_title = top.tag == "head" or not top.skip
+            return
+        if tag in VOID_TAGS:
+            if tag == "br":
+                self.parts.append("\n")
+            elif tag in BLOCK_TAGS:
+                self.flush()
+            return
+
+        hints = " ".join(value for name, value in attrs if name in ("class", "id", "role") and value)
+        boilerplate = top.boilerplate or tag in BOILERPLATE_TAGS or bool(hints and BOILERPLATE_HINT_REGEX.search(hints))
+        skip = top.skip or tag in SKIP_TAGS or any(name == "hidden" or (name == "aria-hidden" and value == "true") for name, value in attrs)
+
+        container = top.container
+        if tag in BLOCK_TAGS:
+            self.flush(tag)
+        if tag in CONTAINER_TAGS and not skip:
+            weight = 0
+            if tag in ("article", "main"):
+                weight += 10
+            if hints and CONTENT_HINT_REGEX.search(hints):
+                weight += 25
+            if hints and BOILERPLATE_HINT_REGEX.search(hints):
+                weight -= 25
+            self.containers.append(Container(tag, top.container, weight, len(self.blocks)))
+            container = len(self.containers) - 1
+
+        if tag == "a":
+            self.link_depth += 1
+        self.stack.append(Element(tag, container, boilerplate, skip))
+        self.open_tags[tag] = self.open_tags.get(tag, 0) + 1
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self.in_title = False
+            return
+
+        # tolerate unbalanced markup: close up to the nearest matching open tag, ignore strays. Only end tags with an
+        # open match search the stack, and everything searched past is popped, so this stays linear
+        if not self.open_tags.get(tag):
+            return
+        for i in range(len(self.stack) - 1, 0, -1):
+            if self.stack[i].tag == tag:
+                break
+        else:
+            return
+
+        if tag in BLOCK_TAGS:
+            self.flush("p")
+        while len(self.stack) > i:
+            element = self.stack.pop()
+            self.open_tags[element.tag] -= 1
+            if element.tag == "a":
+                self.link_depth -= 1
+            if element.container != self.stack[-1].container:
+                self.flush()
+                self.containers[element.container].end_block = len(self.blocks)
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title_parts.append(data)
+            return
+        if self.stack[-1].skip:
+            return
+        self.parts.append(data)
+        if self.link_depth:
+            self.link_chars += len(data.strip())
+
+    def close(self):
+        super().close()
+        self.flush()
+        for container in self.containers:
+            if container.end_block < 0:
+                container.end_block = len(self.blocks)
+
+
+def score_containers(containers: list[Container], blocks: list[Block]) -> None:
+    for container in containers:
+        container.score += container.weight
+        for index in container.blocks:
+            block = blocks[index]
+            if block.boilerplate or len(block.text) < MIN_BLOCK_LENGTH:
+                continue
+            link_density = block.link_chars / len(block.text)
+            score = (1 + block.text.count(",") + block.text.count("，") + min(len(block.text) / 100, 3)) * (1 - link_density)
+
+            # credit the container and, decaying, two levels of ancestors
+            container.score += score
+            level, ancestor = 2, container.parent
+            while ancestor >= 0 and level <= 3:
+                containers[ancestor].score += score / level
+                level, ancestor = level + 1, containers[ancestor].parent
+
+
+def keep_block(block: Block) -> bool:
+    if block.boilerplate:
+        return False
+    if block.tag in ("h1", "h2", "h3", "h4", "h5", "h6", "pre"):
+        return True
+    return block.link_chars / len(block.text) <= MAX_LINK_DENSITY
+
+
+def render_block(block: Block, markdown: bool) -> str:
+    if not markdown:
+        return block.text
+    if block.tag[0] == "h" and block.tag[1:].isdigit():
+        return f"{'#' * int(block.tag[1])} {block.text}"
+    if block.tag == "li":
+        return f"- {block.text}"
+    if block.tag == "pre":
+        return f"```\n{block.text}\n```"
+    if block.tag == "blockquote":
+        return f"> {block.text}"
+    return block.text
+
+
+def extract_content(html: str, markdown: bool = True) -> str:
+    """Return the main content of an HTML page as Markdown (or plain text), prefixed with its title."""
+    parser = ContentExtractor()
+    parser.feed(html)
+    parser.close()
+
+    blocks, containers = parser.blocks, parser.containers
+    score_containers(containers, blocks)
+
+    best = max(containers, key=lambda container: container.score)
+    if best.score <= 0:
+        # nothing article-like, fall back to every non boilerplate block
+        best = containers[0]
+
+    lines = []
+    title = WHITESPACE_REGEX.sub(" ", "".join(parser.title_parts)).strip()
+    if title:
+        lines.append(f"# {title}" if markdown else title)
+    for block in blocks[best.first_block:best.end_block]:
+        if keep_block(block) and not (lines and block.text == title):
+            lines.append(render_block(block, markdown))
+
+    return "\n\n".join(lines)
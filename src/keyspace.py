@@ -0,0 +1,176 @@
+"""
+keyspace.py
+
+Sampled memory analytics of the Redis keyspace, grouped by key family (e.g. `user:*:messages`).
+
+Keys are sampled at random with RANDOMKEY (a keyspace no larger than the sample is scanned whole), their MEMORY
+USAGE and TTL are fetched in pipelined batches, and the sample is scaled up to DBSIZE to estimate the totals of every
+family.
+
+The periodic job's analysis is the baseline of the growth column. /redis_stats compares against it as well, but is
+stored on its own, so running it by hand doesn't move the baseline.
+
+Redis key structure:
+- admin:keyspace:snapshot -> JSON of the last periodic analysis  # Baseline for the growth column of the next one
+- admin:keyspace:on_demand -> JSON of the last /redis_stats analysis
+"""
+
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, asdict
+
+from telegram.ext import CallbackContext
+
+from core import logger, redis_client
+from leader import is_leader
+from redis_browser import format_bytes
+from tracing import traced
+
+KEYSPACE_SAMPLE_SIZE = int(os.getenv('KEYSPACE_SAMPLE_SIZE', 5000))
+KEYSPACE_ANALYTICS_INTERVAL = int(os.getenv('KEYSPACE_ANALYTICS_INTERVAL', 6 * 60 * 60))
+PIPELINE_BATCH_SIZE = 500
+REPORT_MAX_FAMILIES = 20
+
+SNAPSHOT_KEY = "admin:keyspace:snapshot"
+ON_DEMAND_KEY = "admin:keyspace:on_demand"
+
+# Families whose variable segments aren't numeric, everything after the prefix is collapsed
+FAMILY_PREFIXES = [
+    "tweets:sent:",
+    "tweets:targets:user:",
+    "tweets:urls:processing:",
+    "tweets:digest:processing:",
+    "pixiv:jobs:lock:",
+    "pixiv:jobs:result:",
+    "pixiv:chunks:",
+    "bot:instances:",
+    "admin:redis_browser:",
+]
+
+DIGEST_SEGMENT_REGEX = re.compile(r"^[0-9a-f]{16,}$")
+
+
+def normalize_key(key: str) -> str:
+    """Map a key to its family, e.g. user:123:messages -> user:*:messages."""
+    for prefix in FAMILY_PREFIXES:
+        if key.startswith(prefix):
+            return prefix + ":".join("*" for _ in key[len(prefix):].split(":"))
+
+    return ":".join(
+        "*" if segment.lstrip("-").isdigit() or DIGEST_SEGMENT_REGEX.match(segment) else segment
+        for segment in key.split(":")
+    )
+
+
+@dataclass
+class FamilyStats:
+    keys: int = 0
+    bytes: int = 0
+    with_ttl: int = 0
+    estimated_keys: float = 0
+    estimated_bytes: float = 0
+
+
+async def analyze_keyspace(sample_size: int = KEYSPACE_SAMPLE_SIZE) -> dict:
+    total_keys = await redis_client.dbsize()
+
+    sample = []
+    if total_keys <= sample_size:
+        async for key in redis_client.scan_iter(count=1000):
+            sample.append(key)
+    else:
+        # SCAN's first keys are whatever sits in the first buckets, a random sample (with repeats) isn't biased
+        for start in range(0, sample_size, PIPELINE_BATCH_SIZE):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for _ in range(min(PIPELINE_BATCH_SIZE, sample_size - start)):
+                    pipe.randomkey()
+                sample.extend(key for key in await pipe.execute() if key is not None)
+
+    families: dict[str, FamilyStats] = {}
+    for start in range(0, len(sample), PIPELINE_BATCH_SIZE):
+        batch = sample[start:start + PIPELINE_BATCH_SIZE]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in batch:
+                pipe.memory_usage(key)
+                pipe.ttl(key)
+            results = await pipe.execute(raise_on_error=False)
+
+        for i, key in enumerate(batch):
+            memory, ttl = results[i * 2], results[i * 2 + 1]
+            if not isinstance(memory, int):
+                # key expired or got deleted between SCAN and MEMORY USAGE
+                continue
+            stats = families.setdefault(normalize_key(key), FamilyStats())
+            stats.keys += 1
+            stats.bytes += memory
+            stats.with_ttl += 1 if isinstance(ttl, int) and ttl >= 0 else 0
+
+    scale = total_keys / len(sample) if sample else 0
+    for stats in families.values():
+        stats.estimated_keys = stats.keys * scale
+        stats.estimated_bytes = stats.bytes * scale
+
+    return {
+        "time": time.time(),
+        "total_keys": total_keys,
+        "sampled_keys": len(sample),
+        "families": {family: asdict(stats) for family, stats in families.items()}
+    }
+
+
+def format_report(analysis: dict, previous: dict | None) -> str:
+    families = sorted(analysis["families"].items(), key=lambda item: item[1]["estimated_bytes"], reverse=True)
+    total_bytes = sum(stats["estimated_bytes"] for _, stats in families)
+
+    message = f"Keyspace: {analysis['total_keys']} keys, ~{format_bytes(total_bytes)} (sampled {analysis['sampled_keys']})\n"
+    if previous:
+        hours = (analysis["time"] - previous["time"]) / 3600
+        message += f"Growth compared to {hours:.1f}h ago\n"
+    message += "\n"
+
+    for family, stats in families[:REPORT_MAX_FAMILIES]:
+        ttl_coverage = stats["with_ttl"] / stats["keys"] if stats["keys"] else 0
+        message += f"• {family}\n  ~{stats['estimated_keys']:.0f} keys, ~{format_bytes(stats['estimated_bytes'])}, {ttl_coverage:.0%} with ttl"
+
+        previous_stats = previous["families"].get(family) if previous else None
+        if previous_stats:
+            key_growth = stats["estimated_keys"] - previous_stats["estimated_keys"]
+            byte_growth = stats["estimated_bytes"] - previous_stats["estimated_bytes"]
+            sign = "+" if byte_growth >= 0 else "-"
+            message += f", {key_growth:+.0f} keys / {sign}{format_bytes(abs(byte_growth))}"
+        elif previous:
+            message += ", new"
+        message += "\n"
+
+    if len(families) > REPORT_MAX_FAMILIES:
+        message += f"\n… and {len(families) - REPORT_MAX_FAMILIES} smaller families"
+
+    return message
+
+
+async def take_snapshot(baseline: bool = True) -> str:
+    """
+    Analyze the keyspace and return the report. The periodic job's analysis (`baseline`) becomes the baseline of
+    the next one, on-demand ones are stored apart.
+    """
+    previous_json = await redis_client.get(SNAPSHOT_KEY)
+    previous = json.loads(previous_json) if previous_json else None
+
+    analysis = await analyze_keyspace()
+    await redis_client.set(SNAPSHOT_KEY if baseline else ON_DEMAND_KEY, json.dumps(analysis))
+
+    return format_report(analysis, previous)
+
+
+@traced("keyspace_snapshot", root=True)
+async def keyspace_snapshot_job(context: CallbackContext) -> None:
+    if not is_leader():
+        return
+
+    try:
+        report = await take_snapshot()
+        logger.info(f"Keyspace analytics:\n{report}")
+    except Exception as e:
+        logger.error(f"Keyspace analytics failed: {e}", exc_info=True)
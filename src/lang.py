@@ -0,0 +1,138 @@
+"""
+lang.py
+
+Offline language detection, to skip translation calls for text that doesn't need one: text that is already
+Simplified Chinese, or that is nothing but URLs, mentions, hashtags and emoji.
+
+Detection runs in two steps:
+
+1. Unicode script ratios over the text without URLs, mentions and hashtags: every Han, kana or Hangul character
+   counts as one unit, every word of another script as one unit. Any noticeable share of kana means Japanese,
+   Hangul means Korean, and text that is mostly not Han is some other (e.g. Latin script) language.
+2. Mostly-Han text is told apart by an n-gram model of distinctive characters and character pairs of Simplified
+   Chinese, Traditional Chinese and Japanese kanji usage. Text with few or no distinctive n-grams gets a low
+   confidence, so it's rather translated than skipped.
+
+Translation is skipped when the text is Simplified Chinese with a confidence of at least the user's threshold
+(LANG_SKIP_THRESHOLD by default, which can be set above 1 to never skip).
+
+Redis key structure:
+- user:{user_id}:translation_skip_threshold -> float  # Overrides LANG_SKIP_THRESHOLD for this user
+"""
+
+import os
+import re
+from dataclasses import dataclass
+
+from core import logger
+from metrics import TRANSLATIONS_SKIPPED
+from utils import get_redis_value
+
+LANG_SKIP_THRESHOLD = float(os.getenv('LANG_SKIP_THRESHOLD', 0.7))
+# texts with fewer units than this carry no language worth translating
+LANG_MIN_UNITS = 2
+KANA_RATIO_JAPANESE = 0.05
+# distinctive n-grams it takes to be fully confident about a mostly-Han text, fewer scale the confidence down
+LANG_MIN_EVIDENCE = 2
+# long texts (novels) are judged by their beginning
+LANG_SAMPLE_CHARS = 5000
+
+NOISE_REGEX = re.compile(r"^RT @\w+:|https?://\S+|www\.\S+|[@#]\w+")
+HAN_REGEX = re.compile(r"[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]")
+KANA_REGEX = re.compile(r"[\u3040-\u30ff\u31f0-\u31ff\uff66-\uff9f]")
+HANGUL_REGEX = re.compile(r"[\uac00-\ud7af\u1100-\u11ff\u3130-\u318f]")
+WORD_REGEX = re.compile(r"[^\W\d_]+")
+
+# distinctive characters and character pairs, only the Han part of a text is matched against them
+HAN_NGRAMS = {
+    "zh-Hans": (
+        "这们来时个说为对会没过还发现样问题经么让于从给进动与关实点将头长东车门见听书话语认识记网"
+        "热爱应该觉气电视节钱买卖边远万种业务机场岁产区华国学习写饭馆图开"
+    ) + "|" + "|".join(["的是", "了一", "我们", "他们", "这个", "那个", "什么", "没有", "因为", "已经", "现在", "怎么", "还是"]),
+    "zh-Hant": (
+        "這們來時個說為對會沒過還發現樣問題經麼讓於從給進動與關實點將頭長東車門見聽書話語認識記網熱愛應該覺"
+        "氣電視節錢買賣邊遠萬種業務機場歲產區華國學習寫飯館圖開"
+    ) + "|" + "|".join(["我們", "他們", "這個", "那個", "甚麼", "沒有", "因為", "已經", "現在", "怎麼", "還是"]),
+    "ja": (
+        "々様円駅込気図変対応広売読払働続単鉄県沢関済歳辺団権戦価隠転"
+    ) + "|" + "|".join(["日本", "東京", "大阪", "先生", "今日", "明日", "写真", "漫画", "新作", "発売", "予約", "配信", "開催", "更新", "作品"]),
+}
+
+
+def _build_ngram_model(ngrams: dict[str, str]) -> dict[str, set[str]]:
+    model = {}
+    for language, spec in ngrams.items():
+        unigrams, _, bigrams = spec.partition("|")
+        model[language] = set(unigrams) | set(filter(None, bigrams.split("|")))
+    return model
+
+
+HAN_NGRAM_MODEL = _build_ngram_model(HAN_NGRAMS)
+
+
+@dataclass
+class Detection:
+    language: str  # zh-Hans, zh-Hant, ja, ko, other or none
+    confidence: float
+    units: int
+
+
+def score_han(han: str) -> dict[str, int]:
+    """Matches of the 1- and 2-grams of a run of Han characters in the model of every language."""
+    grams = list(han) + [han[i:i + 2] for i in range(len(han) - 1)]
+    return {language: sum(gram in model for gram in grams) for language, model in HAN_NGRAM_MODEL.items()}
+
+
+def detect_language(text: str) -> Detection:
+    text = NOISE_REGEX.sub(" ", text[:LANG_SAMPLE_CHARS])
+    han = "".join(HAN_REGEX.findall(text))
+    kana = len(KANA_REGEX.findall(text))
+    hangul = len(HANGUL_REGEX.findall(text))
+    rest = HANGUL_REGEX.sub(" ", KANA_REGEX.sub(" ", HAN_REGEX.sub(" ", text)))
+    words = len(WORD_REGEX.findall(rest))
+
+    units = len(han) + kana + hangul + words
+    if units < LANG_MIN_UNITS:
+        return Detection("none", 1.0, units)
+    if kana / units >= KANA_RATIO_JAPANESE:
+        return Detection("ja", min(1.0, (kana + len(han)) / units), units)
+    if hangul * 2 >= units:
+        return Detection("ko", hangul / units, units)
+
+    han_ratio = len(han) / units
+    if han_ratio < 0.5:
+        return Detection("other", 1 - han_ratio, units)
+
+    # Han characters shared by all three are the norm, so without evidence against it Simplified Chinese is assumed,
+    # though with a confidence that drops to 0 without evidence for it either (kanji-only Japanese, plain Traditional)
+    scores = score_han(han)
+    language = max(("zh-Hans", "zh-Hant", "ja"), key=lambda language: scores[language])
+    if scores[language] == scores["zh-Hans"]:
+        language = "zh-Hans"
+    evidence = sum(scores.values())
+    confidence = han_ratio * (scores[language] + 1) / (evidence + 1) * min(1.0, evidence / LANG_MIN_EVIDENCE)
+    return Detection(language, confidence, units)
+
+
+async def skip_threshold(user_id: int | None) -> float:
+    if user_id is None:
+        return LANG_SKIP_THRESHOLD
+    try:
+        return float(await get_redis_value(f"user:{user_id}:translation_skip_threshold", LANG_SKIP_THRESHOLD))
+    except ValueError:
+        return LANG_SKIP_THRESHOLD
+
+
+async def needs_translation(text: str, user_id: int | None, source: str) -> bool:
+    """False if translating `text` to Simplified Chinese would be a waste, counted per source and reason."""
+    detection = detect_language(text)
+    if detection.language == "none":
+        reason = "no_text"
+    elif detection.language == "zh-Hans" and detection.confidence >= await skip_threshold(user_id):
+        reason = "zh-Hans"
+    else:
+        return True
+
+    logger.debug(f"Skipping {source} translation, detected {detection}")
+    TRANSLATIONS_SKIPPED.inc(source=source, reason=reason)
+    return False
@@ -0,0 +1,145 @@
+"""
+leader.py
+
+Redis lease based leader election, so several replicas of the bot can run side by side without
+duplicating scheduled work.
+
+Redis key structure:
+- bot:leader -> {instance_id}  # Lease, expires after LEADER_LEASE_TTL seconds unless renewed
+- bot:leader:token -> int  # Fencing token, incremented every time the lease changes hands
+- bot:instances:{instance_id} -> 1  # Liveness marker of every replica, renewed on each heartbeat
+- tweets:urls:processing:{instance_id} -> [tweet1, ...]  # Queue items claimed by a replica
+- tweets:digest:processing:{instance_id}:{chat_id} -> [tweet1, ...]  # Digest records claimed by a replica (see tweet.py)
+
+Only the leader runs the scrape scheduler (`check_for_new_tweets`). Every write made on behalf of the
+leader carries the fencing token it got when acquiring the lease, and is rejected by Redis once a newer
+leader has taken over, so a paused ex-leader can't enqueue stale work.
+
+Delivery is shared by all replicas: each one atomically moves items from `tweets:urls:queue` into its own
+processing list before sending them, so an item is only ever delivered by one replica. The leader
+pushes items claimed by dead replicas back onto the queue, and their digest records back into the chats' buffers.
+"""
+
+import os
+import socket
+import uuid
+
+from telegram.ext import CallbackContext
+
+from core import logger, redis_client
+from tracing import traced
+
+LEADER_LEASE_TTL = int(os.getenv('LEADER_LEASE_TTL', 30))
+LEADER_HEARTBEAT_INTERVAL = int(os.getenv('LEADER_HEARTBEAT_INTERVAL', 10))
+
+LEADER_KEY = "bot:leader"
+LEADER_TOKEN_KEY = "bot:leader:token"
+
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+
+# KEYS[1] = lease, KEYS[2] = fencing token; ARGV[1] = instance id, ARGV[2] = ttl (ms)
+# returns the fencing token if we hold the lease after the call, 0 otherwise
+ACQUIRE_OR_RENEW_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    return tonumber(redis.call('GET', KEYS[2]) or '0')
+end
+if holder then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return redis.call('INCR', KEYS[2])
+"""
+
+# KEYS[1] = lease; ARGV[1] = instance id
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_acquire_or_renew = redis_client.register_script(ACQUIRE_OR_RENEW_SCRIPT)
+_release = redis_client.register_script(RELEASE_SCRIPT)
+
+_fencing_token: int = 0
+
+
+def is_leader() -> bool:
+    """Whether this replica held the lease as of its last heartbeat."""
+    return _fencing_token > 0
+
+
+def fencing_token() -> int:
+    """The fencing token of the current lease, or 0 if this replica isn't the leader."""
+    return _fencing_token
+
+
+def processing_key(instance_id: str = INSTANCE_ID) -> str:
+    return f"tweets:urls:processing:{instance_id}"
+
+
+def digest_processing_key(chat_id: int | str, instance_id: str = INSTANCE_ID) -> str:
+    return f"tweets:digest:processing:{instance_id}:{chat_id}"
+
+
+@traced("leader_heartbeat", root=True)
+async def leader_heartbeat(context: CallbackContext | None = None) -> None:
+    """
+    Renew this replica's liveness marker and try to acquire (or renew) the leader lease.
+
+    Scheduled on every replica at LEADER_HEARTBEAT_INTERVAL, which must be well below LEADER_LEASE_TTL.
+    """
+    global _fencing_token
+
+    try:
+        await redis_client.set(f"bot:instances:{INSTANCE_ID}", 1, ex=LEADER_LEASE_TTL)
+        token = int(await _acquire_or_renew(keys=[LEADER_KEY, LEADER_TOKEN_KEY], args=[INSTANCE_ID, LEADER_LEASE_TTL * 1000]))
+    except Exception as e:
+        # if we can't talk to redis we can't prove we still hold the lease, step down
+        logger.error(f"Leader heartbeat failed: {e}")
+        token = 0
+
+    if token and not _fencing_token:
+        logger.info(f"Instance {INSTANCE_ID} became leader with fencing token {token}")
+    elif not token and _fencing_token:
+        logger.warning(f"Instance {INSTANCE_ID} lost leadership")
+    _fencing_token = token
+
+    if _fencing_token:
+        await requeue_orphaned_tweets()
+
+
+async def requeue_orphaned_tweets() -> None:
+    """Push queue items (and digest records) claimed by replicas that stopped heartbeating back where they came from."""
+    async for key in redis_client.scan_iter("tweets:urls:processing:*"):
+        instance_id = key.split(":", 3)[-1]
+        if instance_id == INSTANCE_ID or await redis_client.exists(f"bot:instances:{instance_id}"):
+            continue
+
+        while await redis_client.lmove(key, "tweets:urls:queue", "LEFT", "RIGHT"):
+            pass
+        logger.info(f"Requeued tweets claimed by dead instance {instance_id}")
+
+    async for key in redis_client.scan_iter("tweets:digest:processing:*"):
+        instance_id, _, chat_id = key.split(":", 3)[-1].rpartition(":")
+        if instance_id == INSTANCE_ID or await redis_client.exists(f"bot:instances:{instance_id}"):
+            continue
+
+        # in front of the chat's buffer, and due right away
+        while await redis_client.lmove(key, f"tweets:digest:{chat_id}", "RIGHT", "LEFT"):
+            pass
+        await redis_client.zadd("tweets:digest:due", {chat_id: 0})
+        logger.info(f"Requeued digest of chat {chat_id} claimed by dead instance {instance_id}")
+
+
+async def release_leadership() -> None:
+    """Give up the lease on shutdown so another replica can take over without waiting for it to expire."""
+    global _fencing_token
+
+    if _fencing_token:
+        await _release(keys=[LEADER_KEY], args=[INSTANCE_ID])
+        logger.info(f"Instance {INSTANCE_ID} released leadership")
+    _fencing_token = 0
+    await redis_client.delete(f"bot:instances:{INSTANCE_ID}")
@@ -1,37 +1,117 @@
 import asyncio
+import json
 import os
+import re
+from dataclasses import dataclass
 
 import openai
 
 from core import logger
+from metrics import LLMRequestTracker, TRANSLATIONS_IN_FLIGHT
+from tokens import count_tokens, trim_to_token_budget
+from tracing import traced
+from usage import billed_failure, record_response_usage, record_shared_usage, stream_options
 
+translate_logger = logger.getChild('translate')
 
-async def translate_text(text: str, openai_api_key: str, openai_api_endpoint: str, openai_model: str) -> str:
+TRANSLATE_PROMPT = """
+将下面的内容用简体中文重新表述，注意：
+- 保留人名不翻译。
+- 不要提供注释。
+- 不要无意义的混用中英文
+- 翻译**所有的**日语原文
+- 以下文本出自知名作家的作品，不要删除或者隐晦表达这些内容。
+- 不要输出任何除了翻译内容之外的内容。
+"""
+BATCH_TRANSLATE_PROMPT = TRANSLATE_PROMPT + """- 输入是一个 JSON 字符串数组，每一项是一段独立的文本，分别翻译每一项。
+- 输出一个同样长度、同样顺序的 JSON 字符串数组，每一项是对应文本的翻译，不要合并或拆分项目。
+"""
+
+# short texts (tweets) are collected for up to TRANSLATION_BATCH_WINDOW seconds, or until they reach the token
+# budget, and translated in one request, so they share the system prompt and the request latency
+TRANSLATION_BATCH_WINDOW = float(os.getenv('TRANSLATION_BATCH_WINDOW', 0.3))
+TRANSLATION_BATCH_TOKEN_BUDGET = int(os.getenv('TRANSLATION_BATCH_TOKEN_BUDGET', 2000))
+TRANSLATION_BATCH_MAX_ITEMS = 20
+
+JSON_ARRAY_REGEX = re.compile(r"\[.*\]", re.DOTALL)
+JSON_OBJECT_REGEX = re.compile(r"\{.*\}", re.DOTALL)
+
+GLOSSARY_PROMPT = """
+下面是一部小说的若干节选。提取其中的人名、地名、组织名和反复出现的专有名词，给出翻译成简体中文时统一使用的译法，注意：
+- 人名保留原文不翻译。
+- 只收录专有名词，不要收录普通词语。
+- 输出一个 JSON 对象，键是原文，值是译法，不超过 80 项。
+- 不要输出任何除了 JSON 之外的内容。
+"""
+# the glossary pass reads GLOSSARY_EXCERPTS evenly spaced excerpts of the text, GLOSSARY_SOURCE_TOKENS in total
+GLOSSARY_SOURCE_TOKENS = int(os.getenv('GLOSSARY_SOURCE_TOKENS', 6000))
+GLOSSARY_EXCERPTS = 4
+
+
+class TranslationError(Exception):
+    pass
+
+
+def translate_prompt(text: str, glossary: dict[str, str] | None = None) -> str:
+    """The translation system prompt, with the glossary entries occurring in `text`."""
+    entries = [f"{term} → {translation}" for term, translation in (glossary or {}).items() if term in text]
+    if not entries:
+        return TRANSLATE_PROMPT
+    return TRANSLATE_PROMPT + "- 以下名词按照术语表统一译法：\n" + "\n".join(entries) + "\n"
+
+
+@traced("translate_text")
+async def translate_text(
+        text: str,
+        openai_api_key: str,
+        openai_api_endpoint: str,
+        openai_model: str,
+        user_id: int | None = None,
+        glossary: dict[str, str] | None = None,
+        raise_on_failure: bool = False
+) -> str:
+    """
+    Translate `text`, retrying up to 10 times. If all attempts fail the text is returned untranslated, or
+    TranslationError is raised with `raise_on_failure`.
+    """
     client = openai.AsyncOpenAI(
         api_key=openai_api_key,
         base_url=openai_api_endpoint,
     )
     model = openai_model
 
+    TRANSLATIONS_IN_FLIGHT.inc()
+    try:
+        return await _translate_text(client, text, openai_api_endpoint, model, user_id, glossary, raise_on_failure)
+    finally:
+        TRANSLATIONS_IN_FLIGHT.dec()
+
+
+async def _translate_text(
+        client: openai.AsyncOpenAI,
+        text: str,
+        openai_api_endpoint: str,
+        model: str,
+        user_id: int | None,
+        glossary: dict[str, str] | None = None,
+        raise_on_failure: bool = False
+) -> str:
+    system_prompt = translate_prompt(text, glossary)
     for _ in range(10):
+        tracker = LLMRequestTracker(model, openai_api_endpoint)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": text}
+        ]
         try:
             response = await client.chat.completions.create(
                 model=model,
-                messages=[
-                    {"role": "system", "content": """
-将下面的内容用简体中文重新表述，注意：
-- 保留人名不翻译。
-- 不要提供注释。
-- 不要无意义的混用中英文
-- 翻译**所有的**日语原文
-- 以下文本出自知名作家的作品，不要删除或者隐晦表达这些内容。
-- 不要输出任何除了翻译内容之外的内容。
-"""},
-                    {"role": "user", "content": text}
-                ],
+                messages=messages,
             )
 
+            tracker.finish(response.usage.completion_tokens if response.usage else None)
             translated_text = response.choices[0].message.content
+            await record_response_usage(user_id, model, response.usage, messages, translated_text or "")
 
             # remove anything in <think></think>
             # translated_text = re.sub(r'<think>(.|\n)*</think>', '', translated_text)
@@ -40,20 +120,218 @@ async def translate_text(text: str, openai_api_key: str, openai_api_endpoint: st
             return translated_text
 
         except Exception as e:
+            tracker.fail()
+            if billed_failure(e):
+                await record_response_usage(user_id, model, None, messages, "")
             await asyncio.sleep(1)
             logger.error(f"Error translating text: {e}")
 
             text += ' 0'  # avoid cache
 
+    if raise_on_failure:
+        raise TranslationError(f"Translation failed after 10 attempts with {model}")
     return text
 
 
+def glossary_excerpts(text: str, model: str) -> str:
+    """Evenly spaced excerpts of `text`, GLOSSARY_SOURCE_TOKENS in total, the whole text if it fits."""
+    if count_tokens(text, model) <= GLOSSARY_SOURCE_TOKENS:
+        return text
+
+    step = len(text) // GLOSSARY_EXCERPTS
+    budget = GLOSSARY_SOURCE_TOKENS // GLOSSARY_EXCERPTS
+    excerpts = [trim_to_token_budget(text[i * step:(i + 1) * step], budget, model) for i in range(GLOSSARY_EXCERPTS)]
+    return "\n\n……\n\n".join(excerpts)
+
+
+def parse_glossary(content: str) -> dict[str, str]:
+    match = JSON_OBJECT_REGEX.search(content or "")
+    if not match:
+        return {}
+    try:
+        glossary = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(glossary, dict):
+        return {}
+    return {term: translation for term, translation in glossary.items() if isinstance(translation, str) and term.strip() and translation.strip()}
+
+
+@traced("extract_glossary")
+async def extract_glossary(text: str, openai_api_key: str, openai_api_endpoint: str, openai_model: str, user_id: int | None = None) -> dict[str, str]:
+    """
+    A {term: translation} glossary of the names and terms in `text`, so chunks translated in parallel use the same
+    translations. Returns an empty glossary if the model's reply isn't a JSON object.
+    """
+    openai_api_endpoint = openai_api_endpoint or 'https://api.openai.com/v1'
+    openai_model = openai_model or 'gpt-4o'
+
+    client = openai.AsyncOpenAI(api_key=openai_api_key, base_url=openai_api_endpoint)
+    messages = [
+        {"role": "system", "content": GLOSSARY_PROMPT},
+        {"role": "user", "content": glossary_excerpts(text, openai_model)}
+    ]
+
+    tracker = LLMRequestTracker(openai_model, openai_api_endpoint)
+    try:
+        response = await client.chat.completions.create(model=openai_model, messages=messages)
+    except Exception as e:
+        tracker.fail()
+        if billed_failure(e):
+            await record_response_usage(user_id, openai_model, None, messages, "")
+        raise
+    tracker.finish(response.usage.completion_tokens if response.usage else None)
+
+    content = response.choices[0].message.content or ""
+    await record_response_usage(user_id, openai_model, response.usage, messages, content)
+    glossary = parse_glossary(content)
+    translate_logger.debug(f"Extracted glossary of {len(glossary)} terms")
+    return glossary
+
+
+def parse_batch_translation(content: str, count: int) -> list[str] | None:
+    """The translations of a batched request, None unless the reply is a JSON array of `count` strings."""
+    match = JSON_ARRAY_REGEX.search(content or "")
+    if not match:
+        return None
+    try:
+        translations = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    if len(translations) != count or not all(isinstance(translation, str) and translation.strip() for translation in translations):
+        return None
+    return translations
+
+
+async def _translate_batch(client: openai.AsyncOpenAI, texts: list[str], openai_api_endpoint: str, model: str, weights: dict) -> list[str] | None:
+    messages = [
+        {"role": "system", "content": BATCH_TRANSLATE_PROMPT},
+        {"role": "user", "content": json.dumps(texts, ensure_ascii=False)}
+    ]
+    tracker = LLMRequestTracker(model, openai_api_endpoint)
+    try:
+        response = await client.chat.completions.create(model=model, messages=messages)
+    except Exception as e:
+        tracker.fail()
+        if billed_failure(e):
+            await record_shared_usage(weights, model, None, messages, "")
+        raise
+    tracker.finish(response.usage.completion_tokens if response.usage else None)
+
+    content = response.choices[0].message.content or ""
+    await record_shared_usage(weights, model, response.usage, messages, content)
+    return parse_batch_translation(content, len(texts))
+
+
+@dataclass
+class PendingTranslation:
+    text: str
+    user_id: int | None
+    tokens: int
+    future: asyncio.Future
+
+
+class TranslationBatcher:
+    """
+    Collects translations of short texts per (endpoint, model, api key) and sends each batch as one request with
+    a JSON array of texts. Batches whose reply can't be split back into one translation per text are translated
+    one by one instead.
+    """
+
+    def __init__(self, window: float, token_budget: int, max_items: int):
+        self.window = window
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self._batches: dict[tuple, list[PendingTranslation]] = {}
+        self._timers: dict[tuple, asyncio.TimerHandle] = {}
+        # the loop only keeps weak references to tasks, sends in flight are kept here until they finish
+        self._sends: set[asyncio.Task] = set()
+
+    async def translate(self, text: str, openai_api_key: str, openai_api_endpoint: str, openai_model: str, user_id: int | None = None) -> str:
+        key = (openai_api_endpoint, openai_model, openai_api_key)
+        loop = asyncio.get_running_loop()
+        pending = PendingTranslation(text, user_id, count_tokens(text, openai_model), loop.create_future())
+
+        batch = self._batches.get(key, [])
+        if batch and sum(item.tokens for item in batch) + pending.tokens > self.token_budget:
+            self._flush(key)
+        batch = self._batches.setdefault(key, [])
+        batch.append(pending)
+        if len(batch) == 1:
+            self._timers[key] = loop.call_later(self.window, self._flush, key)
+        if len(batch) >= self.max_items:
+            self._flush(key)
+
+        return await pending.future
+
+    def _flush(self, key: tuple) -> None:
+        self._timers.pop(key).cancel()
+        batch = self._batches.pop(key)
+        task = asyncio.create_task(self._send(key, batch))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    async def _send(self, key: tuple, batch: list[PendingTranslation]) -> None:
+        openai_api_endpoint, model, openai_api_key = key
+        client = openai.AsyncOpenAI(api_key=openai_api_key, base_url=openai_api_endpoint)
+
+        TRANSLATIONS_IN_FLIGHT.inc()
+        try:
+            translations = None
+            if len(batch) > 1:
+                weights: dict = {}
+                for item in batch:
+                    weights[item.user_id] = weights.get(item.user_id, 0) + item.tokens
+                try:
+                    translations = await _translate_batch(client, [item.text for item in batch], openai_api_endpoint, model, weights)
+                except Exception as e:
+                    logger.error(f"Error translating a batch of {len(batch)} texts: {e}")
+                if translations is None:
+                    logger.warning(f"Batched translation of {len(batch)} texts failed, translating them one by one")
+
+            if translations is None:
+                translations = await asyncio.gather(*[
+                    _translate_text(client, item.text, openai_api_endpoint, model, item.user_id) for item in batch
+                ])
+
+            for item, translation in zip(batch, translations):
+                if not item.future.done():
+                    item.future.set_result(translation)
+        except BaseException as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            raise
+        finally:
+            TRANSLATIONS_IN_FLIGHT.dec()
+
+
+short_text_batcher = TranslationBatcher(TRANSLATION_BATCH_WINDOW, TRANSLATION_BATCH_TOKEN_BUDGET, TRANSLATION_BATCH_MAX_ITEMS)
+
+
+@traced("translate_short_text")
+async def translate_short_text(text: str, openai_api_key: str, openai_api_endpoint: str, openai_model: str, user_id: int | None = None) -> str:
+    """Like translate_text, for short texts (tweets): concurrent requests are batched into one LLM request."""
+    return await short_text_batcher.translate(text, openai_api_key, openai_api_endpoint, openai_model, user_id)
+
+
+@traced("translate_text_by_page")
 async def translate_text_by_page(
         text: str,
         openai_api_key: str,
         openai_api_endpoint: str | None = None,
-        openai_model: str | None = None
+        openai_model: str | None = None,
+        user_id: int | None = None,
+        glossary: dict[str, str] | None = None,
+        checkpoints=None
 ) -> str:
+    """
+    Translate `text` in chunks of about 800 characters, 5 at a time. Chunks don't see each other, pass a glossary
+    (see extract_glossary) to keep names and terms consistent across them.
+
+    Raises TranslationError if a chunk exhausts its retries. With `checkpoints` (see pixiv_jobs.ChunkCheckpoints)
+    finished chunks are stored as they complete, and chunks stored before aren't translated again.
+    """
     if not openai_api_key:
         raise Exception("OpenAI API key is required")
 
@@ -87,9 +365,14 @@ async def translate_text_by_page(
             if page.strip() == "":
                 return page
 
+            if checkpoints is not None and (result := await checkpoints.get(page)) is not None:
+                return result
+
             # logger.debug(f"Translating page: {page}")
-            result = await translate_text(page, openai_api_key, openai_api_endpoint, openai_model)
-            logger.debug(f"Translated page: {page} \n===\n{result}")
+            result = await translate_text(page, openai_api_key, openai_api_endpoint, openai_model, user_id, glossary, raise_on_failure=True)
+            translate_logger.debug(f"Translated page: {page} \n===\n{result}")
+            if checkpoints is not None:
+                await checkpoints.set(page, result)
 
             await asyncio.sleep(1)
 
@@ -100,6 +383,7 @@ async def translate_text_by_page(
     return "\n".join(translated_pages)
 
 
+@traced("translate_text_stream")
 async def translate_text_stream(
     text: str,
     openai_api_key: str,
@@ -107,19 +391,24 @@ async def translate_text_stream(
     openai_model: str,
     callback: callable,
     message_context: list = None,
-    translated_context: list = None
+    translated_context: list = None,
+    user_id: int | None = None,
+    raise_on_failure: bool = False
 ) -> str:
     """
-    Stream translation results in real-time using a callback function.
+    Translate text with context, passing the translation to a callback function once it's complete. An attempt
+    that fails halfway is retried from scratch, so partial output is never passed on.
 
     Args:
         text: The text to translate
         openai_api_key: OpenAI API key
         openai_api_endpoint: OpenAI API endpoint
         openai_model: OpenAI model to use
-        callback: Callback function that receives translated chunks as they become available
+        callback: Callback function that receives the translated text
         message_context: List of previous original text chunks for context
         translated_context: List of previous translated text chunks for context
+        user_id: User whose token usage the translation is recorded to
+        raise_on_failure: Raise TranslationError instead of returning the text untranslated once retries run out
 
     Returns:
         The complete translated text
@@ -132,15 +421,7 @@ async def translate_text_stream(
 
     # Prepare messages with context
     messages = [
-        {"role": "system", "content": """
-将下面的内容用简体中文重新表述，注意：
-- 保留人名不翻译。
-- 不要提供注释。
-- 不要无意义的混用中英文
-- 翻译**所有的**日语原文
-- 以下文本出自知名作家的作品，不要删除或者隐晦表达这些内容。
-- 不要输出任何除了翻译内容之外的内容。
-"""}
+        {"role": "system", "content": TRANSLATE_PROMPT}
     ]
 
     # Add context if available
@@ -152,39 +433,59 @@ async def translate_text_stream(
     # Add the current text to translate
     messages.append({"role": "user", "content": text})
 
+    TRANSLATIONS_IN_FLIGHT.inc()
+    try:
+        return await _translate_text_stream(client, text, openai_api_endpoint, model, messages, callback, user_id, raise_on_failure)
+    finally:
+        TRANSLATIONS_IN_FLIGHT.dec()
+
+
+async def _translate_text_stream(
+        client: openai.AsyncOpenAI,
+        text: str,
+        openai_api_endpoint: str,
+        model: str,
+        messages: list,
+        callback: callable,
+        user_id: int | None,
+        raise_on_failure: bool = False
+) -> str:
     for attempt in range(10):
+        tracker = LLMRequestTracker(model, openai_api_endpoint)
+        full_translation = ""
+        usage = None
         try:
             stream = await client.chat.completions.create(
                 model=model,
                 messages=messages,
-                stream=True
+                stream=True,
+                **stream_options()
             )
 
-            full_translation = ""
-            buffer = ""
-
             async for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    buffer += content
-                    full_translation += content
-
-                    # When buffer reaches a certain size, send it to the callback
-                    if len(buffer) >= 50 or '\n' in buffer:
-                        await callback(buffer)
-                        buffer = ""
+                if chunk.usage:
+                    usage = chunk.usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    tracker.token()
+                    full_translation += chunk.choices[0].delta.content
 
-            # Send any remaining content in the buffer
-            if buffer:
-                await callback(buffer)
+            tracker.finish(usage.completion_tokens if usage else None)
+            await record_response_usage(user_id, model, usage, messages, full_translation)
 
+            # only a finished attempt is passed on, the output of a failed one can't be taken back once sent
+            await callback(full_translation)
             return full_translation
 
         except Exception as e:
+            tracker.fail()
+            if billed_failure(e, full_translation):
+                await record_response_usage(user_id, model, usage, messages, full_translation)
             await asyncio.sleep(1)
             logger.error(f"Error translating text: {e}")
             text += f' {attempt}'  # avoid cache
 
+    if raise_on_failure:
+        raise TranslationError(f"Translation failed after 10 attempts with {model}")
     return text
 
 
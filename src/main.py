@@ -1,21 +1,27 @@
+import asyncio
 import os
 
 from telegram import Update
-from telegram.ext import CommandHandler, MessageHandler, filters, ApplicationBuilder, ContextTypes
+from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters, Application, ApplicationBuilder, ContextTypes
 
 from chat import handle_message
-from commands import set_openai_key_command, set_openai_endpoint_command, set_openai_model_command, set_openai_enable_tools_command, start_command, \
-    help_command, subscribe_twitter_user_command, unsubscribe_twitter_user_command, status_command, set_twitter_translation_command, set_pixiv_translation_command, set_pixiv_direct_translation_command, set_pixiv_streaming_translation_command, \
-    set_system_prompt_command, reset_system_prompt_command, show_system_prompt_command, list_twitter_subscription_command, \
-    get_redis_command, set_redis_command, del_redis_command, list_redis_command
+from commands import COMMANDS, CALLBACK_QUERY_HANDLERS
 from core import logger
-from tweet import check_for_new_tweets, send_tweets
+from keyspace import keyspace_snapshot_job, KEYSPACE_ANALYTICS_INTERVAL
+from leader import leader_heartbeat, release_leadership, LEADER_HEARTBEAT_INTERVAL
+from metrics import InstrumentedRequest, start_metrics_server
+from shard import route_update, WorkerPool, SHARD_WORKERS
+from tracing import traced
 
 STOP_TWITTER_SCRAPE = os.getenv('STOP_TWITTER_SCRAPE', 'false').lower() == 'true'
 SCRAPE_INTERVAL = int(os.environ.get('SCRAPE_INTERVAL', 300))
 SENT_INTERVAL = int(os.environ.get('SENT_INTERVAL', 10))
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
 
 
+@traced("handle_command", root=True)
 async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handle commmands from channel posts
@@ -28,52 +34,36 @@ async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
 
     if update.effective_message.text.startswith('/'):
-        command = update.effective_message.text[1:].split(' ')[0]
+        command = update.effective_message.text[1:].split(' ')[0].split('@')[0]
         context.args = update.effective_message.text[1:].split(' ')[1:]
         logger.info(f"Command received: {command}")
 
-        if command == 'start':
-            await start_command(update, context)
-        elif command == 'help':
-            await help_command(update, context)
-        elif command == 'status':
-            await status_command(update, context)
-        elif command == 'set_openai_key':
-            await set_openai_key_command(update, context)
-        elif command == 'set_openai_endpoint':
-            await set_openai_endpoint_command(update, context)
-        elif command == 'set_openai_model':
-            await set_openai_model_command(update, context)
-        elif command == 'set_openai_enable_tools':
-            await set_openai_enable_tools_command(update, context)
-        elif command == 'set_twitter_translation':
-            await set_twitter_translation_command(update, context)
-        elif command == 'set_pixiv_translation':
-            await set_pixiv_translation_command(update, context)
-        elif command == 'set_pixiv_direct_translation':
-            await set_pixiv_direct_translation_command(update, context)
-        elif command == 'set_pixiv_streaming_translation':
-            await set_pixiv_streaming_translation_command(update, context)
-        elif command == 'subscribe_twitter_user':
-            await subscribe_twitter_user_command(update, context)
-        elif command == 'unsubscribe_twitter_user':
-            await unsubscribe_twitter_user_command(update, context)
-        elif command == 'set_system_prompt':
-            await set_system_prompt_command(update, context)
-        elif command == 'reset_system_prompt':
-            await reset_system_prompt_command(update, context)
-        elif command == 'show_system_prompt':
-            await show_system_prompt_command(update, context)
-        elif command == 'list_twitter_subscription':
-            await list_twitter_subscription_command(update, context)
-        elif command == 'get_redis':
-            await get_redis_command(update, context)
-        elif command == 'set_redis':
-            await set_redis_command(update, context)
-        elif command == 'del_redis':
-            await del_redis_command(update, context)
-        elif command == 'list_redis':
-            await list_redis_command(update, context)
+        handler = COMMANDS.get(command)
+        if handler:
+            await handler(update, context)
+
+
+async def on_startup(app: Application) -> None:
+    if METRICS_PORT:
+        app.bot_data['metrics_runner'] = await start_metrics_server(METRICS_LISTEN, METRICS_PORT)
+        logger.info(f"Serving metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+
+async def on_shutdown(app: Application) -> None:
+    await release_leadership()
+    if 'worker_pool' in app.bot_data:
+        app.bot_data['worker_pool'].stop()
+    if 'metrics_runner' in app.bot_data:
+        await app.bot_data['metrics_runner'].cleanup()
+
+
+def add_handlers(app: Application) -> None:
+    for command, handler in COMMANDS.items():
+        app.add_handler(CommandHandler(command, traced(f"/{command}", root=True)(handler)))
+    for pattern, handler in CALLBACK_QUERY_HANDLERS.items():
+        app.add_handler(CallbackQueryHandler(traced(f"callback:{handler.__name__}", root=True)(handler), pattern=pattern))
+    app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POSTS & filters.COMMAND, handle_command))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
 
 def main() -> None:
@@ -83,37 +73,38 @@ def main() -> None:
         raise ValueError("Please set the TELEGRAM_TOKEN environment variable")
 
     logger.info("Starting bot...")
-    app = ApplicationBuilder().token(telegram_token).build()
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(CommandHandler("status", status_command))
-    app.add_handler(CommandHandler("set_openai_key", set_openai_key_command))
-    app.add_handler(CommandHandler("set_openai_endpoint", set_openai_endpoint_command))
-    app.add_handler(CommandHandler("set_openai_model", set_openai_model_command))
-    app.add_handler(CommandHandler("set_openai_enable_tools", set_openai_enable_tools_command))
-    app.add_handler(CommandHandler("set_twitter_translation", set_twitter_translation_command))
-    app.add_handler(CommandHandler("set_pixiv_translation", set_pixiv_translation_command))
-    app.add_handler(CommandHandler("set_pixiv_direct_translation", set_pixiv_direct_translation_command))
-    app.add_handler(CommandHandler("set_pixiv_streaming_translation", set_pixiv_streaming_translation_command))
-    app.add_handler(CommandHandler("subscribe_twitter_user", subscribe_twitter_user_command))
-    app.add_handler(CommandHandler("unsubscribe_twitter_user", unsubscribe_twitter_user_command))
-    app.add_handler(CommandHandler("set_system_prompt", set_system_prompt_command))
-    app.add_handler(CommandHandler("reset_system_prompt", reset_system_prompt_command))
-    app.add_handler(CommandHandler("show_system_prompt", show_system_prompt_command))
-    app.add_handler(CommandHandler("list_twitter_subscription", list_twitter_subscription_command))
-    app.add_handler(CommandHandler("get_redis", get_redis_command))
-    app.add_handler(CommandHandler("set_redis", set_redis_command))
-    app.add_handler(CommandHandler("del_redis", del_redis_command))
-    app.add_handler(CommandHandler("list_redis", list_redis_command))
-    app.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POSTS & filters.COMMAND, handle_command))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app = ApplicationBuilder() \
+        .token(telegram_token) \
+        .request(InstrumentedRequest(connection_pool_size=256)) \
+        .post_init(on_startup) \
+        .post_shutdown(on_shutdown) \
+        .build()
+    if SHARD_WORKERS:
+        # updates are handled by worker processes, this one only routes them (see shard.py)
+        app.add_handler(TypeHandler(Update, route_update))
+        worker_pool = app.bot_data['worker_pool'] = WorkerPool(SHARD_WORKERS, add_handlers, METRICS_LISTEN, METRICS_PORT)
+        worker_pool.start()
+        app.job_queue.run_repeating(worker_pool.supervise, interval=10)
+    else:
+        add_handlers(app)
+
+    # every replica heartbeats, only the elected leader runs the scrape and analytics jobs (see leader.py)
+    app.job_queue.run_repeating(leader_heartbeat, interval=LEADER_HEARTBEAT_INTERVAL, first=0)
+    app.job_queue.run_repeating(keyspace_snapshot_job, interval=KEYSPACE_ANALYTICS_INTERVAL)
 
     if not STOP_TWITTER_SCRAPE:
+        from tweet import check_for_new_tweets, flush_digests, send_tweets
+
         app.job_queue.run_repeating(check_for_new_tweets, interval=SCRAPE_INTERVAL)
         app.job_queue.run_repeating(send_tweets, interval=SENT_INTERVAL)
-
-    logger.info("Bot is ready to accept connections")
-    app.run_polling()
+        app.job_queue.run_repeating(flush_digests, interval=SENT_INTERVAL)
+
+    logger.info(f"Bot is ready to accept connections ({BOT_MODE})")
+    if BOT_MODE == 'webhook':
+        from webhook import run_webhook
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 
 if __name__ == '__main__':
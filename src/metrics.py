@@ -0,0 +1,280 @@
+"""
+metrics.py
+
+In-process metrics, exposed in the Prometheus text format on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics.
+
+The server is started from main.py when METRICS_PORT is set, and by every shard worker process on a port of its own
+(see shard.py). This module must not import core (core wraps the Redis client with it), gauges that need Redis import
+it lazily when they are collected.
+"""
+
+import bisect
+import time
+from abc import ABC, abstractmethod
+from functools import wraps
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+from aiohttp import web
+from telegram.request import HTTPXRequest
+
+from tracing import span
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+WATCHED_ACCOUNTS_MAX_AGE = 5 * 60
+
+_registry: list['Metric'] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    @abstractmethod
+    async def collect(self) -> list[str]:
+        ...
+
+    async def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(await self.collect())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    async def collect(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    """
+    A gauge is either updated in place (set/inc/dec), or computed by `function` on scrapes, at most once every
+    `max_age` seconds (0: on every scrape).
+    """
+    type = "gauge"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            function: Callable[[], Awaitable[float]] | None = None,
+            max_age: float = 0
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._function = function
+        self._max_age = max_age
+        self._computed_at: float | None = None
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    async def collect(self) -> list[str]:
+        now = time.monotonic()
+        if self._function is not None and (self._computed_at is None or now - self._computed_at >= self._max_age):
+            try:
+                self._values[()] = await self._function()
+                self._computed_at = now
+            except Exception:
+                # a failing gauge shouldn't take the whole scrape down, just leave it out
+                return []
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label set: [count per bucket..., +Inf count], sum
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    def time(self, **labels) -> 'Timer':
+        return Timer(self, labels)
+
+    def total_count(self) -> int:
+        """Number of observations across all label sets."""
+        return sum(sum(counts) for counts, _ in self._values.values())
+
+    async def collect(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else str(bound)
+                labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Timer:
+    """Observe the elapsed time of a `with` block on a histogram."""
+
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> 'Timer':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+async def _tweet_queue_depth() -> float:
+    from core import redis_client
+    return await redis_client.llen("tweets:urls:queue")
+
+
+async def _watched_accounts() -> float:
+    from core import redis_client
+    return len([key async for key in redis_client.scan_iter("tweets:targets:user:*", count=1000)])
+
+
+LLM_TIME_TO_FIRST_TOKEN = Histogram("bot_llm_time_to_first_token_seconds", "Time until the first streamed token of an LLM response", ("model", "endpoint"))
+LLM_TOKENS_PER_SECOND = Histogram("bot_llm_tokens_per_second", "Completion tokens per second of LLM responses", ("model", "endpoint"), buckets=RATE_BUCKETS)
+LLM_REQUEST_DURATION = Histogram("bot_llm_request_duration_seconds", "Total duration of LLM requests", ("model", "endpoint"))
+LLM_REQUEST_ERRORS = Counter("bot_llm_request_errors_total", "Failed LLM requests", ("model", "endpoint"))
+TELEGRAM_REQUEST_DURATION = Histogram("bot_telegram_request_duration_seconds", "Duration of Telegram Bot API calls", ("method",))
+TELEGRAM_RATE_LIMITED = Counter("bot_telegram_rate_limited_total", "Telegram Bot API calls answered with 429", ("method",))
+REDIS_COMMAND_DURATION = Histogram("bot_redis_command_duration_seconds", "Duration of Redis commands", ("command",), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1))
+HANDLER_DURATION = Histogram("bot_handler_duration_seconds", "Duration of message handlers and deliveries", ("handler",))
+SHARD_UPDATES_ROUTED = Counter("bot_shard_updates_routed_total", "Updates routed to shard workers", ("shard",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handlers and deliveries that raised", ("handler",))
+TRANSLATIONS_IN_FLIGHT = Gauge("bot_translations_in_flight", "Translation requests currently waiting on the LLM")
+TRANSLATIONS_SKIPPED = Counter("bot_translations_skipped_total", "Translations skipped because the text needs none", ("source", "reason"))
+TWEET_QUEUE_DEPTH = Gauge("bot_tweet_queue_depth", "Length of tweets:urls:queue", function=_tweet_queue_depth)
+# counted with a SCAN over the whole keyspace, so only every few minutes
+WATCHED_ACCOUNTS = Gauge("bot_watched_twitter_accounts", "Number of Twitter accounts with at least one subscriber", function=_watched_accounts, max_age=WATCHED_ACCOUNTS_MAX_AGE)
+
+
+def endpoint_label(openai_api_endpoint: str | None) -> str:
+    """Reduce an API base URL to its host, to keep label cardinality low."""
+    return urlparse(openai_api_endpoint or "https://api.openai.com/v1").netloc
+
+
+class LLMRequestTracker:
+    """
+    Records latency metrics of one LLM request. Call `token()` for each streamed chunk with content and
+    `finish()` once the response is complete, passing the exact completion token count when the API reports it.
+    """
+
+    def __init__(self, model: str | None, openai_api_endpoint: str | None):
+        self.labels = {"model": model or "", "endpoint": endpoint_label(openai_api_endpoint)}
+        self.start = time.perf_counter()
+        self.first_token_at: float | None = None
+        self.tokens = 0
+
+    def token(self, count: int = 1) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            LLM_TIME_TO_FIRST_TOKEN.observe(self.first_token_at - self.start, **self.labels)
+        self.tokens += count
+
+    def finish(self, completion_tokens: int | None = None) -> None:
+        end = time.perf_counter()
+        LLM_REQUEST_DURATION.observe(end - self.start, **self.labels)
+
+        tokens = completion_tokens if completion_tokens is not None else self.tokens
+        generation_start = self.first_token_at or self.start
+        if tokens and end > generation_start:
+            LLM_TOKENS_PER_SECOND.observe(tokens / (end - generation_start), **self.labels)
+
+    def fail(self) -> None:
+        LLM_REQUEST_ERRORS.inc(**self.labels)
+
+
+def timed(handler: str):
+    """Decorator recording the duration (and failures) of a coroutine function under `handler`."""
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with HANDLER_DURATION.time(handler=handler):
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    HANDLER_ERRORS.inc(handler=handler)
+                    raise
+        return wrapper
+    return decorator
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records (and traces) Bot API call latency and 429 responses per method."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        with TELEGRAM_REQUEST_DURATION.time(method=api_method), span(f"telegram.{api_method}") as request_span:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        request_span.set_attribute("status", code)
+        if code == 429:
+            TELEGRAM_RATE_LIMITED.inc(method=api_method)
+        return code, payload
+
+
+async def render() -> str:
+    return "\n".join([await metric.render() for metric in _registry]) + "\n"
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=await render(), content_type="text/plain", charset="utf-8")
+
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
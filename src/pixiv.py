@@ -1,3 +1,12 @@
+"""
+pixiv.py
+
+Sending Pixiv novels, published to telegraph and translated in one of three modes (streaming, direct or telegraph).
+
+Redis key structure:
+- pixiv:glossary:{novel_id} -> JSON object, {term: translation}  # Names and terms of a novel, expires after PIXIV_GLOSSARY_TTL seconds (empty ones after PIXIV_EMPTY_GLOSSARY_TTL)
+"""
+
 import json
 import os
 import re
@@ -7,13 +16,22 @@ from telegram.ext import ContextTypes
 from telegraph.aio import Telegraph
 
 from core import logger, redis_client
-from llm_translate import translate_text_by_page, translate_text, translate_text_stream
+from lang import needs_translation
+from llm_translate import extract_glossary, translate_text_by_page, translate_text, translate_text_stream
+from metrics import timed
+from pixiv_jobs import ChunkCheckpoints, coalesced_job, complete_request, credentials_fingerprint, track_request
+from tracing import traced
+from usage import quota_exceeded
 from utils import split_content_by_delimiter, get_redis_value
 
 telegraph = Telegraph()
 
 PIXIV_NOVEL_URL_REGEX = re.compile(r"https://www.pixiv.net/novel/show.php\?id=(\d+).*")
 
+PIXIV_GLOSSARY_TTL = int(os.getenv('PIXIV_GLOSSARY_TTL', 30 * 24 * 60 * 60))
+# an empty glossary is as likely an unparsable reply as a novel without names, it's extracted again sooner
+PIXIV_EMPTY_GLOSSARY_TTL = int(os.getenv('PIXIV_EMPTY_GLOSSARY_TTL', 60 * 60))
+
 PIXIV_COOKIE = os.getenv('PIXIV_COOKIE')
 if not PIXIV_COOKIE:
     raise ValueError("PIXIV_COOKIE environment variable not set")
@@ -43,13 +61,22 @@ HEADERS = {
 }
 
 
+class NovelUnavailable(Exception):
+    """The novel was deleted or made private, asking again won't help."""
+
+
 async def get_novel(novel_id: str) -> dict:
     async with httpx.AsyncClient() as client:
         response = await client.get(
             f"https://www.pixiv.net/ajax/novel/{novel_id}", headers=HEADERS
         )
 
-        return json.loads(response.text)['body']
+        if response.status_code in (403, 404):
+            raise NovelUnavailable(f"Pixiv novel {novel_id} is unavailable: {response.status_code}")
+        result = json.loads(response.text)
+        if result.get('error') and response.status_code < 500:
+            raise NovelUnavailable(f"Pixiv novel {novel_id} is unavailable: {result.get('message')}")
+        return result['body']
 
 
 async def send_to_telegraph(title: str, content: str, author_name: str, author_url: str) -> list[str]:
@@ -75,6 +102,60 @@ async def send_to_telegraph(title: str, content: str, author_name: str, author_u
     return [page['url'] for page in pages]
 
 
+def split_batches(content: str, separator: str) -> list[str]:
+    """Group the paragraphs of a novel into batches of about 800 characters."""
+    batches = []
+    current_batch = ""
+    for paragraph in content.split("\n"):
+        if len(current_batch) + len(paragraph) <= 800:
+            current_batch += paragraph + separator
+        else:
+            if current_batch.strip():
+                batches.append(current_batch)
+            current_batch = paragraph + separator
+
+    if current_batch.strip():
+        batches.append(current_batch)
+    return batches
+
+
+async def translation_settings(context: ContextTypes.DEFAULT_TYPE, user_id: int, chat_id: int, message_id: int) -> tuple[str, str, str] | None:
+    """(api key, endpoint, model) if the user wants pixiv novels translated and has tokens left, otherwise None."""
+    openai_api_key = await get_redis_value(f'user:{user_id}:openai_api_key')
+    openai_api_endpoint = await get_redis_value(f'user:{user_id}:openai_api_endpoint')
+    openai_model = await get_redis_value(f'user:{user_id}:openai_model')
+    pixiv_translation = (await get_redis_value(f'user:{user_id}:pixiv_translation', 'false')).lower() == 'true'
+
+    if not openai_api_key or not pixiv_translation:
+        return None
+
+    if quota_message := await quota_exceeded(user_id):
+        await context.bot.send_message(chat_id=chat_id, text=quota_message, reply_to_message_id=message_id)
+        return None
+
+    return openai_api_key, openai_api_endpoint, openai_model
+
+
+async def novel_glossary(novel_id: str, content: str, openai_api_key: str, openai_api_endpoint: str, openai_model: str, user_id: int) -> dict[str, str]:
+    """The glossary of a novel, extracted once and shared by the chunks translated in parallel (and later requests)."""
+    cache_key = f"pixiv:glossary:{novel_id}"
+    cached = await redis_client.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+
+    try:
+        glossary = await extract_glossary(content, openai_api_key, openai_api_endpoint, openai_model, user_id)
+    except Exception as e:
+        # chunks are still translated without one, only less consistently
+        logger.warning(f"Failed to extract glossary of pixiv novel {novel_id}: {e!r}")
+        return {}
+
+    await redis_client.set(cache_key, json.dumps(glossary, ensure_ascii=False), ex=PIXIV_GLOSSARY_TTL if glossary else PIXIV_EMPTY_GLOSSARY_TTL)
+    return glossary
+
+
+@traced("send_pixiv_novel_direct")
+@timed("send_pixiv_novel_direct")
 async def send_pixiv_novel_direct(
     url: str,
     context: ContextTypes.DEFAULT_TYPE,
@@ -90,59 +171,42 @@ async def send_pixiv_novel_direct(
     novel_id = match.group(1)
     novel = await get_novel(novel_id)
 
-    openai_api_key = await get_redis_value(f'user:{user_id}:openai_api_key')
-    openai_api_endpoint = await get_redis_value(f'user:{user_id}:openai_api_endpoint')
-    openai_model = await get_redis_value(f'user:{user_id}:openai_model')
-    pixiv_translation = (await get_redis_value(f'user:{user_id}:pixiv_translation', 'false')).lower() == 'true'
-
-    if not openai_api_key or not pixiv_translation:
+    settings = await translation_settings(context, user_id, chat_id, message_id)
+    if not settings:
         return
-
-    # Split content into paragraphs
-    paragraphs = novel["content"].split("\n")
-    current_batch = ""
-    translated_content = []
-    message_context = []
-
-    for paragraph in paragraphs:
-        if len(current_batch) + len(paragraph) <= 800:
-            current_batch += paragraph + "\n"
-        else:
-            if current_batch.strip():
-                # Translate current batch
+    openai_api_key, openai_api_endpoint, openai_model = settings
+    credentials = credentials_fingerprint(openai_api_key, openai_api_endpoint)
+
+    async def produce(emit):
+        batches = split_batches(novel["content"], "\n")
+        glossary = {}
+        if len(batches) > 1:
+            glossary = await novel_glossary(novel_id, novel["content"], openai_api_key, openai_api_endpoint, openai_model, user_id)
+
+        checkpoints = ChunkCheckpoints(novel_id, openai_model, credentials)
+        for batch in batches:
+            translated = await checkpoints.get(batch)
+            if translated is None:
                 translated = await translate_text(
-                    current_batch,
+                    batch,
                     openai_api_key=openai_api_key,
                     openai_api_endpoint=openai_api_endpoint,
-                    openai_model=openai_model
-                )
-
-                # Send translated batch to user
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"<b>[{novel_id}] {novel['title']}</b>\n{translated.strip(" \n")}",
-                    reply_to_message_id=message_id,
-                    parse_mode="HTML"
+                    openai_model=openai_model,
+                    user_id=user_id,
+                    glossary=glossary,
+                    raise_on_failure=True
                 )
+                await checkpoints.set(batch, translated)
+            await emit(translated)
 
-                # Add to context for next batch
-                message_context.append(translated)
-                translated_content.append(translated)
-
-            current_batch = paragraph + "\n"
-
-    # Handle the last batch
-    if current_batch.strip():
-        translated = await translate_text(
-            current_batch,
-            openai_api_key=openai_api_key,
-            openai_api_endpoint=openai_api_endpoint,
-            openai_model=openai_model
-        )
+    translated_content = []
 
+    # users asking for the same novel with the same model and API key at the same time share one translation
+    async for translated in coalesced_job(novel_id, openai_model, credentials, "direct", produce):
+        # Send translated batch to user
         await context.bot.send_message(
             chat_id=chat_id,
-            text=f"<b>[{novel_id}] {novel['title']}</b>\n\n{translated}",
+            text=f"<b>[{novel_id}] {novel['title']}</b>\n{translated.strip(" \n")}",
             reply_to_message_id=message_id,
             parse_mode="HTML"
         )
@@ -152,6 +216,8 @@ async def send_pixiv_novel_direct(
     return "\n".join(translated_content)
 
 
+@traced("send_pixiv_novel_streaming")
+@timed("send_pixiv_novel_streaming")
 async def send_pixiv_novel_streaming(
     url: str,
     context: ContextTypes.DEFAULT_TYPE,
@@ -167,20 +233,11 @@ async def send_pixiv_novel_streaming(
     novel_id = match.group(1)
     novel = await get_novel(novel_id)
 
-    openai_api_key = await get_redis_value(f'user:{user_id}:openai_api_key')
-    openai_api_endpoint = await get_redis_value(f'user:{user_id}:openai_api_endpoint')
-    openai_model = await get_redis_value(f'user:{user_id}:openai_model')
-    pixiv_translation = (await get_redis_value(f'user:{user_id}:pixiv_translation', 'false')).lower() == 'true'
-
-    if not openai_api_key or not pixiv_translation:
+    settings = await translation_settings(context, user_id, chat_id, message_id)
+    if not settings:
         return
-
-    # Split content into paragraphs
-    paragraphs = novel["content"].split("\n")
-    current_batch = ""
-    translated_content = []
-    message_context = []
-    translated_context = []
+    openai_api_key, openai_api_endpoint, openai_model = settings
+    credentials = credentials_fingerprint(openai_api_key, openai_api_endpoint)
 
     # Initialize message objects for streaming
     current_reply_obj = None
@@ -255,50 +312,42 @@ async def send_pixiv_novel_streaming(
                 logger.error(f"Failed to update reply message: {str(e)}", exc_info=True)
                 raise
 
-    for paragraph in paragraphs:
-        if len(current_batch) + len(paragraph) <= 800:
-            current_batch += paragraph + "\n\n"
-        else:
-            if current_batch.strip():
-                # Add current batch to message context
-                message_context.append(current_batch)
+    async def produce(emit):
+        message_context = []
+        translated_context = []
+        checkpoints = ChunkCheckpoints(novel_id, openai_model, credentials)
 
-                # Translate current batch using streaming with context
-                translated = await translate_text_stream(
-                    current_batch,
-                    openai_api_key=openai_api_key,
-                    openai_api_endpoint=openai_api_endpoint,
-                    openai_model=openai_model,
-                    callback=update_reply_msg_to_user,
-                    message_context=message_context[:-1],  # Exclude current batch
-                    translated_context=translated_context
-                )
+        for batch in split_batches(novel["content"], "\n\n"):
+            # Add current batch to message context
+            message_context.append(batch)
 
-                # Add to translated context
+            # Batches translated by an earlier, interrupted attempt are sent at once
+            translated = await checkpoints.get(batch)
+            if translated is not None:
+                await emit(translated)
                 translated_context.append(translated)
-                translated_content.append(translated)
-
-            current_batch = paragraph + "\n\n"
+                continue
+
+            # Translate current batch with context, it is passed on once the whole batch is translated
+            translated = await translate_text_stream(
+                batch,
+                openai_api_key=openai_api_key,
+                openai_api_endpoint=openai_api_endpoint,
+                openai_model=openai_model,
+                callback=emit,
+                message_context=message_context[:-1],  # Exclude current batch
+                translated_context=translated_context,
+                user_id=user_id,
+                raise_on_failure=True
+            )
+            await checkpoints.set(batch, translated)
 
-    # Handle the last batch
-    if current_batch.strip():
-        # Add current batch to message context
-        message_context.append(current_batch)
-
-        # Translate last batch using streaming with context
-        translated = await translate_text_stream(
-            current_batch,
-            openai_api_key=openai_api_key,
-            openai_api_endpoint=openai_api_endpoint,
-            openai_model=openai_model,
-            callback=update_reply_msg_to_user,
-            message_context=message_context[:-1],  # Exclude current batch
-            translated_context=translated_context
-        )
+            # Add to translated context
+            translated_context.append(translated)
 
-        # Add to translated context
-        translated_context.append(translated)
-        translated_content.append(translated)
+    # users asking for the same novel with the same model and API key at the same time follow one translation stream
+    async for fragment in coalesced_job(novel_id, openai_model, credentials, "streaming", produce):
+        await update_reply_msg_to_user(fragment)
 
     # Send any remaining content
     if reply_msg and reply_msg_last_sent_end_pos < len(reply_msg):
@@ -317,9 +366,11 @@ async def send_pixiv_novel_streaming(
             )
         replies.append(current_reply_obj)
 
-    return "\n".join(translated_content)
+    return reply_msg
 
 
+@traced("send_pixiv_novel")
+@timed("send_pixiv_novel")
 async def send_pixiv_novel(
     url: str,
     context: ContextTypes.DEFAULT_TYPE,
@@ -333,15 +384,37 @@ async def send_pixiv_novel(
         return
 
     novel_id = match.group(1)
+
+    # recorded until it completes, so /resume_pixiv can pick it up after a failure or a restart
+    await track_request(user_id, novel_id, url, chat_id, message_id)
+    try:
+        await _send_pixiv_novel(url, novel_id, context, user_id, chat_id, message_id)
+    except NovelUnavailable:
+        await complete_request(user_id, novel_id)
+        raise
+    await complete_request(user_id, novel_id)
+
+
+async def _send_pixiv_novel(
+    url: str,
+    novel_id: str,
+    context: ContextTypes.DEFAULT_TYPE,
+    user_id: int,
+    chat_id: int,
+    message_id: int
+):
     novel = await get_novel(novel_id)
 
     streaming_translation = (await get_redis_value(f'user:{user_id}:pixiv_streaming_translation', 'true')).lower() == 'true'
     direct_translation = (await get_redis_value(f'user:{user_id}:pixiv_direct_translation', 'true')).lower() == 'true'
 
-    if streaming_translation:
+    # novels already written in Simplified Chinese are only published to telegraph
+    translation_needed = await needs_translation(novel['content'], user_id, 'pixiv')
+
+    if streaming_translation and translation_needed:
         await send_pixiv_novel_streaming(url, context, user_id, chat_id, message_id)
         return
-    elif direct_translation:
+    elif direct_translation and translation_needed:
         await send_pixiv_novel_direct(url, context, user_id, chat_id, message_id)
         return
 
@@ -355,27 +428,38 @@ async def send_pixiv_novel(
     for page_url in page_urls:
         await context.bot.send_message(chat_id=user_id, text=page_url, reply_to_message_id=message_id)
 
-    openai_api_key = await get_redis_value(f'user:{user_id}:openai_api_key')
-    openai_api_endpoint = await get_redis_value(f'user:{user_id}:openai_api_endpoint')
-    openai_model = await get_redis_value(f'user:{user_id}:openai_model')
-    pixiv_translation = (await get_redis_value(f'user:{user_id}:pixiv_translation', 'false')).lower() == 'true'
-
-    if not openai_api_key or not pixiv_translation:
+    if not translation_needed:
         return
 
-    translated_content = await translate_text_by_page(
-        novel["content"],
-        openai_api_key,
-        openai_api_endpoint,
-        openai_model
-    )
+    settings = await translation_settings(context, user_id, chat_id, message_id)
+    if not settings:
+        return
+    openai_api_key, openai_api_endpoint, openai_model = settings
+    credentials = credentials_fingerprint(openai_api_key, openai_api_endpoint)
+
+    async def produce(emit):
+        glossary = {}
+        if len(split_batches(novel["content"], "\n")) > 1:
+            glossary = await novel_glossary(novel_id, novel["content"], openai_api_key, openai_api_endpoint, openai_model, user_id)
+        translated_content = await translate_text_by_page(
+            novel["content"],
+            openai_api_key,
+            openai_api_endpoint,
+            openai_model,
+            user_id,
+            glossary,
+            ChunkCheckpoints(novel_id, openai_model, credentials)
+        )
 
-    page_urls = await send_to_telegraph(
-        title=f"[{novel_id}-translated] {novel['title']}",
-        content=translated_content,
-        author_name=novel['userName'],
-        author_url=f"https://www.pixiv.net/users/{novel['userId']}"
-    )
+        page_urls = await send_to_telegraph(
+            title=f"[{novel_id}-translated] {novel['title']}",
+            content=translated_content,
+            author_name=novel['userName'],
+            author_url=f"https://www.pixiv.net/users/{novel['userId']}"
+        )
+        for page_url in page_urls:
+            await emit(page_url)
 
-    for page_url in page_urls:
+    # the translated pages are published once and shared with everyone asking for them meanwhile
+    async for page_url in coalesced_job(novel_id, openai_model, credentials, "telegraph", produce):
         await context.bot.send_message(chat_id=chat_id, text=page_url, reply_to_message_id=message_id)
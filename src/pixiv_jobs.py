@@ -0,0 +1,214 @@
+"""
+pixiv_jobs.py
+
+Coalescing of Pixiv novel translation jobs, keyed by (novel_id, model, credentials, mode). Only requesters using the
+same API endpoint and key share a job, its output and checkpoints, so no one's output is generated with (and billed
+to) someone else's key.
+
+A job's output is a list of events (streamed fragments, translated batches or published page URLs, depending on
+the mode). The first requester starts the job, everyone asking for the same key while it runs attaches to it:
+
+- in process, requesters follow the job's events live (replaying what was emitted before they joined)
+- across replicas, a Redis lock marks the job as running, and requesters on other replicas wait for its result
+- a finished job's events are kept for a while, so requests shortly after it completed are answered right away
+
+Jobs checkpoint every translated chunk, so a job that failed halfway (or was cut short by a restart) continues
+where it stopped the next time the novel is requested. Requests are recorded until they complete, those left over
+by a failure or restart are resumed with /resume_pixiv, which gives up on a request after PIXIV_REQUEST_MAX_ATTEMPTS.
+
+Redis key structure:
+- pixiv:jobs:lock:{novel_id}:{model}:{credentials}:{mode} -> instance id  # Held while the job runs, renewed until it ends
+- pixiv:jobs:result:{novel_id}:{model}:{credentials}:{mode} -> JSON list of events  # Expires after PIXIV_JOB_RESULT_TTL seconds
+- pixiv:chunks:{novel_id}:{model}:{credentials}:{chunk_digest} -> translated chunk  # Expires after PIXIV_CHECKPOINT_TTL seconds
+
+{credentials} is `credentials_fingerprint` of the requester's API endpoint and key.
+- pixiv:jobs:requests:{user_id} -> hash, {novel_id} -> JSON request (url, chat_id, message_id, attempts)  # Requests not completed yet, expires PIXIV_REQUEST_TTL seconds after the last one
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from typing import AsyncIterator, Awaitable, Callable
+
+from core import logger, redis_client
+from leader import INSTANCE_ID
+
+PIXIV_JOB_RESULT_TTL = int(os.getenv('PIXIV_JOB_RESULT_TTL', 60 * 60))
+PIXIV_CHECKPOINT_TTL = int(os.getenv('PIXIV_CHECKPOINT_TTL', 7 * 24 * 60 * 60))
+# past the checkpoints' lifetime a resumed request starts from scratch anyway
+PIXIV_REQUEST_TTL = PIXIV_CHECKPOINT_TTL
+PIXIV_REQUEST_MAX_ATTEMPTS = int(os.getenv('PIXIV_REQUEST_MAX_ATTEMPTS', 3))
+JOB_LOCK_TTL = 60
+JOB_LOCK_RENEW_INTERVAL = 20
+JOB_POLL_INTERVAL = 2
+
+# KEYS[1] = lock; ARGV[1] = instance id, ARGV[2] = ttl (s); renews (or releases, with ttl 0) a lock we hold
+RENEW_OR_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+else
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+_renew_or_release = redis_client.register_script(RENEW_OR_RELEASE_SCRIPT)
+
+
+class Job:
+    """Events of a running job, shared by everyone following it."""
+
+    def __init__(self):
+        self.events: list = []
+        self.done = False
+        self.error: BaseException | None = None
+        self._changed = asyncio.Condition()
+
+    async def emit(self, event) -> None:
+        self.events.append(event)
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def finish(self, error: BaseException | None = None) -> None:
+        self.done = True
+        self.error = error
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def follow(self) -> AsyncIterator:
+        position = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(lambda: position < len(self.events) or self.done)
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise RuntimeError("Coalesced translation job failed") from self.error
+                return
+
+
+_jobs: dict[str, Job] = {}
+# the loop only keeps weak references to tasks, running jobs are kept here until they finish
+_job_tasks: set[asyncio.Task] = set()
+
+
+async def _run(key: str, job: Job, produce: Callable[[Callable[..., Awaitable[None]]], Awaitable[None]]) -> None:
+    lock_key = f"pixiv:jobs:lock:{key}"
+
+    async def renew_lock():
+        while True:
+            await asyncio.sleep(JOB_LOCK_RENEW_INTERVAL)
+            try:
+                await _renew_or_release(keys=[lock_key], args=[INSTANCE_ID, JOB_LOCK_TTL])
+            except Exception as e:
+                # keep trying, the lock only expires after JOB_LOCK_TTL
+                logger.warning(f"Failed to renew the lock of pixiv job {key}: {e}")
+
+    renewer = asyncio.create_task(renew_lock())
+    try:
+        await produce(job.emit)
+        await redis_client.set(f"pixiv:jobs:result:{key}", json.dumps(job.events, ensure_ascii=False), ex=PIXIV_JOB_RESULT_TTL)
+        await job.finish()
+    except Exception as e:
+        logger.error(f"Pixiv job {key} failed: {e}", exc_info=True)
+        await job.finish(e)
+    finally:
+        renewer.cancel()
+        del _jobs[key]
+        if not job.done:
+            # cancelled (e.g. at shutdown), followers in this process must not wait forever
+            await job.finish(asyncio.CancelledError())
+        await _renew_or_release(keys=[lock_key], args=[INSTANCE_ID, 0])
+
+
+def credentials_fingerprint(openai_api_key: str, openai_api_endpoint: str | None) -> str:
+    return hashlib.sha256(f"{openai_api_endpoint or ''}\n{openai_api_key}".encode()).hexdigest()[:16]
+
+
+async def coalesced_job(
+        novel_id: str,
+        model: str,
+        credentials: str,
+        mode: str,
+        produce: Callable[[Callable[..., Awaitable[None]]], Awaitable[None]]
+) -> AsyncIterator:
+    """
+    Yield the events of the job (novel_id, model, credentials, mode). `produce(emit)` runs the job, awaiting
+    `emit(event)` for every piece of output, and is only called if no one else is running (or recently finished) the
+    same job.
+    """
+    key = f"{novel_id}:{model}:{credentials}:{mode}"
+
+    while True:
+        if key in _jobs:
+            logger.info(f"Attaching to running pixiv job {key}")
+            async for event in _jobs[key].follow():
+                yield event
+            return
+
+        result = await redis_client.get(f"pixiv:jobs:result:{key}")
+        if result is not None:
+            logger.info(f"Serving pixiv job {key} from its result")
+            for event in json.loads(result):
+                yield event
+            return
+
+        if await redis_client.set(f"pixiv:jobs:lock:{key}", INSTANCE_ID, nx=True, ex=JOB_LOCK_TTL):
+            job = _jobs[key] = Job()
+            # the job runs on its own, so it isn't cut short if the first requester goes away
+            task = asyncio.create_task(_run(key, job, produce))
+            _job_tasks.add(task)
+            task.add_done_callback(_job_tasks.discard)
+            continue
+
+        # another replica runs it, wait for its result, or for the lock to free up if it fails
+        while await redis_client.exists(f"pixiv:jobs:lock:{key}") and key not in _jobs:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+class ChunkCheckpoints:
+    """Translated chunks of a novel with one model and credentials, keyed by the chunk's content."""
+
+    def __init__(self, novel_id: str, model: str, credentials: str):
+        self.novel_id = novel_id
+        self.model = model
+        self.credentials = credentials
+
+    def key(self, chunk: str) -> str:
+        return f"pixiv:chunks:{self.novel_id}:{self.model}:{self.credentials}:{hashlib.sha1(chunk.encode()).hexdigest()}"
+
+    async def get(self, chunk: str) -> str | None:
+        return await redis_client.get(self.key(chunk))
+
+    async def set(self, chunk: str, translated: str) -> None:
+        await redis_client.set(self.key(chunk), translated, ex=PIXIV_CHECKPOINT_TTL)
+
+
+async def track_request(user_id: int, novel_id: str, url: str, chat_id: int, message_id: int) -> int:
+    """Record a request until it completes, returns how many times it has been attempted."""
+    key = f"pixiv:jobs:requests:{user_id}"
+    previous = await redis_client.hget(key, novel_id)
+    attempts = json.loads(previous).get("attempts", 1) + 1 if previous else 1
+
+    request = {"url": url, "chat_id": chat_id, "message_id": message_id, "attempts": attempts}
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(key, novel_id, json.dumps(request))
+        pipe.expire(key, PIXIV_REQUEST_TTL)
+        await pipe.execute()
+    return attempts
+
+
+async def complete_request(user_id: int, novel_id: str) -> None:
+    await redis_client.hdel(f"pixiv:jobs:requests:{user_id}", novel_id)
+
+
+async def unfinished_requests(user_id: int) -> dict[str, dict]:
+    """{novel_id: request} of the user's requests that didn't complete, including those still running."""
+    requests = await redis_client.hgetall(f"pixiv:jobs:requests:{user_id}")
+    return {novel_id: json.loads(request) for novel_id, request in requests.items()}
@@ -0,0 +1,194 @@
+"""
+redis_browser.py
+
+Paginated, cursor based views of the keyspace for the admin commands (/list_redis, /get_redis).
+
+Nothing here loads a whole keyspace or a whole collection: keys are listed with SCAN, collections are read with
+LRANGE windows / SSCAN / HSCAN / ZSCAN, and TYPE / TTL / MEMORY USAGE of a page are fetched in one pipeline.
+Every page carries an inline "Next" button whose callback data holds the cursor:
+
+- rl|{cursor}|{rest}|{pattern} -> next page of keys matching pattern
+- rg|{cursor}|{rest}|{key} -> next page of a key's values
+
+A SCAN round can return more than fits in one message, the lines that didn't fit are carried over to the next page
+as {rest} (empty if there are none), which shows them before it scans on from {cursor}.
+
+Callback data is limited to 64 bytes, longer patterns / keys and the carried lines are stored under
+admin:redis_browser:{digest} -> pattern, key or JSON list of lines (expires after a day) and referenced as #{digest}.
+"""
+
+import hashlib
+import json
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from core import redis_client
+
+PAGE_SIZE = 20
+VALUE_MAX_LENGTH = 200
+MESSAGE_MAX_LENGTH = 4000
+SCAN_MAX_ROUNDS = 100
+CALLBACK_DATA_MAX_BYTES = 64
+REFERENCE_TTL = 24 * 60 * 60
+
+
+def truncate(value: str, max_length: int = VALUE_MAX_LENGTH) -> str:
+    value = str(value)
+    if len(value) <= max_length:
+        return value
+    return f"{value[:max_length]}… (+{len(value) - max_length} chars)"
+
+
+def format_bytes(size: int | None) -> str:
+    if size is None:
+        return "?"
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def format_ttl(ttl: int) -> str:
+    return "no ttl" if ttl < 0 else f"ttl {ttl}s"
+
+
+async def store_reference(value: str) -> str:
+    digest = hashlib.sha1(value.encode()).hexdigest()[:16]
+    await redis_client.set(f"admin:redis_browser:{digest}", value, ex=REFERENCE_TTL)
+    return f"#{digest}"
+
+
+async def callback_data(action: str, cursor: int, rest: list[str], target: str) -> str:
+    rest = await store_reference(json.dumps(rest, ensure_ascii=False)) if rest else ""
+    data = f"{action}|{cursor}|{rest}|{target}"
+    if len(data.encode()) <= CALLBACK_DATA_MAX_BYTES:
+        return data
+    return f"{action}|{cursor}|{rest}|{await store_reference(target)}"
+
+
+async def parse_callback_data(data: str) -> tuple[str, int, list[str], str | None]:
+    """
+    Returns (action, cursor, carried lines, pattern or key), the latter is None if a stored reference expired.
+    """
+    parts = data.split("|", 3)
+    if len(parts) < 4:
+        # a button of the old format, without carried lines
+        return parts[0], 0, [], None
+    action, cursor, rest, target = parts
+    if target.startswith("#"):
+        target = await redis_client.get(f"admin:redis_browser:{target[1:]}")
+
+    lines = []
+    if rest:
+        stored = await redis_client.get(f"admin:redis_browser:{rest[1:]}")
+        if stored is None:
+            return action, int(cursor), [], None
+        lines = json.loads(stored)
+    return action, int(cursor), lines, target
+
+
+async def next_page_markup(action: str, cursor: int, rest: list[str], target: str) -> InlineKeyboardMarkup | None:
+    if not cursor and not rest:
+        return None
+    data = await callback_data(action, cursor, rest, target)
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Next ▶", callback_data=data)]])
+
+
+def fill_page(message: str, lines: list[str]) -> tuple[str, list[str]]:
+    """Add as many lines as fit in one message, returns the message and the lines left for the next page."""
+    for i, line in enumerate(lines):
+        if len(message) + len(line) + 1 > MESSAGE_MAX_LENGTH:
+            return message + "…\n", lines[i:]
+        message += line + "\n"
+    return message, []
+
+
+async def scan_keys(pattern: str, cursor: int = 0) -> tuple[int, list[str]]:
+    """
+    Collect about PAGE_SIZE keys matching pattern starting at cursor. Sparse patterns may take several SCAN
+    rounds, which are capped so one page never walks the whole keyspace.
+    """
+    keys = []
+    for _ in range(SCAN_MAX_ROUNDS):
+        cursor, batch = await redis_client.scan(cursor, match=pattern, count=PAGE_SIZE)
+        keys.extend(batch)
+        if not cursor or len(keys) >= PAGE_SIZE:
+            break
+    return cursor, keys
+
+
+async def render_key_list(pattern: str, cursor: int = 0, carried: list[str] | None = None) -> tuple[str, InlineKeyboardMarkup | None]:
+    """A page of keys matching pattern. Lines carried over from the previous page are shown before scanning on."""
+    if carried:
+        next_cursor, lines = cursor, carried
+    else:
+        next_cursor, keys = await scan_keys(pattern, cursor)
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.type(key)
+                pipe.ttl(key)
+                pipe.memory_usage(key)
+            results = await pipe.execute(raise_on_error=False)
+
+        lines = []
+        for i, key in enumerate(keys):
+            key_type, ttl, memory = results[i * 3:i * 3 + 3]
+            memory = memory if isinstance(memory, int) else None
+            lines.append(f"• ({key_type}, {format_bytes(memory)}, {format_ttl(ttl)}) {truncate(key, 150)}")
+
+    message = f"Keys matching pattern '{pattern}':\n\n"
+    if not lines:
+        message += "(no keys on this page)\n" if next_cursor else "(no keys found)\n"
+
+    message, rest = fill_page(message, lines)
+    return message, await next_page_markup("rl", next_cursor, rest, pattern)
+
+
+async def render_key_value(key: str, cursor: int = 0, carried: list[str] | None = None) -> tuple[str, InlineKeyboardMarkup | None]:
+    """A page of a key's values. Lines carried over from the previous page are shown before reading on."""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.type(key)
+        pipe.ttl(key)
+        pipe.memory_usage(key)
+        key_type, ttl, memory = await pipe.execute(raise_on_error=False)
+
+    if key_type == "none":
+        return f"Key '{key}' not found", None
+
+    memory = memory if isinstance(memory, int) else None
+    header = f"Key: {key}\nType: {key_type}\nSize: {format_bytes(memory)}, {format_ttl(ttl)}\n"
+    lines = []
+    next_cursor = 0
+
+    if carried:
+        lines, next_cursor = carried, cursor
+    elif key_type == "string":
+        length = await redis_client.strlen(key)
+        value = await redis_client.getrange(key, 0, MESSAGE_MAX_LENGTH // 2)
+        header += f"Length: {length}\n"
+        lines.append(value if length <= len(value) else f"{value}… (+{length - len(value)} chars)")
+    elif key_type == "list":
+        length = await redis_client.llen(key)
+        values = await redis_client.lrange(key, cursor, cursor + PAGE_SIZE - 1)
+        header += f"Length: {length}\n"
+        lines.extend(f"- [{cursor + i}] {truncate(value)}" for i, value in enumerate(values))
+        next_cursor = cursor + PAGE_SIZE if cursor + PAGE_SIZE < length else 0
+    elif key_type == "set":
+        header += f"Members: {await redis_client.scard(key)}\n"
+        next_cursor, values = await redis_client.sscan(key, cursor, count=PAGE_SIZE)
+        lines.extend(f"- {truncate(value)}" for value in values)
+    elif key_type == "hash":
+        header += f"Fields: {await redis_client.hlen(key)}\n"
+        next_cursor, values = await redis_client.hscan(key, cursor, count=PAGE_SIZE)
+        lines.extend(f"- {truncate(field, 100)}: {truncate(value)}" for field, value in values.items())
+    elif key_type == "zset":
+        header += f"Members: {await redis_client.zcard(key)}\n"
+        next_cursor, values = await redis_client.zscan(key, cursor, count=PAGE_SIZE)
+        lines.extend(f"- {truncate(member)} ({score})" for member, score in values)
+    else:
+        lines.append(f"Unsupported type: {key_type}")
+
+    message, rest = fill_page(header + "Value(s):\n", lines)
+    return message, await next_page_markup("rg", next_cursor, rest, key)
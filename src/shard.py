@@ -0,0 +1,236 @@
+"""
+shard.py
+
+Multi-process mode, enabled with SHARD_WORKERS > 0.
+
+The front process (main.py) receives updates, by polling or webhook, and routes each one to one of SHARD_WORKERS
+shards by the crc32 of its chat id, appending it to the shard's Redis Stream. Worker processes, spawned and
+supervised by the front process, handle the updates of one shard each, one at a time and in stream order: updates
+of one chat keep their order, while the chats are spread over all cores. Scheduled jobs (leader heartbeat, tweet
+scraping and delivery, analytics) and the metrics server stay in the front process.
+
+Each shard is consumed by a single worker in the whole deployment: workers hold a lease per shard, like the leader
+lease (see leader.py), and a worker taking over a shard first handles the entries its predecessor read but never
+acknowledged.
+
+Workers log to their own file (LOG_FILE with the shard number added) and, when METRICS_PORT is set, serve the
+metrics of the updates they handle on METRICS_PORT + 1 + shard, while the front process keeps METRICS_PORT.
+
+Redis key structure:
+- bot:updates:{shard} -> stream of {update: JSON}, consumer group "workers"  # Trimmed to about SHARD_STREAM_MAXLEN entries
+- bot:shards:{shard} -> {instance_id}  # Lease of the worker consuming the shard, expires after SHARD_LEASE_TTL seconds unless renewed
+- bot:shards:{shard}:token -> int  # Incremented every time the lease changes hands
+"""
+
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import zlib
+from typing import Callable
+
+import redis.asyncio as redis
+from telegram import Update
+from telegram.ext import Application, ApplicationBuilder, CallbackContext
+
+from core import logger, redis_client, set_log_file, LOG_FILE
+from leader import ACQUIRE_OR_RENEW_SCRIPT, INSTANCE_ID, RELEASE_SCRIPT
+from metrics import InstrumentedRequest, SHARD_UPDATES_ROUTED, start_metrics_server
+
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', 0))
+SHARD_STREAM_MAXLEN = int(os.getenv('SHARD_STREAM_MAXLEN', 10000))
+SHARD_LEASE_TTL = 30
+SHARD_LEASE_RENEW_INTERVAL = 10
+# seconds a worker blocks waiting for new entries, well below the lease ttl
+SHARD_READ_BLOCK = 5
+SHARD_READ_COUNT = 10
+
+CONSUMER_GROUP = "workers"
+# only the lease holder reads a shard, so all workers share one consumer and inherit each other's pending entries
+CONSUMER_NAME = "worker"
+
+_acquire_or_renew = redis_client.register_script(ACQUIRE_OR_RENEW_SCRIPT)
+_release = redis_client.register_script(RELEASE_SCRIPT)
+
+
+def stream_key(shard: int) -> str:
+    return f"bot:updates:{shard}"
+
+
+def shard_for(update: Update, shards: int) -> int:
+    if update.effective_chat:
+        key = update.effective_chat.id
+    elif update.effective_user:
+        key = update.effective_user.id
+    else:
+        key = 0
+    return zlib.crc32(str(key).encode()) % shards
+
+
+async def route_update(update: Update, context: CallbackContext) -> None:
+    """The front process' only handler: append the update to its shard's stream instead of handling it."""
+    shard = shard_for(update, SHARD_WORKERS)
+    await redis_client.xadd(
+        stream_key(shard),
+        {"update": json.dumps(update.to_dict(), ensure_ascii=False)},
+        maxlen=SHARD_STREAM_MAXLEN,
+        approximate=True
+    )
+    SHARD_UPDATES_ROUTED.inc(shard=shard)
+
+
+class ShardLease:
+    """The lease on one shard, renewed in the background while the worker runs."""
+
+    def __init__(self, shard: int):
+        self.key = f"bot:shards:{shard}"
+        self.held = False
+
+    async def renew(self) -> None:
+        try:
+            token = int(await _acquire_or_renew(keys=[self.key, f"{self.key}:token"], args=[INSTANCE_ID, SHARD_LEASE_TTL * 1000]))
+        except Exception as e:
+            logger.error(f"Renewing {self.key} failed: {e}")
+            token = 0
+
+        if token and not self.held:
+            logger.info(f"Instance {INSTANCE_ID} acquired {self.key} with fencing token {token}")
+        elif not token and self.held:
+            logger.warning(f"Instance {INSTANCE_ID} lost {self.key}")
+        self.held = bool(token)
+
+    async def keep(self) -> None:
+        while True:
+            await self.renew()
+            await asyncio.sleep(SHARD_LEASE_RENEW_INTERVAL)
+
+    async def release(self) -> None:
+        if self.held:
+            await _release(keys=[self.key], args=[INSTANCE_ID])
+        self.held = False
+
+
+async def handle_entry(app: Application, fields: dict | None) -> None:
+    if not fields:
+        # trimmed from the stream before it was handled
+        return
+    update = Update.de_json(json.loads(fields["update"]), app.bot)
+    if update is not None:
+        await app.process_update(update)
+
+
+async def consume_shard(app: Application, shard: int, lease: ShardLease) -> None:
+    key = stream_key(shard)
+    try:
+        await redis_client.xgroup_create(key, CONSUMER_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    while True:
+        if not lease.held:
+            await asyncio.sleep(SHARD_READ_BLOCK)
+            continue
+
+        # entries read before but not acknowledged, by a previous holder or before a crash, come first
+        entries = await redis_client.xreadgroup(CONSUMER_GROUP, CONSUMER_NAME, {key: "0"}, count=SHARD_READ_COUNT)
+        if not entries or not entries[0][1]:
+            entries = await redis_client.xreadgroup(CONSUMER_GROUP, CONSUMER_NAME, {key: ">"}, count=SHARD_READ_COUNT, block=SHARD_READ_BLOCK * 1000)
+
+        for _, messages in entries or []:
+            for entry_id, fields in messages:
+                try:
+                    await handle_entry(app, fields)
+                except Exception as e:
+                    # handler errors are caught by the application, this is a broken entry, don't retry it forever
+                    logger.error(f"Failed to handle {key} entry {entry_id}: {e}", exc_info=True)
+                await redis_client.xack(key, CONSUMER_GROUP, entry_id)
+
+
+def worker_log_file(shard: int) -> str:
+    name, extension = os.path.splitext(LOG_FILE)
+    return f"{name}.shard{shard}{extension}"
+
+
+async def _run_worker(shard: int, setup: Callable[[Application], None], metrics_listen: str, metrics_port: int) -> None:
+    app = ApplicationBuilder() \
+        .token(os.environ['TELEGRAM_TOKEN']) \
+        .request(InstrumentedRequest(connection_pool_size=256)) \
+        .updater(None) \
+        .build()
+    setup(app)
+
+    metrics_runner = None
+    if metrics_port:
+        metrics_runner = await start_metrics_server(metrics_listen, metrics_port)
+        logger.info(f"Worker of shard {shard} serving metrics on http://{metrics_listen}:{metrics_port}/metrics")
+
+    lease = ShardLease(shard)
+    try:
+        async with app:
+            keeper = asyncio.create_task(lease.keep())
+            consumer = asyncio.create_task(consume_shard(app, shard, lease))
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, consumer.cancel)
+            logger.info(f"Worker of shard {shard} started")
+            try:
+                await consumer
+            except asyncio.CancelledError:
+                pass
+            finally:
+                keeper.cancel()
+                await lease.release()
+                logger.info(f"Worker of shard {shard} stopped")
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
+
+def run_worker(shard: int, setup: Callable[[Application], None], log_file: str, metrics_listen: str, metrics_port: int) -> None:
+    """
+    Entry point of a worker process, `setup` registers the handlers on its application. The metrics server is only
+    started with a metrics_port.
+    """
+    set_log_file(log_file)
+    # SIGINT goes to the whole process group, the front process stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(_run_worker(shard, setup, metrics_listen, metrics_port))
+
+
+class WorkerPool:
+    def __init__(self, count: int, setup: Callable[[Application], None], metrics_listen: str = "", metrics_port: int = 0):
+        self.count = count
+        self.setup = setup
+        self.metrics_listen = metrics_listen
+        self.metrics_port = metrics_port
+        self.processes: dict[int, multiprocessing.Process] = {}
+        self._context = multiprocessing.get_context("spawn")
+
+    def _spawn(self, shard: int) -> None:
+        metrics_port = self.metrics_port + 1 + shard if self.metrics_port else 0
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self.setup, worker_log_file(shard), self.metrics_listen, metrics_port),
+            name=f"shard-{shard}",
+            daemon=True
+        )
+        process.start()
+        self.processes[shard] = process
+
+    def start(self) -> None:
+        for shard in range(self.count):
+            self._spawn(shard)
+        logger.info(f"Started {self.count} shard workers")
+
+    async def supervise(self, context: CallbackContext | None = None) -> None:
+        """Respawn workers that died, scheduled in the front process."""
+        for shard, process in self.processes.items():
+            if not process.is_alive():
+                logger.error(f"Worker of shard {shard} exited with {process.exitcode}, restarting it")
+                self._spawn(shard)
+
+    def stop(self) -> None:
+        for process in self.processes.values():
+            process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=SHARD_LEASE_TTL)
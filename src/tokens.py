@@ -0,0 +1,108 @@
+"""
+tokens.py
+
+Token counting for prompt budgets.
+
+Uses tiktoken when it is installed and the model's encoding can be loaded (unknown models fall back to
+o200k_base, a fair approximation for most current models). tiktoken downloads encodings on first use, so when
+that isn't possible counts are estimated from the characters instead: CJK characters count as one token each,
+everything else as a quarter token per character.
+"""
+
+import re
+from functools import lru_cache
+
+from core import logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+DEFAULT_ENCODING = "o200k_base"
+DEFAULT_CONTEXT_WINDOW = 32_000
+# first matching prefix wins, so longer prefixes go first
+MODEL_CONTEXT_WINDOWS = [
+    ("gpt-4.1", 1_000_000),
+    ("gpt-4o", 128_000),
+    ("gpt-4-turbo", 128_000),
+    ("gpt-4-32k", 32_768),
+    ("gpt-4", 8_192),
+    ("gpt-3.5", 16_385),
+    ("gpt-5", 400_000),
+    ("o1", 200_000),
+    ("o3", 200_000),
+    ("o4", 200_000),
+    ("claude", 200_000),
+    ("gemini", 1_000_000),
+    ("deepseek", 64_000),
+    ("qwen", 128_000),
+]
+# per message framing tokens of the chat format, and the reply priming
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+
+CJK_REGEX = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+def context_window(model: str) -> int:
+    model = model.lower().split("/")[-1]
+    for prefix, window in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+@lru_cache(maxsize=None)
+def load_encoding(name: str):
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        # typically the encoding can't be downloaded, cached so it's only attempted once
+        logger.warning(f"Falling back to estimated token counts, can't load {name}: {e!r}")
+        return None
+
+
+def get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        name = tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        name = DEFAULT_ENCODING
+    return load_encoding(name)
+
+
+def count_tokens(text: str, model: str = "") -> int:
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    cjk = len(CJK_REGEX.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def count_message_tokens(messages: list[dict], model: str = "") -> int:
+    total = REPLY_OVERHEAD_TOKENS
+    for message in messages:
+        total += MESSAGE_OVERHEAD_TOKENS + count_tokens(message.get("content") or "", model)
+        for tool_call in message.get("tool_calls") or []:
+            total += count_tokens(tool_call["function"]["name"], model) + count_tokens(tool_call["function"]["arguments"], model)
+    return total
+
+
+def trim_to_token_budget(text: str, budget: int, model: str = "") -> str:
+    tokens = count_tokens(text, model)
+    if tokens <= budget:
+        return text
+
+    encoding = get_encoding(model)
+    if encoding is not None:
+        kept = encoding.decode(encoding.encode(text, disallowed_special=())[:budget])
+    else:
+        # scale by the observed characters per token, then shave off until it fits
+        kept = text[:len(text) * budget // tokens]
+        while kept and count_tokens(kept, model) > budget:
+            kept = kept[:len(kept) * 9 // 10]
+
+    return f"{kept}\n\n[truncated, {tokens - budget} more tokens]"
@@ -0,0 +1,137 @@
+"""
+tools.py
+
+Tools the chat model can call. Every tool is registered with its JSON schema, an async handler receiving the
+parsed arguments and a timeout.
+
+All tool calls of one assistant turn run concurrently: each one is bounded by its own timeout, the whole turn by
+TOOL_CALLS_TIMEOUT. Failures, timeouts and unknown tools become error messages for the model instead of failing
+the reply, and results are returned in the order of the tool calls.
+"""
+
+import asyncio
+import json
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Callable, Coroutine, List
+
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall
+from openai.types.chat.chat_completion_tool_param import ChatCompletionToolParam
+
+from core import logger
+from tracing import span
+from utils import get_web_content, WEB_CONTENT_TIMEOUT
+
+TOOL_CALLS_TIMEOUT = float(os.getenv('TOOL_CALLS_TIMEOUT', 45))
+DEFAULT_TOOL_TIMEOUT = 10
+
+
+@dataclass
+class Tool:
+    name: str
+    description: str
+    parameters: dict
+    handler: Callable[..., Coroutine[Any, Any, str]]
+    timeout: float
+
+
+TOOL_REGISTRY: dict[str, Tool] = {}
+
+
+def register_tool(name: str, description: str, properties: dict | None = None, timeout: float = DEFAULT_TOOL_TIMEOUT):
+    properties = properties or {}
+
+    def decorator(handler: Callable[..., Coroutine[Any, Any, str]]):
+        TOOL_REGISTRY[name] = Tool(name, description, {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False
+        }, handler, timeout)
+        return handler
+    return decorator
+
+
+def tool_definitions() -> List[ChatCompletionToolParam]:
+    return [
+        {
+            "type": "function",
+            "function": {"name": tool.name, "description": tool.description, "parameters": tool.parameters}
+        }
+        for tool in TOOL_REGISTRY.values()
+    ]
+
+
+@register_tool("get_current_time", "Get the current time")
+async def get_current_time() -> str:
+    time_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return f"The current time is {time_str}. (UTC)"
+
+
+@register_tool("get_web_content", "Get the content of a web page", {
+    "url": {"type": "string", "description": "The URL of the web page to get the content from"}
+}, timeout=WEB_CONTENT_TIMEOUT + 15)
+async def get_web_content_tool(url: str) -> str:
+    return await get_web_content(url)
+
+
+async def run_tool_call(tool_call: ChoiceDeltaToolCall) -> str:
+    name = tool_call.function.name
+    tool = TOOL_REGISTRY.get(name)
+    if tool is None:
+        return f"Error: unknown tool {name}"
+
+    try:
+        arguments = json.loads(tool_call.function.arguments or "{}")
+    except json.JSONDecodeError as e:
+        return f"Error: invalid arguments for {name}: {e}"
+
+    logger.debug(f"Executing {name} tool with {arguments}")
+    with span(f"tool.{name}"):
+        try:
+            return await asyncio.wait_for(tool.handler(**arguments), tool.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool {name} timed out after {tool.timeout}s")
+            return f"Error: {name} timed out after {tool.timeout}s"
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # raised by the tool without us being cancelled, e.g. something it awaited was cancelled
+            logger.warning(f"Tool {name} was cancelled")
+            return f"Error: {name} was cancelled"
+        except Exception as e:
+            logger.warning(f"Tool {name} failed: {e!r}")
+            return f"Error: {name} failed: {e!r}"
+
+
+def tool_call_result(tool_call: ChoiceDeltaToolCall, task: asyncio.Task, done: set[asyncio.Task]) -> str:
+    name = tool_call.function.name
+    if task not in done:
+        return f"Error: {name} did not finish within {TOOL_CALLS_TIMEOUT}s"
+    if task.cancelled():
+        return f"Error: {name} was cancelled"
+    if task.exception() is not None:
+        return f"Error: {name} failed: {task.exception()!r}"
+    return task.result()
+
+
+async def run_tool_calls(tool_calls: List[ChoiceDeltaToolCall]) -> list[dict]:
+    """Run the tool calls concurrently and return their `tool` messages in the original order."""
+    tasks = [asyncio.create_task(run_tool_call(tool_call)) for tool_call in tool_calls]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=TOOL_CALLS_TIMEOUT)
+    finally:
+        # past the timeout, or if we're cancelled ourselves, nothing waits for the unfinished ones any more
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    return [
+        {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": tool_call_result(tool_call, task, done)
+        }
+        for tool_call, task in zip(tool_calls, tasks)
+    ]
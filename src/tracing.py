@@ -0,0 +1,214 @@
+"""
+tracing.py
+
+Lightweight span tracing, propagated through contextvars (so it follows awaits and tasks spawned with
+asyncio.gather / create_task).
+
+A trace starts at a root span: every Telegram update handler and job-queue tick opens one. Spans opened while
+no trace is active are no-ops, so instrumenting shared helpers (Redis, LLM calls, Bot API calls) costs next to
+nothing outside of a trace.
+
+When a root span takes longer than SLOW_TRACE_THRESHOLD seconds, the whole trace is logged to `bot.trace` as
+one structured JSON record, and, if TRACE_EXPORT_FILE is set, appended to that file as an OTLP/JSON
+`resourceSpans` line (one export request per line), which OpenTelemetry tooling can ingest. Like the log, exported
+lines are written by a background thread, so the event loop never waits on the disk.
+"""
+
+import asyncio
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import secrets
+import time
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener
+
+SLOW_TRACE_THRESHOLD = float(os.getenv('SLOW_TRACE_THRESHOLD', 5))
+TRACE_EXPORT_FILE = os.getenv('TRACE_EXPORT_FILE')
+SERVICE_NAME = os.getenv('SERVICE_NAME', 'personal-bot')
+MAX_SPANS_PER_TRACE = int(os.getenv('MAX_SPANS_PER_TRACE', 2000))
+
+trace_logger = logging.getLogger('bot.trace')
+# exported lines only go to TRACE_EXPORT_FILE, through their own queue
+export_logger = logging.getLogger('bot.trace.export')
+export_logger.propagate = False
+export_logger.setLevel(logging.INFO)
+_export_pid: int | None = None
+
+_current_span: contextvars.ContextVar['Span | None'] = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start', 'end', 'error', '_token')
+
+    def __init__(self, trace: 'Trace', name: str, parent_id: str | None, attributes: dict):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end: int | None = None
+        self.error: str | None = None
+        self._token = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self) -> 'Span':
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end = time.time_ns()
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.error = f"{exc_type.__name__}: {exc}"
+        _current_span.reset(self._token)
+
+        if self.parent_id is None:
+            self.trace.finish(self)
+
+
+def start_export() -> None:
+    """Start the thread writing exported traces, once per process (worker processes don't inherit the parent's)."""
+    global _export_pid
+    if _export_pid == os.getpid():
+        return
+
+    export_handler = logging.FileHandler(TRACE_EXPORT_FILE, encoding='utf-8', delay=True)
+    export_handler.setFormatter(logging.Formatter('%(message)s'))
+    export_queue = queue.SimpleQueue()
+    export_listener = QueueListener(export_queue, export_handler)
+    export_listener.start()
+    atexit.register(export_listener.stop)
+
+    export_logger.handlers = [QueueHandler(export_queue)]
+    _export_pid = os.getpid()
+
+
+class Trace:
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: list[Span] = []
+
+    def finish(self, root: Span) -> None:
+        if root.duration < SLOW_TRACE_THRESHOLD:
+            return
+
+        record = {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "duration": round(root.duration, 3),
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "offset": round((span.start - root.start) / 1e9, 3),
+                    "duration": round(span.duration, 3),
+                    **({"error": span.error} if span.error else {}),
+                    **({"attributes": span.attributes} if span.attributes else {})
+                }
+                for span in sorted(self.spans, key=lambda span: span.start)
+            ]
+        }
+        trace_logger.warning(f"Slow trace {root.name} took {root.duration:.3f}s: {json.dumps(record, ensure_ascii=False, default=str)}")
+
+        if TRACE_EXPORT_FILE:
+            start_export()
+            export_logger.info(json.dumps(self.to_otlp(), default=str))
+
+    def to_otlp(self) -> dict:
+        def attribute(key: str, value) -> dict:
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            if isinstance(value, float):
+                return {"key": key, "value": {"doubleValue": value}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        spans = []
+        for span in self.spans:
+            otlp_span = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end or time.time_ns()),
+                "attributes": [attribute(key, value) for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1}
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": "bot"}, "spans": spans}]
+            }]
+        }
+
+
+class _NoopSpan:
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def span(name: str, root: bool = False, **attributes) -> Span | _NoopSpan:
+    """
+    Open a span as a context manager. With `root=True` a new trace is started when none is active, otherwise
+    the span is only recorded inside an existing trace.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        if not root:
+            return _NOOP_SPAN
+        trace = Trace()
+        new_span = Span(trace, name, None, attributes)
+    else:
+        trace = parent.trace
+        if len(trace.spans) >= MAX_SPANS_PER_TRACE:
+            return _NOOP_SPAN
+        new_span = Span(trace, name, parent.span_id, attributes)
+
+    trace.spans.append(new_span)
+    return new_span
+
+
+def traced(name: str, root: bool = False):
+    """Decorator wrapping every call of a (coroutine) function in a span, see `span`."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, root=root):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, root=root):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
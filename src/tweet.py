@@ -5,9 +5,15 @@ This file contains the logic for checking for new tweets, send new tweets to cor
 
 Redis key structure:
 - tweets:sent:{username}:{post_id} -> 1  # Track sent tweets
-- tweets:urls:queue -> [tweet_url1, tweet_url2, ...]  # Queue of tweet URLs to be sent
+- tweets:urls:queue -> [tweet1, tweet2, ...]  # Queue of tweets to be sent, JSON records or (legacy) tweet URLs that are fetched when sent; a requeued record lists the chats it was already sent to in `done`
 - tweets:subscriptions:user:{telegram_id} -> [twitter_username1, twitter_username2, ...]  # User's subscriptions
 - tweets:targets:user:{twitter_username} -> [telegram_id1, telegram_id2, ...]  # Target users for each Twitter user
+- tweets:urls:processing:{instance_id} -> [tweet1, ...]  # Queue items claimed by one replica (see leader.py)
+- tweets:info:{post_id} -> api.fxtwitter.com response  # Expires after TWEET_INFO_CACHE_TTL seconds
+- tweets:digest:{chat_id} -> [tweet1, ...]  # Tweet records buffered for the chat's next digest
+- tweets:digest:due -> sorted set, chat_id -> unix time  # When the chat's next digest is due
+- tweets:digest:processing:{instance_id}:{chat_id} -> [tweet1, ...]  # Digest records claimed by a replica, until sent
+- user:{chat_id}:twitter_digest -> minutes  # Digest mode: tweets are collected and sent every this many minutes, 0 is off
 
 This requires a many-to-many mapping between twitter_id and telegram_id, we store as:
 
@@ -102,21 +108,58 @@ we divide the sending process into two parts:
 an additional set is used to cache the fetched tweet urls:
 
 tweet_url_to_be_sent: [tweet_url1, tweet_url2, ...]
+
+---
+
+update (2026-10-19)
+
+multiple replicas can now run at once, see leader.py:
+
+- only the elected leader scrapes, and enqueues through a script that checks its fencing token
+- every replica claims queue items with LMOVE into tweets:urls:processing:{instance_id} before sending them
+
+the scraper parses the __NEXT_DATA__ JSON embedded in the syndication timeline and queues self-contained tweet
+records (see `parse_timeline`), shaped like the `tweet` object of api.fxtwitter.com so both render the same way.
+Retweet and media-only filters are applied before queueing, and delivering a record needs no second fetch. Plain
+tweet URLs (from before, or from the regex fallback when the page has no __NEXT_DATA__) are still fetched from
+api.fxtwitter.com when sent.
+
+---
+
+update (2026-10-19)
+
+chats can switch to digest mode with /set_twitter_digest: their tweets are buffered instead of sent one by one, and
+flushed every few minutes (or early, once TWEET_DIGEST_MAX_TWEETS are buffered) as albums of up to 10 media plus
+text messages, each with a compact index linking the tweets. Whoever removes the chat from tweets:digest:due sends
+its digest, so replicas don't send it twice. The claimed records move to a processing list of the replica and leave
+it message by message as they are sent, a failed digest is retried without what was sent already, and dropped if
+the chat can't be reached anymore.
 """
 
+import asyncio
+import csv
+import html
 import json
 import os
 import random
 import re
+import sys
+import time
 from datetime import datetime
 
 import httpx
 from telegram import InputMediaPhoto, InputMediaVideo, LinkPreviewOptions
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import CallbackContext
 
 from core import logger, redis_client
-from llm_translate import translate_text
-from utils import get_redis_value
+from lang import needs_translation
+from leader import is_leader, fencing_token, processing_key, digest_processing_key, LEADER_TOKEN_KEY
+from llm_translate import translate_short_text
+from metrics import timed
+from tracing import traced
+from usage import quota_exceeded
+from utils import get_redis_value, SingleFlight
 
 TWITTER_COOKIE = os.getenv("TWITTER_COOKIE")
 if not TWITTER_COOKIE:
@@ -125,6 +168,22 @@ if not TWITTER_COOKIE:
 SEND_ONLY_WITH_MEDIA = os.getenv("SEND_ONLY_WITH_MEDIA", "true").lower() == "true"
 IGNORE_RETWEETS = os.getenv("IGNORE_RETWEETS", "true").lower() == "true"
 SAVE_TWITTER_RESPONSE = os.getenv("SAVE_TWITTER_RESPONSE", "false").lower() == "true"
+SEND_BATCH_SIZE = int(os.getenv("SEND_BATCH_SIZE", 20))
+TWEET_INFO_CACHE_TTL = int(os.getenv("TWEET_INFO_CACHE_TTL", 300))
+SUBSCRIPTION_BATCH_SIZE = 500
+# a chat's digest is sent early once this many tweets are buffered for it
+TWEET_DIGEST_MAX_TWEETS = int(os.getenv("TWEET_DIGEST_MAX_TWEETS", 30))
+TWEET_DIGEST_SNIPPET_CHARS = 80
+TWEET_DIGEST_ALBUM_MEDIA = 10
+TWEET_DIGEST_RETRY_DELAY = 60
+# Telegram fetches files sent by URL up to 20 MB, and accepts uploads up to 50 MB
+TELEGRAM_URL_MAX_BYTES = 20 * 1024 * 1024
+TELEGRAM_UPLOAD_MAX_BYTES = 50 * 1024 * 1024
+# variant bitrates are of the video stream, sizes are estimated with the audio and some container overhead on top
+VIDEO_AUDIO_BITRATE = 128_000
+VIDEO_CONTAINER_OVERHEAD = 1.05
+CAPTION_MAX_LENGTH = 1024
+MESSAGE_MAX_LENGTH = 4096
 
 RAW_HEADERS = f"""
 Host: syndication.twitter.com
@@ -145,37 +204,140 @@ Pragma: no-cache
 Cache-Control: no-cache
 """
 
+twitter_logger = logger.getChild('twitter')
+
 HEADERS = {
     line.split(": ")[0]: line.split(": ")[1]
     for line in RAW_HEADERS.split("\n")
     if line
 }
 
+POST_ID_REGEX = re.compile(r"/status/(\d+)")
+USERNAME_REGEX = re.compile(r"^@?([A-Za-z0-9_]{1,15})$")
+PROFILE_URL_REGEX = re.compile(r"^(?:https?://)?(?:www\.|mobile\.)?(?:twitter|x)\.com/([A-Za-z0-9_]{1,15})/?(?:[?#].*)?$")
+SUBSCRIPTION_SEPARATOR_REGEX = re.compile(r"[\s,;]+")
+CSV_USERNAME_COLUMNS = ("username", "screen_name", "handle")
+VIDEO_RESOLUTION_REGEX = re.compile(r"/(\d+)x(\d+)/")
+HTML_TAG_REGEX = re.compile(r"<[^>]+>")
+NEXT_DATA_REGEX = re.compile(r'<script id="__NEXT_DATA__" type="application/json">(.*?)</script>', re.DOTALL)
+
+# KEYS[1] = fencing token, KEYS[2] = sent marker, KEYS[3] = queue; ARGV[1] = our token, ARGV[2] = queue item
+# returns -1 if a newer leader exists, 0 if the tweet was already queued before, 1 if it got queued
+ENQUEUE_TWEET_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return -1
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 0
+end
+redis.call('RPUSH', KEYS[3], ARGV[2])
+redis.call('SET', KEYS[2], 1)
+return 1
+"""
+
+_enqueue_tweet = redis_client.register_script(ENQUEUE_TWEET_SCRIPT)
 
-async def subscribe_twitter_user(twitter_username: str, chat_id: int) -> str | None:
+# concurrent lookups of one tweet (pasted by several users, delivered to many subscribers) share one request
+tweet_info_flights = SingleFlight()
+
+
+def normalize_username(twitter_username: str) -> str:
     twitter_username = twitter_username.lower()
     if twitter_username.startswith('@'):
         twitter_username = twitter_username[1:]
+    return twitter_username
+
+
+def parse_usernames(text: str, table: str = "") -> tuple[list[str], list[str]]:
+    """
+    (usernames, rejected entries) of a list of Twitter users separated by whitespace, commas or semicolons, as
+    @name, name or profile URL, plus those of a CSV `table`: its username / screen_name / handle column, or its
+    first column if it has no such header.
+    """
+    entries = SUBSCRIPTION_SEPARATOR_REGEX.split(text)
+
+    rows = [row for row in csv.reader(table.splitlines()) if row]
+    if rows:
+        header = [cell.strip().lower() for cell in rows[0]]
+        column = next((header.index(name) for name in CSV_USERNAME_COLUMNS if name in header), None)
+        if column is None:
+            column = 0
+        else:
+            rows = rows[1:]
+        entries += [row[column] for row in rows if len(row) > column]
+
+    # a dict, to drop duplicates in constant time and keep the order
+    usernames, rejected = {}, []
+    for entry in entries:
+        entry = entry.strip().strip('"\'')
+        if not entry or entry.lower() in CSV_USERNAME_COLUMNS:
+            continue
+        match = PROFILE_URL_REGEX.match(entry) or USERNAME_REGEX.match(entry)
+        if not match:
+            rejected.append(entry)
+            continue
+        usernames[normalize_username(match.group(1))] = None
+    return list(usernames), rejected
+
+
+async def update_subscriptions(usernames: list[str], chat_id: int, subscribe: bool) -> int:
+    """
+    Add (or remove) subscriptions of a chat, both index sets of a batch are written in one transaction.
+    Returns how many subscriptions changed.
+    """
+    changed = 0
+    for i in range(0, len(usernames), SUBSCRIPTION_BATCH_SIZE):
+        batch = usernames[i:i + SUBSCRIPTION_BATCH_SIZE]
+        async with redis_client.pipeline(transaction=True) as pipe:
+            if subscribe:
+                pipe.sadd(f"tweets:subscriptions:user:{chat_id}", *batch)
+                for twitter_username in batch:
+                    pipe.sadd(f"tweets:targets:user:{twitter_username}", chat_id)
+            else:
+                pipe.srem(f"tweets:subscriptions:user:{chat_id}", *batch)
+                for twitter_username in batch:
+                    pipe.srem(f"tweets:targets:user:{twitter_username}", chat_id)
+            changed += (await pipe.execute())[0]
+    return changed
 
-    # Add to user's subscriptions
-    await redis_client.sadd(f"tweets:subscriptions:user:{chat_id}", twitter_username)
-    # Add to Twitter user's targets
-    await redis_client.sadd(f"tweets:targets:user:{twitter_username}", chat_id)
 
+async def subscribe_twitter_user(twitter_username: str, chat_id: int) -> str | None:
+    twitter_username = normalize_username(twitter_username)
+    await update_subscriptions([twitter_username], chat_id, subscribe=True)
     return f"Subscribed to @{twitter_username}"
 
 
 async def unsubscribe_twitter_user(twitter_username: str, chat_id: int) -> str | None:
-    twitter_username = twitter_username.lower()
-    if twitter_username.startswith('@'):
-        twitter_username = twitter_username[1:]
+    twitter_username = normalize_username(twitter_username)
+    await update_subscriptions([twitter_username], chat_id, subscribe=False)
+    return f"Unsubscribed from @{twitter_username}"
 
-    # Remove from user's subscriptions
-    await redis_client.srem(f"tweets:subscriptions:user:{chat_id}", twitter_username)
-    # Remove from Twitter user's targets
-    await redis_client.srem(f"tweets:targets:user:{twitter_username}", chat_id)
 
-    return f"Unsubscribed from @{twitter_username}"
+def bulk_result(action: str, usernames: list[str], changed: int, rejected: list[str]) -> str:
+    message = f"{action} {changed} Twitter users ({len(usernames) - changed} unchanged)."
+    if rejected:
+        message += f"\nSkipped {len(rejected)} invalid entries: {', '.join(rejected[:20])}"
+        if len(rejected) > 20:
+            message += ", ..."
+    return message
+
+
+async def subscribe_twitter_users(text: str, chat_id: int, table: str = "") -> str:
+    usernames, rejected = parse_usernames(text, table)
+    changed = await update_subscriptions(usernames, chat_id, subscribe=True)
+    return bulk_result("Subscribed to", usernames, changed, rejected)
+
+
+async def unsubscribe_twitter_users(text: str, chat_id: int, table: str = "") -> str:
+    usernames, rejected = parse_usernames(text, table)
+    changed = await update_subscriptions(usernames, chat_id, subscribe=False)
+    return bulk_result("Unsubscribed from", usernames, changed, rejected)
+
+
+async def export_twitter_subscription(chat_id: int) -> str:
+    """The chat's subscriptions, one username per line, in the format the bulk commands read."""
+    subscribed_users = await redis_client.smembers(f"tweets:subscriptions:user:{chat_id}")
+    return "\n".join(sorted(subscribed_users))
 
 
 async def list_twitter_subscription(chat_id: int) -> str:
@@ -191,6 +353,8 @@ async def list_twitter_subscription(chat_id: int) -> str:
     return message
 
 
+@traced("send_tweet")
+@timed("send_tweet")
 async def send_tweet(
         url: str,
         context: CallbackContext,
@@ -199,20 +363,157 @@ async def send_tweet(
         reply_to_message_id: int | None = None,
         can_ignore: bool = False
 ) -> None:
-    async with httpx.AsyncClient() as client:
-        url = url.replace("x.com", "twitter.com").replace('twitter.com', 'api.fxtwitter.com')
-        response = await client.get(url, timeout=10)
-    info = json.loads(response.text)
+    info = await get_tweet_info(url)
 
     if info['code'] == 404:
         return
 
-    create_timestamp = datetime.fromtimestamp(info['tweet']['created_timestamp'])
-    create_timestamp_str = create_timestamp.strftime("%Y/%m/%d %H:%M:%S")
+    await deliver_tweet(info['tweet'], context, user_id, chat_id, reply_to_message_id, can_ignore)
 
-    if can_ignore and IGNORE_RETWEETS and info['tweet']['text'].startswith("RT"):
-        logger.debug(f"Ignoring tweet {url} because it's a retweet")
-        return
+
+async def queued_record(item: str) -> dict | None:
+    """The tweet record of a queue item, legacy items (tweet URLs) are fetched. None if the tweet no longer exists."""
+    if item.startswith("{"):
+        return json.loads(item)
+
+    info = await get_tweet_info(item)
+    if info['code'] == 404:
+        return None
+    return info['tweet']
+
+
+async def get_tweet_info(url: str) -> dict:
+    """api.fxtwitter.com's response for a tweet URL, cached in Redis for TWEET_INFO_CACHE_TTL seconds."""
+    match = POST_ID_REGEX.search(url)
+    flight_key = match.group(1) if match else url
+    cache_key = f"tweets:info:{flight_key}"
+
+    async def fetch() -> dict:
+        cached = await redis_client.get(cache_key) if match else None
+        if cached is not None:
+            return json.loads(cached)
+
+        async with httpx.AsyncClient() as client:
+            api_url = url.replace("x.com", "twitter.com").replace('twitter.com', 'api.fxtwitter.com')
+            response = await client.get(api_url, timeout=10)
+        info = json.loads(response.text)
+        if match and info.get('code') in (200, 404):
+            await redis_client.set(cache_key, response.text, ex=TWEET_INFO_CACHE_TTL)
+        return info
+
+    return await tweet_info_flights.do(flight_key, fetch)
+
+
+def video_variants(media: dict, max_bytes: int) -> list[dict]:
+    """
+    The mp4 variants of a video / gif estimated to be at most `max_bytes`, best first: by bitrate, then resolution.
+    A variant whose size can't be estimated (no duration or bitrate, e.g. gifs) is assumed to fit.
+    """
+    def resolution(variant: dict) -> int:
+        match = VIDEO_RESOLUTION_REGEX.search(variant['url'])
+        return int(match.group(1)) * int(match.group(2)) if match else 0
+
+    def estimated_size(variant: dict) -> float:
+        if not media.get('duration') or not variant.get('bitrate'):
+            return 0
+        return (variant['bitrate'] + VIDEO_AUDIO_BITRATE) * media['duration'] / 8 * VIDEO_CONTAINER_OVERHEAD
+
+    variants = [variant for variant in media.get('variants', []) if variant.get('content_type') == 'video/mp4']
+    variants.sort(key=lambda variant: (variant.get('bitrate', 0), resolution(variant)), reverse=True)
+    return [variant for variant in variants if estimated_size(variant) <= max_bytes]
+
+
+def video_url(media: dict, max_bytes: int = TELEGRAM_URL_MAX_BYTES) -> str | None:
+    """
+    The best mp4 of a video / gif Telegram can fetch by URL, or the smallest one if none fits. Media without variants
+    are fxtwitter's, whose url is an mp4. None if there is no mp4 at all (only HLS variants, or none were scraped).
+    """
+    variants = video_variants(media, max_bytes) or video_variants(media, sys.maxsize)[-1:]
+    if variants:
+        return variants[0]['url']
+    if 'variants' in media:
+        return None
+    return media['url']
+
+
+def url_fetchable_video(media: dict) -> bool:
+    """Whether the video has an mp4 that is estimated to be small enough for Telegram to fetch by URL."""
+    return video_url(media) is not None and bool(video_variants(media, TELEGRAM_URL_MAX_BYTES) or 'variants' not in media)
+
+
+def fetchable_by_url(tweet: dict) -> bool:
+    """False if a video of the tweet has no mp4, or one estimated to be too large for Telegram to fetch by URL."""
+    return all(
+        url_fetchable_video(media)
+        for media in tweet.get('media', {}).get('all', [])
+        if media['type'] in ('video', 'gif')
+    )
+
+
+async def download_video(client: httpx.AsyncClient, media: dict) -> InputMediaVideo | InputMediaPhoto | None:
+    """
+    Download the best variant of a video that fits Telegram's upload limit, trying smaller ones while the actual size
+    is over it, then the video's thumbnail. None if nothing could be downloaded.
+    """
+    urls = [variant['url'] for variant in video_variants(media, TELEGRAM_UPLOAD_MAX_BYTES)]
+    if not urls and video_url(media, TELEGRAM_UPLOAD_MAX_BYTES):
+        # estimated to be too large, or not estimated at all, its actual size decides
+        urls = [video_url(media, TELEGRAM_UPLOAD_MAX_BYTES)]
+    for url in urls:
+        try:
+            async with client.stream("GET", url, timeout=60) as response:
+                response.raise_for_status()
+                if int(response.headers.get('content-length', 0)) > TELEGRAM_UPLOAD_MAX_BYTES:
+                    logger.debug(f"Skipping video variant {url}, {response.headers['content-length']} bytes")
+                    continue
+
+                content = bytearray()
+                async for chunk in response.aiter_bytes():
+                    content += chunk
+                    if len(content) > TELEGRAM_UPLOAD_MAX_BYTES:
+                        break
+                else:
+                    return InputMediaVideo(bytes(content))
+                logger.debug(f"Skipping video variant {url}, over {TELEGRAM_UPLOAD_MAX_BYTES} bytes")
+
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to download video variant {url}: {e}")
+
+    if media.get('thumbnail_url'):
+        logger.warning(f"No mp4 of the video can be uploaded, sending its thumbnail {media['thumbnail_url']}")
+        try:
+            response = await client.get(media['thumbnail_url'])
+            response.raise_for_status()
+            return InputMediaPhoto(response.content)
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to download video thumbnail {media['thumbnail_url']}: {e}")
+    return None
+
+
+def tweet_medias(tweet: dict) -> list[InputMediaPhoto | InputMediaVideo]:
+    """The media of a tweet by URL, for Telegram to fetch them itself (used by digests, see `fetchable_by_url`)."""
+    if 'external' in tweet['media']:
+        return [InputMediaPhoto(tweet['media']['external']['thumbnail_url'])]
+
+    medias = []
+    for media in tweet['media']['all']:
+        if media['type'] == 'photo':
+            medias.append(InputMediaPhoto(media['url']))
+        elif media['type'] in ('video', 'gif'):
+            if media.get('thumbnail_url') and not url_fetchable_video(media):
+                # no mp4, or too large to be fetched by URL, the thumbnail stands in for it
+                medias.append(InputMediaPhoto(media['thumbnail_url']))
+            elif video_url(media) is not None:
+                medias.append(InputMediaVideo(video_url(media)))
+    return medias
+
+
+async def tweet_caption(tweet: dict, user_id: int) -> str:
+    """The HTML caption of a tweet (and its quote), translated if the user turned on tweet translation."""
+    url = tweet['url']
+
+    create_timestamp = datetime.fromtimestamp(tweet['created_timestamp'])
+    create_timestamp_str = create_timestamp.strftime("%Y/%m/%d %H:%M:%S")
 
     async def info_to_caption(info: dict) -> str:
         if len(info['text']):
@@ -221,14 +522,19 @@ async def send_tweet(
             openai_model = await get_redis_value(f'user:{user_id}:openai_model')
             twitter_translation = (await get_redis_value(f'user:{user_id}:twitter_translation', 'false')).lower() == 'true'
 
-            if openai_api_key and twitter_translation:
+            if (
+                    openai_api_key and twitter_translation
+                    and await needs_translation(info['text'], user_id, 'tweet')
+                    and not await quota_exceeded(user_id)
+            ):
                 logger.debug(f"Translating tweet {url} to {openai_model}")
 
-                translated = (await translate_text(
+                translated = (await translate_short_text(
                     info['text'],
                     openai_api_key=openai_api_key,
                     openai_api_endpoint=openai_api_endpoint,
-                    openai_model=openai_model
+                    openai_model=openai_model,
+                    user_id=user_id
                 )).strip(' \n')
 
                 return f"""
@@ -258,68 +564,104 @@ async def send_tweet(
 <a href="{info['url']}">{create_timestamp_str}</a>
 """
 
-    caption = await info_to_caption(info['tweet'])
+    caption = await info_to_caption(tweet)
 
-    if "quote" in info['tweet']:
+    if "quote" in tweet:
         caption += "<blockquote>"
-        caption += await info_to_caption(info['tweet']['quote'])
+        caption += await info_to_caption(tweet['quote'])
         caption += "</blockquote>"
 
-    if "media" in info['tweet']:
-        try:
-            medias = []
-
-            if 'external' in info['tweet']['media']:
-                medias.append(InputMediaPhoto(info['tweet']['media']['external']['thumbnail_url']))
+    return caption
 
-            else:
-                for media in info['tweet']['media']['all']:
-                    if media['type'] == 'photo':
-                        medias.append(InputMediaPhoto(media['url']))
-                    elif media['type'] == 'video':
-                        medias.append(InputMediaVideo(media['variants'][3]['url']))
-                    elif media['type'] == 'gif':
-                        medias.append(InputMediaVideo(media['variants'][0]['url']))
 
-            await context.bot.send_media_group(
-                chat_id=chat_id,
-                media=medias,
-                reply_to_message_id=reply_to_message_id,
-                caption=caption,
-                parse_mode="HTML",
-                write_timeout=20
-            )
+async def upload_tweet_media(
+        tweet: dict,
+        context: CallbackContext,
+        chat_id: int,
+        reply_to_message_id: int | None,
+        caption: str
+) -> None:
+    """Download a tweet's media and upload them, for media Telegram can't (or failed to) fetch by URL itself."""
+    medias = []
 
-        except Exception as e:
-            logger.error(f"Error fetching media for tweet {url}: {e}")
-            medias = []
+    async with httpx.AsyncClient() as client:
 
-            async with httpx.AsyncClient() as client:
+        if 'external' in tweet['media']:
+            response = await client.get(tweet['media']['external']['thumbnail_url'])
+            medias.append(InputMediaPhoto(response.content))
 
-                if 'external' in info['tweet']['media']:
-                    response = await client.get(info['tweet']['media']['external']['thumbnail_url'])
+        else:
+            for media in tweet['media']['all']:
+                if media['type'] == 'photo':
+                    response = await client.get(media['url'])
                     medias.append(InputMediaPhoto(response.content))
+                elif media['type'] in ('video', 'gif'):
+                    video = await download_video(client, media)
+                    if video is not None:
+                        medias.append(video)
 
-                else:
-                    for media in info['tweet']['media']['all']:
-                        if media['type'] == 'photo':
-                            response = await client.get(media['url'])
-                            medias.append(InputMediaPhoto(response.content))
-                        elif media['type'] == 'video':
-                            response = await client.get(media['variants'][3]['url'])
-                            medias.append(InputMediaVideo(response.content))
-                        elif media['type'] == 'gif':
-                            response = await client.get(media['variants'][0]['url'])
-                            medias.append(InputMediaVideo(response.content))
+    if not medias:
+        # nothing could be sent, the caption still links the tweet
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=caption,
+            parse_mode="HTML",
+            reply_to_message_id=reply_to_message_id,
+            link_preview_options=LinkPreviewOptions(is_disabled=True)
+        )
+        return
+
+    await context.bot.send_media_group(
+        chat_id=chat_id,
+        media=medias,
+        reply_to_message_id=reply_to_message_id,
+        caption=caption,
+        parse_mode="HTML",
+        write_timeout=20
+    )
 
+
+async def deliver_tweet(
+        tweet: dict,
+        context: CallbackContext,
+        user_id: int,
+        chat_id: int,
+        reply_to_message_id: int | None = None,
+        can_ignore: bool = False,
+        caption: str | None = None
+) -> None:
+    """
+    Send a tweet, in the shape of api.fxtwitter.com's `tweet` object, to a chat. `caption` is built by
+    `tweet_caption` unless it's passed in.
+    """
+    info = {'tweet': tweet}
+    url = tweet['url']
+
+    if can_ignore and IGNORE_RETWEETS and info['tweet']['text'].startswith("RT"):
+        logger.debug(f"Ignoring tweet {url} because it's a retweet")
+        return
+
+    if caption is None:
+        caption = await tweet_caption(tweet, user_id)
+
+    if "media" in info['tweet']:
+        if not fetchable_by_url(tweet):
+            logger.debug(f"Uploading the media of tweet {url}, a video is too large for Telegram to fetch by URL")
+            await upload_tweet_media(tweet, context, chat_id, reply_to_message_id, caption)
+            return
+
+        try:
             await context.bot.send_media_group(
                 chat_id=chat_id,
-                media=medias,
+                media=tweet_medias(tweet),
                 reply_to_message_id=reply_to_message_id,
                 caption=caption,
                 parse_mode="HTML",
                 write_timeout=20
             )
+        except Exception as e:
+            logger.error(f"Error fetching media for tweet {url}: {e}")
+            await upload_tweet_media(tweet, context, chat_id, reply_to_message_id, caption)
 
     else:
         if can_ignore and SEND_ONLY_WITH_MEDIA:
@@ -335,11 +677,248 @@ async def send_tweet(
         )
 
 
-async def fetch_tweets(twitter_id: str) -> list[str]:
+def media_count(tweet: dict) -> int:
+    if 'media' not in tweet:
+        return 0
+    if 'external' in tweet['media']:
+        return 1
+    return sum(media['type'] in ('photo', 'video', 'gif') for media in tweet['media']['all'])
+
+
+def visible_length(text: str) -> int:
+    """Length of an HTML caption as Telegram counts it, without tags and entities."""
+    return len(html.unescape(HTML_TAG_REGEX.sub("", text)))
+
+
+def digest_line(label: str, tweet: dict) -> str:
+    text = " ".join(tweet['text'].split())
+    if len(text) > TWEET_DIGEST_SNIPPET_CHARS:
+        text = text[:TWEET_DIGEST_SNIPPET_CHARS].rstrip() + "…"
+
+    line = f"{label}. <b>{html.escape(tweet['author']['name'], quote=False)}</b>"
+    if text:
+        line += f": {html.escape(text, quote=False)}"
+    return line + f' <a href="{tweet["url"]}">↗</a>'
+
+
+def pack_digest(tweets: list[dict]) -> list[tuple[list[dict], str]]:
+    """
+    Split the tweets of a digest into messages of (tweets, index): albums of the tweets with media, each line of the
+    index labelled with the positions of the tweet's media in the album, then text messages of the tweets without.
+    """
+    messages = []
+
+    group, lines, position = [], [], 1
+    for tweet in (tweet for tweet in tweets if media_count(tweet)):
+        count = media_count(tweet)
+
+        def line_at(start: int) -> str:
+            return digest_line(str(start) if count == 1 else f"{start}-{start + count - 1}", tweet)
+
+        line = line_at(position)
+        if group and (
+                position + count - 1 > TWEET_DIGEST_ALBUM_MEDIA
+                or visible_length("\n".join([*lines, line])) > CAPTION_MAX_LENGTH
+        ):
+            messages.append((group, "\n".join(lines)))
+            group, lines, position = [], [], 1
+            line = line_at(position)
+        group.append(tweet)
+        lines.append(line)
+        position += count
+    if group:
+        messages.append((group, "\n".join(lines)))
+
+    group, lines = [], []
+    for number, tweet in enumerate((tweet for tweet in tweets if not media_count(tweet)), 1):
+        line = digest_line(str(number), tweet)
+        if lines and visible_length("\n".join([*lines, line])) > MESSAGE_MAX_LENGTH:
+            messages.append((group, "\n".join(lines)))
+            group, lines = [], []
+        group.append(tweet)
+        lines.append(line)
+    if lines:
+        messages.append((group, "\n".join(lines)))
+
+    return messages
+
+
+async def digest_interval(chat_id: int) -> int:
+    """Seconds between the chat's digests, 0 if tweets are sent to it right away."""
+    try:
+        return max(0, int(float(await get_redis_value(f"user:{chat_id}:twitter_digest", 0)) * 60))
+    except (ValueError, OverflowError):
+        # set by hand (/set_redis) or before it was validated
+        return 0
+
+
+async def buffer_for_digest(item: str, chat_id: int, interval: int) -> None:
+    """Add a queued tweet record to the chat's next digest, which is due `interval` seconds after its first tweet."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(f"tweets:digest:{chat_id}", item)
+        pipe.zadd("tweets:digest:due", {str(chat_id): time.time() + interval}, nx=True)
+        length, _ = await pipe.execute()
+
+    if length >= TWEET_DIGEST_MAX_TWEETS:
+        await redis_client.zadd("tweets:digest:due", {str(chat_id): 0})
+
+
+async def send_digest(items: list[str], context: CallbackContext, chat_id: int, processing: str) -> None:
+    """Send the digest of buffered tweet records, removing every message's records from `processing` once it's sent."""
+    tweets = [json.loads(item) for item in items]
+    records = {id(tweet): item for tweet, item in zip(tweets, items)}
+
+    for group, index in pack_digest(tweets):
+        sent = False
+        if media_count(group[0]):
+            try:
+                await context.bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[media for tweet in group for media in tweet_medias(tweet)],
+                    caption=index,
+                    parse_mode="HTML",
+                    write_timeout=20
+                )
+                sent = True
+            except Exception as e:
+                # the index links every tweet, it still does without the album
+                logger.error(f"Error sending digest album to {chat_id}: {e}")
+
+        if not sent:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=index,
+                parse_mode="HTML",
+                link_preview_options=LinkPreviewOptions(is_disabled=True)
+            )
+
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for tweet in group:
+                pipe.lrem(processing, 1, records[id(tweet)])
+            await pipe.execute()
+
+
+@traced("flush_digests", root=True)
+async def flush_digests(context: CallbackContext) -> None:
+    """Send the digests that are due, scheduled on every replica like send_tweets."""
+    for chat_id in await redis_client.zrangebyscore("tweets:digest:due", 0, time.time()):
+        # removing the entry claims the digest, so no two replicas send it
+        if not await redis_client.zrem("tweets:digest:due", chat_id):
+            continue
+
+        # claimed records move to our processing list, the leader returns those of dead replicas to the buffer
+        key = f"tweets:digest:{chat_id}"
+        processing = digest_processing_key(chat_id)
+        while await redis_client.lmove(key, processing, "LEFT", "RIGHT"):
+            pass
+        items = await redis_client.lrange(processing, 0, -1)
+        if not items:
+            continue
+
+        try:
+            await send_digest(items, context, int(chat_id), processing)
+        except (Forbidden, BadRequest) as e:
+            # the bot was blocked or removed, or the chat is gone, retrying won't help
+            logger.warning(f"Dropping digest of {len(items)} tweets to {chat_id}: {e}")
+            await redis_client.delete(processing, key)
+        except Exception as e:
+            logger.error(f"Error sending digest of {len(items)} tweets to {chat_id}: {e}", exc_info=True)
+
+            # what wasn't sent yet goes back in front of tweets buffered meanwhile, and is retried with the next round
+            while await redis_client.lmove(processing, key, "RIGHT", "LEFT"):
+                pass
+            await redis_client.zadd("tweets:digest:due", {chat_id: time.time() + TWEET_DIGEST_RETRY_DELAY})
+
+
+def parse_tweet(tweet: dict) -> dict:
+    """Convert a tweet of the syndication timeline into the shape of api.fxtwitter.com's `tweet` object."""
+    user = tweet['user']
+    screen_name = user['screen_name']
+    retweeted = tweet.get('retweeted_status')
+    source = retweeted or tweet
+
+    text = source.get('full_text') or source.get('text') or ''
+    if 'display_text_range' in source:
+        # drops the trailing t.co links of attached media
+        text = text[:source['display_text_range'][1]]
+    for entity in source.get('entities', {}).get('urls', []):
+        text = text.replace(entity['url'], entity.get('expanded_url') or entity['url'])
+    text = html.unescape(text).strip()
+    if retweeted:
+        text = f"RT @{retweeted['user']['screen_name']}: {text}"
+
+    medias = []
+    for media in source.get('extended_entities', {}).get('media') or source.get('mediaDetails') or []:
+        if media['type'] == 'photo':
+            medias.append({'type': 'photo', 'url': media['media_url_https']})
+        elif media['type'] in ('video', 'animated_gif'):
+            video = {
+                'type': 'video' if media['type'] == 'video' else 'gif',
+                'url': None,
+                'variants': media.get('video_info', {}).get('variants', []),
+                'thumbnail_url': media['media_url_https']
+            }
+            if media.get('video_info', {}).get('duration_millis'):
+                video['duration'] = media['video_info']['duration_millis'] / 1000
+            video['url'] = video_url(video)
+            medias.append(video)
+
+    record = {
+        'id': tweet['id_str'],
+        'url': f"https://x.com/{screen_name}/status/{tweet['id_str']}",
+        'text': text,
+        'created_timestamp': int(datetime.strptime(tweet['created_at'], "%a %b %d %H:%M:%S %z %Y").timestamp()),
+        'author': {
+            'name': user.get('name', screen_name),
+            'screen_name': screen_name,
+            'url': f"https://x.com/{screen_name}"
+        },
+        'retweet': retweeted is not None
+    }
+    if medias:
+        record['media'] = {'all': medias}
+    if source.get('quoted_status'):
+        quote = parse_tweet(source['quoted_status'])
+        quote.pop('quote', None)
+        record['quote'] = quote
+    return record
+
+
+def parse_timeline(page: str) -> list[dict] | None:
+    """Tweet records of a syndication timeline page, None if the page carries no __NEXT_DATA__."""
+    match = NEXT_DATA_REGEX.search(page)
+    if not match:
+        return None
+
+    data = json.loads(match.group(1))
+    entries = data.get('props', {}).get('pageProps', {}).get('timeline', {}).get('entries', [])
+
+    tweets = []
+    for entry in entries:
+        if entry.get('type') != 'tweet':
+            continue
+        try:
+            tweets.append(parse_tweet(entry['content']['tweet']))
+        except (KeyError, ValueError) as e:
+            twitter_logger.warning(f"Skipping unparsable timeline entry {entry.get('entry_id')}: {e!r}")
+    return tweets
+
+
+def should_enqueue(tweet: dict) -> bool:
+    if IGNORE_RETWEETS and tweet['retweet']:
+        return False
+    if SEND_ONLY_WITH_MEDIA and 'media' not in tweet:
+        return False
+    return True
+
+
+async def fetch_tweets(twitter_id: str) -> list[dict]:
+    """
+    Fetch the timeline of a user, returns tweet records passing the retweet / media filters, or {'id', 'url'}
+    stubs found by regex when the page has no __NEXT_DATA__.
+    """
     logger.debug(f"Fetching tweets for {twitter_id}")
 
-    # visit https://syndication.twitter.com/srv/timeline-profile/screen-name/{twitter_id}, regex all x.com/@twitter_id/status/...
-    # and return the list of tweets
     async with httpx.AsyncClient() as client:
         response = await client.get(
             f"https://syndication.twitter.com/srv/timeline-profile/screen-name/{twitter_id}",
@@ -347,15 +926,25 @@ async def fetch_tweets(twitter_id: str) -> list[str]:
             timeout=10,
         )
         if SAVE_TWITTER_RESPONSE:
-            logger.debug(f"Response: {response.text}")
-        # tweet_ids = re.findall(r"tweet-(\d{19})", response.text)
-        # tweet_urls = [f"https://x.com/{twitter_id}/status/{tweet_id}" for tweet_id in tweet_ids]
-        tweet_urls = re.findall(r"https://x\.com/{twitter_id}/status/(\d+)", response.text)
-        return tweet_urls
+            twitter_logger.debug(f"Response: {response.text}")
+
+    tweets = parse_timeline(response.text)
+    if tweets is not None:
+        return [tweet for tweet in tweets if should_enqueue(tweet)]
 
+    twitter_logger.warning(f"No __NEXT_DATA__ in the timeline of @{twitter_id}, falling back to regex")
+    post_ids = dict.fromkeys(re.findall(rf"https://(?:x|twitter)\.com/{re.escape(twitter_id)}/status/(\d+)", response.text, re.IGNORECASE))
+    return [{'id': post_id, 'url': f"https://x.com/{twitter_id}/status/{post_id}"} for post_id in post_ids]
 
+
+@traced("check_for_new_tweets", root=True)
 async def check_for_new_tweets(context: CallbackContext) -> None:
+    if not is_leader():
+        logger.debug("Not the leader, skipping tweet check")
+        return
+
     logger.debug("Checking for new tweets...")
+    token = fencing_token()
 
     # Get all Twitter usernames we're watching
     twitter_usernames = set()
@@ -372,53 +961,110 @@ async def check_for_new_tweets(context: CallbackContext) -> None:
     logger.debug(f"Randomly selected @{username} to check")
 
     try:
-        tweet_urls = await fetch_tweets(username)
-        for tweet_url in tweet_urls:
-            # Extract post ID from URL
-            post_id = tweet_url.split("/")[-1]
-            # Check if tweet was already sent
-            if await redis_client.exists(f"tweets:sent:{username}:{post_id}"):
-                continue
-
-            # Add to queue
-            await redis_client.rpush(f"tweets:urls:queue", tweet_url)
-            # Mark as sent
-            await redis_client.set(f"tweets:sent:{username}:{post_id}", 1)
+        tweets = await fetch_tweets(username)
+        for tweet in tweets:
+            # full records are queued as JSON, regex stubs as plain URLs that are fetched when sent
+            item = json.dumps(tweet, ensure_ascii=False) if 'created_timestamp' in tweet else tweet['url']
+            # Queue the tweet unless it was already sent, as long as we're still the leader
+            result = await _enqueue_tweet(
+                keys=[LEADER_TOKEN_KEY, f"tweets:sent:{username}:{tweet['id']}", "tweets:urls:queue"],
+                args=[token, item]
+            )
+            if result == -1:
+                logger.warning(f"Fencing token {token} is stale, stopping tweet check for @{username}")
+                return
 
     except Exception as e:
         logger.error(f"Error checking tweets for @{username}: {e}", exc_info=True)
 
 
+@traced("send_tweets", root=True)
 async def send_tweets(context: CallbackContext) -> None:
     logger.debug("Sending queued tweets...")
 
-    # Get all queued tweet URLs
-    tweet_urls = await redis_client.lrange(f"tweets:urls:queue", 0, -1)
-    if not tweet_urls:
-        return
+    processing = processing_key()
 
-    for tweet_url in tweet_urls:
-        try:
-            # Extract username from URL
-            username = tweet_url.split("/")[3].lower()
+    # Items this instance claimed before but never finished come first
+    items = await redis_client.lrange(processing, 0, -1)
 
-            # Get target users
-            target_users = await redis_client.smembers(f"tweets:targets:user:{username}")
-            if not target_users:
-                continue
+    # Claim a batch from the shared queue, other replicas claim the rest
+    for _ in range(SEND_BATCH_SIZE):
+        item = await redis_client.lmove("tweets:urls:queue", processing, "LEFT", "RIGHT")
+        if item is None:
+            break
+        items.append(item)
 
-            # Send to each target user
-            for user_id in target_users:
-                await send_tweet(
-                    url=tweet_url,
-                    context=context,
-                    user_id=int(user_id),
-                    chat_id=int(user_id),
-                    can_ignore=True
-                )
-
-            # Remove from queue
-            await redis_client.lrem(f"tweets:urls:queue", 1, tweet_url)
+    if not items:
+        return
 
-        except Exception as e:
-            logger.error(f"Error sending tweet {tweet_url}: {e}", exc_info=True)
+    # legacy items are tweet URLs, they're fetched so they're sent (or buffered for digests) like records
+    records = await asyncio.gather(*(queued_record(item) for item in items), return_exceptions=True)
+
+    tweets, done = [], []
+    for item, record in zip(items, records):
+        if isinstance(record, Exception):
+            logger.error(f"Error fetching queued tweet {item}: {record}")
+            tweet = None
+        elif record is None:
+            # deleted since it was queued
+            await redis_client.lrem(processing, 1, item)
+            continue
+        else:
+            tweet = dict(record)
+        tweets.append((item, tweet))
+        # chats a requeued item was already delivered to
+        done.append(set(tweet.pop('done', [])) if tweet else set())
+
+    # Captions of all claimed tweets are built concurrently, so their translations are batched into few LLM
+    # requests, the tweets are still sent one by one in queue order
+    targets = []
+    for (item, tweet), done_targets in zip(tweets, done):
+        tweet_url = tweet['url'] if tweet else item
+        target_users = await redis_client.smembers(f"tweets:targets:user:{tweet_url.split('/')[3].lower()}")
+        targets.append({user_id for user_id in target_users if int(user_id) not in done_targets})
+
+    intervals = {}
+    for user_id in set().union(*targets):
+        intervals[user_id] = await digest_interval(int(user_id))
+
+    # tweets for chats in digest mode are buffered as they are, without a caption
+    captions = {}
+    for index, ((item, tweet), target_users) in enumerate(zip(tweets, targets)):
+        if tweet:
+            for user_id in target_users:
+                if not intervals[user_id]:
+                    captions[index, int(user_id)] = tweet_caption(tweet, int(user_id))
+    captions = dict(zip(captions, await asyncio.gather(*captions.values(), return_exceptions=True)))
+
+    for index, ((item, tweet), target_users, done_targets) in enumerate(zip(tweets, targets, done)):
+        if tweet is None:
+            # couldn't be fetched, retried as a whole
+            failed = True
+        else:
+            failed = False
+            for user_id in target_users:
+                try:
+                    if intervals[user_id]:
+                        await buffer_for_digest(json.dumps(tweet, ensure_ascii=False), int(user_id), intervals[user_id])
+                    else:
+                        caption = captions[index, int(user_id)]
+                        if isinstance(caption, Exception):
+                            raise caption
+                        await deliver_tweet(tweet, context, int(user_id), int(user_id), can_ignore=True, caption=caption)
+                    done_targets.add(int(user_id))
+                except Exception as e:
+                    logger.error(f"Error sending tweet {tweet['url']} to {user_id}: {e}", exc_info=True)
+                    failed = True
+
+        if not failed:
+            # Remove from our claimed items
+            await redis_client.lrem(processing, 1, item)
+            continue
+
+        # Hand it back to the shared queue so it's retried, possibly by another replica, but only for the chats
+        # that didn't get it yet
+        retry = json.dumps({**tweet, 'done': sorted(done_targets)}, ensure_ascii=False) if tweet else item
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.lrem(processing, 1, item)
+            pipe.rpush("tweets:urls:queue", retry)
+            await pipe.execute()
@@ -0,0 +1,143 @@
+"""
+usage.py
+
+Per-user token accounting and token quotas.
+
+Every LLM request made on behalf of a user (chat replies, translations, summaries) records the prompt and completion
+tokens the API reported (streamed requests ask for them with stream_options.include_usage), or an estimate when the
+endpoint doesn't report usage. Failed requests that were likely billed anyway (timeouts, streams that broke midway)
+record an estimate too. Quotas count prompt + completion tokens of all models, 0 means unlimited.
+
+Redis key structure:
+- user:{user_id}:usage:daily:{YYYYMMDD} -> hash, {model}:prompt / {model}:completion / {model}:requests -> count  # Expires after 2 days
+- user:{user_id}:usage:monthly:{YYYYMM} -> hash, same fields  # Expires after 32 days
+- user:{user_id}:token_quota_daily -> int  # Overrides TOKEN_QUOTA_DAILY for this user
+- user:{user_id}:token_quota_monthly -> int  # Overrides TOKEN_QUOTA_MONTHLY for this user
+"""
+
+import os
+from datetime import datetime, timezone
+
+import openai
+
+from core import logger, redis_client
+from tokens import count_message_tokens, count_tokens
+
+TOKEN_QUOTA_DAILY = int(os.getenv('TOKEN_QUOTA_DAILY', 0))
+TOKEN_QUOTA_MONTHLY = int(os.getenv('TOKEN_QUOTA_MONTHLY', 0))
+# some OpenAI compatible endpoints reject stream_options, set to false for those
+OPENAI_STREAM_USAGE = os.getenv('OPENAI_STREAM_USAGE', 'true').lower() == 'true'
+
+DAILY_TTL = 2 * 24 * 60 * 60
+MONTHLY_TTL = 32 * 24 * 60 * 60
+
+
+def stream_options() -> dict:
+    """Extra arguments for streamed chat completions, so the last chunk carries the token usage."""
+    return {"stream_options": {"include_usage": True}} if OPENAI_STREAM_USAGE else {}
+
+
+def usage_keys(user_id: int) -> tuple[str, str]:
+    now = datetime.now(timezone.utc)
+    return f"user:{user_id}:usage:daily:{now:%Y%m%d}", f"user:{user_id}:usage:monthly:{now:%Y%m}"
+
+
+async def record_usage(user_id: int, model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    daily_key, monthly_key = usage_keys(user_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, ttl in ((daily_key, DAILY_TTL), (monthly_key, MONTHLY_TTL)):
+            pipe.hincrby(key, f"{model}:prompt", prompt_tokens)
+            pipe.hincrby(key, f"{model}:completion", completion_tokens)
+            pipe.hincrby(key, f"{model}:requests", 1)
+            pipe.expire(key, ttl)
+        await pipe.execute()
+
+
+def billed_failure(error: Exception, completion: str = "") -> bool:
+    """Whether a failed request probably reached the model and was billed: it timed out or streamed some output."""
+    return bool(completion) or isinstance(error, openai.APITimeoutError)
+
+
+async def record_response_usage(user_id: int | None, model: str, usage, messages: list[dict], completion: str) -> None:
+    """Record the usage reported with a response, or estimate it from the messages and completion text."""
+    if user_id is None:
+        return
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens, completion_tokens = count_message_tokens(messages, model), count_tokens(completion, model)
+
+    try:
+        await record_usage(user_id, model, prompt_tokens, completion_tokens)
+    except Exception as e:
+        # accounting must never fail the reply itself
+        logger.error(f"Failed to record token usage of user {user_id}: {e}")
+
+
+async def record_shared_usage(weights: dict[int | None, int], model: str, usage, messages: list[dict], completion: str) -> None:
+    """Split the usage of one request made for several users (batched translations) by their weights."""
+    if usage is not None:
+        prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+    else:
+        prompt_tokens, completion_tokens = count_message_tokens(messages, model), count_tokens(completion, model)
+
+    total = sum(weights.values()) or 1
+    for user_id, weight in weights.items():
+        if user_id is None:
+            continue
+        try:
+            await record_usage(user_id, model, prompt_tokens * weight // total, completion_tokens * weight // total)
+        except Exception as e:
+            logger.error(f"Failed to record token usage of user {user_id}: {e}")
+
+
+def summarize_usage(usage: dict[str, str]) -> dict[str, dict[str, int]]:
+    """{model: {"prompt": n, "completion": n, "requests": n}} of a usage hash."""
+    models: dict[str, dict[str, int]] = {}
+    for field, value in usage.items():
+        model, _, kind = field.rpartition(":")
+        models.setdefault(model, {"prompt": 0, "completion": 0, "requests": 0})[kind] = int(value)
+    return models
+
+
+def total_tokens(models: dict[str, dict[str, int]]) -> int:
+    return sum(counts["prompt"] + counts["completion"] for counts in models.values())
+
+
+async def get_usage(user_id: int) -> tuple[dict, dict, int, int]:
+    """Returns (daily usage, monthly usage, daily quota, monthly quota) of a user."""
+    daily_key, monthly_key = usage_keys(user_id)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(daily_key)
+        pipe.hgetall(monthly_key)
+        pipe.get(f"user:{user_id}:token_quota_daily")
+        pipe.get(f"user:{user_id}:token_quota_monthly")
+        daily, monthly, daily_quota, monthly_quota = await pipe.execute()
+
+    return (
+        summarize_usage(daily),
+        summarize_usage(monthly),
+        int(daily_quota) if daily_quota is not None else TOKEN_QUOTA_DAILY,
+        int(monthly_quota) if monthly_quota is not None else TOKEN_QUOTA_MONTHLY
+    )
+
+
+async def quota_exceeded(user_id: int) -> str | None:
+    """Returns a message for the user if their daily or monthly token quota is used up."""
+    daily, monthly, daily_quota, monthly_quota = await get_usage(user_id)
+    if daily_quota and total_tokens(daily) >= daily_quota:
+        return f"Daily token quota reached ({total_tokens(daily)}/{daily_quota} tokens), please try again tomorrow (UTC)."
+    if monthly_quota and total_tokens(monthly) >= monthly_quota:
+        return f"Monthly token quota reached ({total_tokens(monthly)}/{monthly_quota} tokens)."
+    return None
+
+
+async def format_usage(user_id: int) -> str:
+    daily, monthly, daily_quota, monthly_quota = await get_usage(user_id)
+
+    lines = []
+    for title, models, quota in (("today", daily, daily_quota), ("this month", monthly, monthly_quota)):
+        lines.append(f"- Tokens {title}: {total_tokens(models)}" + (f"/{quota}" if quota else ""))
+        for model, counts in sorted(models.items()):
+            lines.append(f"  - {model}: {counts['prompt']} prompt + {counts['completion']} completion, {counts['requests']} requests")
+    return "\n".join(lines)
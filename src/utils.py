@@ -2,9 +2,14 @@
 utils.py
 
 Aims to clean out LLM output, cleans out non-existing HTML tags, and closes open tags
+
+Redis key structure:
+- web:content:{sha1 of url} -> fetched page text, already capped  # Expires after WEB_CONTENT_CACHE_TTL, error responses after WEB_CONTENT_ERROR_CACHE_TTL
 """
 
 import asyncio
+import hashlib
+import importlib
 from html.parser import HTMLParser
 import httpx
 from datetime import datetime, timedelta
@@ -15,12 +20,24 @@ from telegram.ext import ContextTypes, CallbackContext
 import os
 
 from core import logger, redis_client
+from extract import extract_content
+from tokens import trim_to_token_budget
+from tracing import traced
 
 T = TypeVar('T')
 
 ADMIN_CHAT_ID_LIST = [int(id) for id in os.getenv('ADMIN_CHAT_ID_LIST', '').split(',') if id]
 
+WEB_CONTENT_MAX_BYTES = int(os.getenv('WEB_CONTENT_MAX_BYTES', 2 * 1024 * 1024))
+WEB_CONTENT_TIMEOUT = float(os.getenv('WEB_CONTENT_TIMEOUT', 15))
+WEB_CONTENT_CACHE_TTL = int(os.getenv('WEB_CONTENT_CACHE_TTL', 60 * 60))
+# error responses (4xx / 5xx, unsupported content types) are likely transient, they are only cached briefly
+WEB_CONTENT_ERROR_CACHE_TTL = int(os.getenv('WEB_CONTENT_ERROR_CACHE_TTL', 60))
+WEB_CONTENT_TOKEN_BUDGET = int(os.getenv('WEB_CONTENT_TOKEN_BUDGET', 8000))
+TEXT_CONTENT_TYPES = ("text/", "application/json", "application/xml", "application/xhtml+xml", "application/ld+json")
+
 
+@traced("get_redis_value")
 async def get_redis_value(key: str, default: Optional[T] = None) -> Optional[str]:
     """
     Get a value from Redis and decode it from bytes to string.
@@ -59,6 +76,7 @@ def split_content_by_delimiter(content: str, delimiter: str, chunk_size: int = 2
 ACCEPTABLE_HTML_TAGS = ["b", "strong", "i", "em", "code", "s", "strike", "del", "pre"]
 
 
+@traced("clean_html")
 def clean_html(html: str) -> str:
     tag_stack = []
     result = ""
@@ -101,50 +119,113 @@ def clean_html(html: str) -> str:
     return result
 
 
-TAGS_TO_KEEP = ["body", "h1", "h2", "h3", "h4", "h5", "h6", "p", "a", "ul", "ol", "li", "blockquote", "code", "pre",
-                "table", "thead", "tbody", "tfoot", "tr", "td", "th", "article"]
-ATTRIBUTES_TO_KEEP = ["alt"]
+class _FlightAbandoned(Exception):
+    """The caller running a flight was cancelled, its followers start over."""
 
 
-def clean_web_html(html: str) -> str:
+class SingleFlight:
     """
-    Cleans out comments, scripts, css, and other non-content tags and attributes.
+    Deduplicate concurrent calls by key: while a call for a key is in flight, later callers await the same
+    result instead of starting their own. If the caller running it is cancelled, the others don't inherit the
+    cancellation, one of them runs the call again.
     """
-    result = ""
-    tag_stack = []
 
-    class HTMLCleaner(HTMLParser):
-        def handle_starttag(self, tag, attrs):
-            nonlocal result
-            tag_stack.append(tag)
-            if tag in TAGS_TO_KEEP:
-                result += f"<{tag}"
-                for attr, value in attrs:
-                    if attr in ATTRIBUTES_TO_KEEP:
-                        result += f" {attr}=\"{value}\""
-                result += ">"
+    def __init__(self):
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, func: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        while key in self._in_flight:
+            try:
+                return await asyncio.shield(self._in_flight[key])
+            except _FlightAbandoned:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            # mark retrieved, followers (if any) re-raise it themselves
+            future.exception()
+            raise
+        except BaseException:
+            future.set_exception(_FlightAbandoned())
+            future.exception()
+            raise
+        finally:
+            del self._in_flight[key]
+
+
+web_content_flights = SingleFlight()
+
+
+async def fetch_web_content(url: str) -> tuple[str, bool]:
+    """
+    Stream the response body and stop at WEB_CONTENT_MAX_BYTES, non-text responses are aborted as soon as
+    their headers arrive. Returns (text, whether the response was a success).
+    """
+    async with httpx.AsyncClient(timeout=WEB_CONTENT_TIMEOUT, follow_redirects=True) as client:
+        async with client.stream("GET", url) as response:
+            content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+            if content_type and not content_type.startswith(TEXT_CONTENT_TYPES):
+                return f"[{response.status_code}] Unsupported content type: {content_type}", False
+
+            body = bytearray()
+            truncated = False
+            async for chunk in response.aiter_bytes():
+                body.extend(chunk)
+                if len(body) >= WEB_CONTENT_MAX_BYTES:
+                    del body[WEB_CONTENT_MAX_BYTES:]
+                    truncated = True
+                    break
+
+            text = body.decode(response.encoding or "utf-8", errors="replace")
+            if content_type in ("", "text/html", "application/xhtml+xml"):
+                # pure Python parsing of a large page takes a while, keep the event loop responsive
+                text = await asyncio.to_thread(extract_content, text)
+            if response.status_code >= 400:
+                text = f"[{response.status_code}] {text}"
+            if truncated:
+                text += f"\n\n[truncated at {WEB_CONTENT_MAX_BYTES} bytes]"
+            return text, response.status_code < 400
+
+
+@traced("get_web_content")
+async def get_web_content(url: str) -> str:
+    cache_key = f"web:content:{hashlib.sha1(url.encode()).hexdigest()}"
 
-        def handle_endtag(self, tag):
-            nonlocal result
-            tag_stack.pop()
-            if tag in TAGS_TO_KEEP:
-                result += f"</{tag}>"
+    async def fetch_and_cache() -> str:
+        content = await redis_client.get(cache_key)
+        if content is None:
+            content, ok = await fetch_web_content(url)
+            await redis_client.set(cache_key, content, ex=WEB_CONTENT_CACHE_TTL if ok else WEB_CONTENT_ERROR_CACHE_TTL)
+        return content
 
-        def handle_data(self, data):
-            nonlocal result
-            if tag_stack and tag_stack[-1] in TAGS_TO_KEEP:
-                result += data
+    try:
+        content = await web_content_flights.do(url, fetch_and_cache)
+    except httpx.HTTPError as e:
+        logger.warning(f"Failed to fetch {url}: {e!r}")
+        return f"Failed to fetch {url}: {e!r}"
 
-    parser = HTMLCleaner()
-    parser.feed(html)
-    return result
+    return trim_to_token_budget(content, WEB_CONTENT_TOKEN_BUDGET)
 
 
-async def get_web_content(url: str) -> str:
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        return response.text
-        # return clean_web_html(response.text)
+def lazy_function(module_name: str, function_name: str) -> Callable[..., Coroutine]:
+    """
+    Return a coroutine function that imports `module_name` on its first call and forwards to `function_name`.
+
+    Used for optional subsystems (tweet, pixiv) so their environment checks and dependencies are only
+    loaded once a feature is actually used.
+    """
+    async def call(*args, **kwargs):
+        module = importlib.import_module(module_name)
+        return await getattr(module, function_name)(*args, **kwargs)
+
+    call.__name__ = function_name
+    return call
 
 
 def rate_limit(time_window: timedelta, limit: int):
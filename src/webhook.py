@@ -0,0 +1,126 @@
+"""
+webhook.py
+
+Serves the bot over a webhook instead of long polling, enabled with BOT_MODE=webhook.
+
+Routes:
+- POST {WEBHOOK_PATH} -> Telegram Update JSON, checked against the X-Telegram-Bot-Api-Secret-Token header
+- GET /healthz -> 200 when the application is running and Redis answers, 503 otherwise
+
+The server is meant to sit behind a reverse proxy that terminates TLS, and only listens on 127.0.0.1 unless
+WEBHOOK_LISTEN says otherwise. Every update must carry the secret token; without WEBHOOK_SECRET_TOKEN a random one
+is generated for each run and registered with Telegram. If WEBHOOK_URL is not set the webhook is not registered
+with Telegram, which is handy for local testing with a fixed WEBHOOK_SECRET_TOKEN, e.g.:
+
+curl -X POST -H 'Content-Type: application/json' -H 'X-Telegram-Bot-Api-Secret-Token: <secret>' \
+    --data @update.json http://localhost:8080/telegram
+"""
+
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import signal
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from core import logger, redis_client
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8080))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+
+
+def build_web_app(app: Application, secret_token: str) -> web.Application:
+    async def handle_update(request: web.Request) -> web.Response:
+        request_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(request_token.encode(), secret_token.encode()):
+            logger.warning(f"Rejected webhook request from {request.remote} with invalid secret token")
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return web.Response(status=400, text="Invalid JSON")
+        if not isinstance(data, dict):
+            return web.Response(status=400, text="Invalid update")
+
+        try:
+            update = Update.de_json(data, app.bot)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Rejected malformed update from {request.remote}: {e!r}")
+            return web.Response(status=400, text="Invalid update")
+        if update is None:
+            return web.Response(status=400, text="Invalid update")
+
+        await app.update_queue.put(update)
+        return web.Response()
+
+    async def handle_health(request: web.Request) -> web.Response:
+        try:
+            redis_ok = await redis_client.ping()
+        except Exception as e:
+            logger.warning(f"Health check failed to reach Redis: {e}")
+            redis_ok = False
+
+        healthy = app.running and redis_ok
+        return web.json_response(
+            {"status": "ok" if healthy else "unavailable", "running": app.running, "redis": redis_ok},
+            status=200 if healthy else 503
+        )
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, handle_update)
+    web_app.router.add_get('/healthz', handle_health)
+    return web_app
+
+
+async def run_webhook(app: Application) -> None:
+    """Run the application until SIGINT/SIGTERM, feeding it updates received on the webhook endpoint."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    secret_token = WEBHOOK_SECRET_TOKEN
+    if not secret_token:
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET_TOKEN not set, using a random secret token for this run")
+
+    runner = web.AppRunner(build_web_app(app, secret_token))
+    await runner.setup()
+
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+        await app.start()
+
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=secret_token,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook registered at {WEBHOOK_URL} (max_connections={WEBHOOK_MAX_CONNECTIONS})")
+        else:
+            logger.warning("WEBHOOK_URL not set, the webhook is not registered with Telegram")
+
+        site = web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT)
+        await site.start()
+        logger.info(f"Listening for updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        try:
+            await stop_event.wait()
+        finally:
+            logger.info("Stopping webhook server...")
+            await runner.cleanup()
+            await app.stop()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
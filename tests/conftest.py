@@ -0,0 +1,38 @@
+"""
+Shared setup of the tests: src/ on the path, and a fake Redis for the modules that use core.redis_client.
+
+Redis backed tests run against fakeredis (with lupa for the Lua scripts), they are skipped when it isn't installed:
+
+pip install fakeredis lupa
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+os.environ.setdefault("LOG_DIR", os.path.join(tempfile.gettempdir(), "personal-bot-tests"))
+os.environ.setdefault("TWITTER_COOKIE", "test")
+
+
+@pytest.fixture
+def redis():
+    """core.redis_client, connected to an empty fake Redis for the duration of the test."""
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    from redis.asyncio import ConnectionPool
+
+    from core import redis_client
+
+    original_pool = redis_client.connection_pool
+    redis_client.connection_pool = ConnectionPool(
+        connection_class=fakeredis.aioredis.FakeAsyncRedisConnection,
+        server=fakeredis.FakeServer(),
+        decode_responses=True
+    )
+    try:
+        yield redis_client
+    finally:
+        redis_client.connection_pool = original_pool
@@ -0,0 +1,78 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from extract import extract_content  # noqa: E402
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "extract")
+
+
+def extract_fixture(name: str, markdown: bool = True) -> str:
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return extract_content(f.read(), markdown)
+
+
+def test_unclosed_head_is_closed_by_body():
+    output = extract_fixture("news_unclosed_head.html")
+
+    assert output.startswith("# City council approves new bike lanes\n\n")
+    assert "twelve kilometres of protected bike lanes" in output
+    assert "some shop owners worried about losing parking spaces" in output
+    assert "the first section, along the river, should open" in output
+    assert "Most read" not in output
+    assert "Weather warning" not in output
+    assert "Copyright" not in output
+    assert "dataLayer" not in output
+
+
+def test_blog_post_keeps_structure_and_drops_boilerplate():
+    output = extract_fixture("blog_post.html")
+
+    assert "## Finding slow callbacks" in output
+    assert "```\nloop.set_debug(True)\nloop.slow_callback_duration = 0.05\n```" in output
+    assert "- Run CPU bound work in a thread or process pool." in output
+    assert "Share this" not in output
+    assert "Great write-up" not in output
+    assert "Leave a reply" not in output
+    assert "Proudly powered by WordPress" not in output
+    assert "Skip to content" not in output
+
+
+def test_malformed_forum_thread():
+    output = extract_fixture("forum_malformed.html")
+
+    assert output.startswith("# Re: Router keeps dropping the connection - Example Forums\n\n")
+    assert "My router drops the connection every evening around nine" in output
+    assert "Has anyone seen this before, or knows what to check next?" in output
+    assert "var forum" not in output
+    assert "Forum index" not in output
+    assert "Sent from my phone" not in output
+
+
+def test_svg_titles_are_not_the_page_title():
+    output = extract_fixture("listing_svg_icons.html")
+
+    assert output.startswith("# 3-bedroom house with garden in Riverside | RealHome\n\n")
+    assert "open kitchen, a living room with large windows" in output
+    assert "logo" not in output
+    assert "Open menu" not in output
+    assert "Bedrooms" not in output
+
+
+def test_plain_text_output():
+    output = extract_fixture("blog_post.html", markdown=False)
+
+    assert output.startswith("Profiling asyncio applications – Notes on Python\n\n")
+    assert "#" not in output
+    assert "```" not in output
+
+
+def test_head_without_body_tag():
+    html = "<html><head><title>T</title><article><p>Body text that is long enough to count, with a comma.</p>"
+    assert extract_content(html) == "# T\n\nBody text that is long enough to count, with a comma."
+
+
+def test_head_content_is_skipped_until_closed():
+    html = "<head><title>T</title><noscript><img src=x></noscript><style>p{}</style></head><p>Visible paragraph, long enough to count.</p>"
+    assert extract_content(html) == "# T\n\nVisible paragraph, long enough to count."
@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+import pytest
+
+import leader
+import tweet
+from leader import LEADER_KEY, LEADER_TOKEN_KEY, INSTANCE_ID
+
+
+@pytest.fixture(autouse=True)
+def no_lease():
+    leader._fencing_token = 0
+    yield
+    leader._fencing_token = 0
+
+
+async def take_over(redis, instance_id: str) -> int:
+    """Let another replica take the lease, as if ours expired while we were paused."""
+    await redis.delete(LEADER_KEY)
+    return int(await leader._acquire_or_renew(keys=[LEADER_KEY, LEADER_TOKEN_KEY], args=[instance_id, 30000]))
+
+
+def test_heartbeat_acquires_and_renews_the_lease(redis):
+    async def run():
+        await leader.leader_heartbeat()
+        assert leader.is_leader()
+        token = leader.fencing_token()
+
+        await leader.leader_heartbeat()
+        assert leader.fencing_token() == token
+        assert await redis.get(LEADER_KEY) == INSTANCE_ID
+        assert await redis.exists(f"bot:instances:{INSTANCE_ID}")
+
+    asyncio.run(run())
+
+
+def test_heartbeat_does_not_take_a_held_lease(redis):
+    async def run():
+        await take_over(redis, "other")
+        await leader.leader_heartbeat()
+        assert not leader.is_leader()
+
+    asyncio.run(run())
+
+
+def test_heartbeat_steps_down_when_redis_fails(redis, monkeypatch):
+    async def run():
+        await leader.leader_heartbeat()
+        assert leader.is_leader()
+
+        async def fail(*args, **kwargs):
+            raise ConnectionError("redis is gone")
+
+        monkeypatch.setattr(redis, "set", fail)
+        await leader.leader_heartbeat()
+        assert not leader.is_leader()
+
+    asyncio.run(run())
+
+
+def test_stale_leader_cannot_enqueue(redis, monkeypatch):
+    record = {"id": "1", "url": "https://x.com/alice/status/1", "text": "hi", "created_timestamp": 1}
+
+    async def fetch_tweets(username):
+        return [record]
+
+    monkeypatch.setattr(tweet, "fetch_tweets", fetch_tweets)
+
+    async def run():
+        await redis.sadd("tweets:targets:user:alice", "1")
+        await leader.leader_heartbeat()
+        newer_token = await take_over(redis, "other")
+        assert newer_token > leader.fencing_token()
+
+        # still believes it's the leader until its next heartbeat
+        await tweet.check_for_new_tweets(None)
+        assert await redis.llen("tweets:urls:queue") == 0
+        assert not await redis.exists("tweets:sent:alice:1")
+
+    asyncio.run(run())
+
+
+def test_leader_enqueues_each_tweet_once(redis, monkeypatch):
+    record = {"id": "1", "url": "https://x.com/alice/status/1", "text": "hi", "created_timestamp": 1}
+
+    async def fetch_tweets(username):
+        return [record]
+
+    monkeypatch.setattr(tweet, "fetch_tweets", fetch_tweets)
+
+    async def run():
+        await redis.sadd("tweets:targets:user:alice", "1")
+        await leader.leader_heartbeat()
+        await tweet.check_for_new_tweets(None)
+        await tweet.check_for_new_tweets(None)
+        assert [json.loads(item) for item in await redis.lrange("tweets:urls:queue", 0, -1)] == [record]
+
+    asyncio.run(run())
+
+
+def test_requeue_items_of_dead_instances_only(redis):
+    async def run():
+        await redis.rpush(leader.processing_key("dead"), "a", "b")
+        await redis.rpush(leader.processing_key("alive"), "c")
+        await redis.set("bot:instances:alive", 1)
+        await redis.rpush("tweets:digest:-100", "newer")
+        await redis.rpush(leader.digest_processing_key(-100, "dead"), "older1", "older2")
+        await redis.zadd("tweets:digest:due", {"-100": 12345})
+
+        await leader.requeue_orphaned_tweets()
+
+        assert await redis.lrange("tweets:urls:queue", 0, -1) == ["a", "b"]
+        assert await redis.lrange(leader.processing_key("alive"), 0, -1) == ["c"]
+        assert await redis.lrange("tweets:digest:-100", 0, -1) == ["older1", "older2", "newer"]
+        assert await redis.zscore("tweets:digest:due", "-100") == 0
+
+    asyncio.run(run())
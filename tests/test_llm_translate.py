@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+
+import llm_translate
+from llm_translate import TranslationBatcher
+
+ENDPOINT = "https://llm.example.com/v1"
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """Batches and single texts sent to the LLM; set `batch_reply` to None to make batches unsplittable."""
+    sent = {"batches": [], "single": [], "batch_reply": True, "error": None}
+
+    async def _translate_batch(client, texts, openai_api_endpoint, model, weights):
+        sent["batches"].append((model, texts, weights))
+        if sent["error"] is not None:
+            raise sent["error"]
+        return [f"译:{text}" for text in texts] if sent["batch_reply"] else None
+
+    async def _translate_text(client, text, openai_api_endpoint, model, user_id, *args, **kwargs):
+        sent["single"].append(text)
+        if sent["error"] is not None:
+            raise sent["error"]
+        return f"单:{text}"
+
+    monkeypatch.setattr(llm_translate, "_translate_batch", _translate_batch)
+    monkeypatch.setattr(llm_translate, "_translate_text", _translate_text)
+    return sent
+
+
+def translate_all(batcher: TranslationBatcher, texts: list[str], model: str = "model", user_id: int = 1):
+    return [batcher.translate(text, "key", ENDPOINT, model, user_id) for text in texts]
+
+
+def test_concurrent_texts_are_sent_as_one_batch(llm):
+    async def run():
+        batcher = TranslationBatcher(window=0.01, token_budget=1000, max_items=10)
+        results = await asyncio.gather(*translate_all(batcher, ["a", "b", "c"]))
+        assert results == ["译:a", "译:b", "译:c"]
+        assert [texts for _, texts, _ in llm["batches"]] == [["a", "b", "c"]]
+        assert llm["single"] == []
+
+    asyncio.run(run())
+
+
+def test_a_lone_text_is_translated_on_its_own(llm):
+    async def run():
+        batcher = TranslationBatcher(window=0.01, token_budget=1000, max_items=10)
+        assert await batcher.translate("a", "key", ENDPOINT, "model") == "单:a"
+        assert llm["batches"] == []
+
+    asyncio.run(run())
+
+
+def test_batches_are_split_by_size_budget_and_model(llm):
+    async def run():
+        batcher = TranslationBatcher(window=0.01, token_budget=1000, max_items=2)
+        await asyncio.gather(*translate_all(batcher, ["a", "b", "c", "d"]), *translate_all(batcher, ["e", "f"], model="other"))
+        assert sorted(texts for _, texts, _ in llm["batches"]) == [["a", "b"], ["c", "d"], ["e", "f"]]
+
+        llm["batches"].clear()
+        long_text = "word " * 300
+        batcher = TranslationBatcher(window=0.01, token_budget=llm_translate.count_tokens(long_text) + 10, max_items=10)
+        await asyncio.gather(*translate_all(batcher, [long_text, long_text, "short"]))
+        assert [len(texts) for _, texts, _ in llm["batches"]] == [2]
+        assert llm["single"] == [long_text]
+
+    asyncio.run(run())
+
+
+def test_batch_usage_is_weighted_by_user(llm):
+    async def run():
+        batcher = TranslationBatcher(window=0.01, token_budget=1000, max_items=10)
+        await asyncio.gather(*translate_all(batcher, ["a", "b"], user_id=1), *translate_all(batcher, ["c"], user_id=2))
+        [(_, _, weights)] = llm["batches"]
+        assert set(weights) == {1, 2}
+        assert weights[1] == 2 * weights[2]
+
+    asyncio.run(run())
+
+
+def test_unsplittable_batch_falls_back_to_single_texts(llm):
+    llm["batch_reply"] = None
+
+    async def run():
+        batcher = TranslationBatcher(window=0.01, token_budget=1000, max_items=10)
+        assert await asyncio.gather(*translate_all(batcher, ["a", "b"])) == ["单:a", "单:b"]
+        assert llm["single"] == ["a", "b"]
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_caller(llm):
+    llm["error"] = RuntimeError("LLM is down")
+
+    async def run():
+        batcher = TranslationBatcher(window=0.01, token_budget=1000, max_items=10)
+        results = await asyncio.gather(*translate_all(batcher, ["a", "b"]), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert not batcher._sends
+
+    asyncio.run(run())
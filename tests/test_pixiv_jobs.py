@@ -0,0 +1,166 @@
+import asyncio
+
+import pytest
+
+import pixiv_jobs
+from leader import INSTANCE_ID
+from pixiv_jobs import ChunkCheckpoints, coalesced_job
+
+JOB = ("123", "model", "credentials", "stream")
+KEY = "123:model:credentials:stream"
+
+
+async def collect(produce, job=JOB) -> list:
+    return [event async for event in coalesced_job(*job, produce)]
+
+
+class Producer:
+    """Emits `events`, with `pause` it waits after the first one until `resume` is set."""
+
+    def __init__(self, *events, error: Exception | None = None, pause: bool = False):
+        self.events = events
+        self.error = error
+        self.runs = 0
+        self.started = asyncio.Event()
+        self.resume = asyncio.Event()
+        if not pause:
+            self.resume.set()
+
+    async def __call__(self, emit) -> None:
+        self.runs += 1
+        for i, event in enumerate(self.events):
+            await emit(event)
+            if i == 0:
+                self.started.set()
+                await self.resume.wait()
+        if self.error is not None:
+            raise self.error
+
+
+def test_concurrent_requesters_share_one_job(redis):
+    async def run():
+        produce = Producer("a", "b", "c", pause=True)
+        first = asyncio.create_task(collect(produce))
+        await produce.started.wait()
+        # joins after the first event, which is replayed
+        second = asyncio.create_task(collect(produce))
+        await asyncio.sleep(0)
+        produce.resume.set()
+
+        assert await first == ["a", "b", "c"]
+        assert await second == ["a", "b", "c"]
+        assert produce.runs == 1
+        assert not await redis.exists(f"pixiv:jobs:lock:{KEY}")
+
+        # served from the result afterwards
+        assert await collect(Producer("x")) == ["a", "b", "c"]
+        assert await redis.ttl(f"pixiv:jobs:result:{KEY}") > 0
+
+    asyncio.run(run())
+
+
+def test_jobs_are_keyed_by_model_and_credentials(redis):
+    async def run():
+        results = await asyncio.gather(
+            collect(Producer("mine")),
+            collect(Producer("theirs"), ("123", "model", "other credentials", "stream")),
+            collect(Producer("other model"), ("123", "other model", "credentials", "stream"))
+        )
+        assert results == [["mine"], ["theirs"], ["other model"]]
+
+    asyncio.run(run())
+
+
+def test_failed_job_fails_its_followers_and_runs_again(redis):
+    async def run():
+        produce = Producer("a", "b", error=ValueError("LLM is down"), pause=True)
+        first = asyncio.create_task(collect(produce))
+        await produce.started.wait()
+        second = asyncio.create_task(collect(produce))
+        await asyncio.sleep(0)
+        produce.resume.set()
+
+        for requester in (first, second):
+            with pytest.raises(RuntimeError) as error:
+                await requester
+            assert isinstance(error.value.__cause__, ValueError)
+        assert not await redis.exists(f"pixiv:jobs:result:{KEY}")
+        assert not await redis.exists(f"pixiv:jobs:lock:{KEY}")
+
+        assert await collect(Producer("a")) == ["a"]
+
+    asyncio.run(run())
+
+
+def test_cancelled_job_does_not_leave_followers_waiting(redis):
+    async def run():
+        produce = Producer("a", "b", pause=True)
+        follower = asyncio.create_task(collect(produce))
+        await produce.started.wait()
+
+        [task] = pixiv_jobs._job_tasks
+        task.cancel()
+        with pytest.raises(RuntimeError) as error:
+            await asyncio.wait_for(follower, 1)
+        assert isinstance(error.value.__cause__, asyncio.CancelledError)
+        assert KEY not in pixiv_jobs._jobs
+        assert not await redis.exists(f"pixiv:jobs:lock:{KEY}")
+
+    asyncio.run(run())
+
+
+def test_waits_for_the_job_of_another_replica(redis, monkeypatch):
+    monkeypatch.setattr(pixiv_jobs, "JOB_POLL_INTERVAL", 0.01)
+
+    async def run():
+        await redis.set(f"pixiv:jobs:lock:{KEY}", "other instance")
+        produce = Producer("mine")
+        requester = asyncio.create_task(collect(produce))
+        await asyncio.sleep(0.05)
+        assert not requester.done()
+
+        await redis.set(f"pixiv:jobs:result:{KEY}", '["theirs"]')
+        await redis.delete(f"pixiv:jobs:lock:{KEY}")
+        assert await requester == ["theirs"]
+        assert produce.runs == 0
+
+    asyncio.run(run())
+
+
+def test_lock_of_another_instance_is_not_released(redis):
+    async def run():
+        await redis.set(f"pixiv:jobs:lock:{KEY}", "other instance")
+        assert await pixiv_jobs._renew_or_release(keys=[f"pixiv:jobs:lock:{KEY}"], args=[INSTANCE_ID, 0]) == 0
+        assert await redis.get(f"pixiv:jobs:lock:{KEY}") == "other instance"
+
+    asyncio.run(run())
+
+
+def test_chunk_checkpoints(redis):
+    async def run():
+        checkpoints = ChunkCheckpoints("123", "model", "credentials")
+        assert await checkpoints.get("chunk") is None
+        await checkpoints.set("chunk", "translated")
+        assert await checkpoints.get("chunk") == "translated"
+        assert await checkpoints.get("other chunk") is None
+        assert await ChunkCheckpoints("123", "model", "other credentials").get("chunk") is None
+        assert await redis.ttl(checkpoints.key("chunk")) > 0
+
+    asyncio.run(run())
+
+
+def test_requests_are_tracked_until_completed(redis):
+    async def run():
+        assert await pixiv_jobs.track_request(1, "123", "https://www.pixiv.net/novel/show.php?id=123", 10, 20) == 1
+        assert await pixiv_jobs.track_request(1, "123", "https://www.pixiv.net/novel/show.php?id=123", 10, 30) == 2
+        await pixiv_jobs.track_request(1, "456", "https://www.pixiv.net/novel/show.php?id=456", 10, 40)
+
+        unfinished = await pixiv_jobs.unfinished_requests(1)
+        assert unfinished["123"] == {"url": "https://www.pixiv.net/novel/show.php?id=123", "chat_id": 10, "message_id": 30, "attempts": 2}
+        assert await redis.ttl("pixiv:jobs:requests:1") > 0
+
+        await pixiv_jobs.complete_request(1, "123")
+        assert list(await pixiv_jobs.unfinished_requests(1)) == ["456"]
+        assert await pixiv_jobs.unfinished_requests(2) == {}
+
+    asyncio.run(run())
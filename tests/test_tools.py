@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+from openai.types.chat.chat_completion_chunk import ChoiceDeltaToolCall, ChoiceDeltaToolCallFunction
+
+import tools
+from tools import Tool
+
+started = []
+cancelled = []
+
+
+async def echo(text: str) -> str:
+    return text
+
+
+async def slow(seconds: float) -> str:
+    started.append(seconds)
+    try:
+        await asyncio.sleep(seconds)
+    except asyncio.CancelledError:
+        cancelled.append(seconds)
+        raise
+    return f"slept {seconds}s"
+
+
+async def broken() -> str:
+    raise RuntimeError("boom")
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    started.clear()
+    cancelled.clear()
+    monkeypatch.setitem(tools.TOOL_REGISTRY, "echo", Tool("echo", "", {}, echo, 1))
+    monkeypatch.setitem(tools.TOOL_REGISTRY, "slow", Tool("slow", "", {}, slow, 0.05))
+    monkeypatch.setitem(tools.TOOL_REGISTRY, "broken", Tool("broken", "", {}, broken, 1))
+
+
+def call(index: int, name: str, arguments: str = "{}") -> ChoiceDeltaToolCall:
+    return ChoiceDeltaToolCall(
+        index=index, id=f"call_{index}", type="function",
+        function=ChoiceDeltaToolCallFunction(name=name, arguments=arguments)
+    )
+
+
+def test_results_are_in_call_order_and_failures_are_messages():
+    calls = [
+        call(0, "slow", '{"seconds": 0.01}'),
+        call(1, "echo", '{"text": "hi"}'),
+        call(2, "broken"),
+        call(3, "missing"),
+        call(4, "echo", "{not json"),
+    ]
+    messages = asyncio.run(tools.run_tool_calls(calls))
+    assert [message["tool_call_id"] for message in messages] == [f"call_{i}" for i in range(5)]
+    contents = [message["content"] for message in messages]
+    assert contents[:2] == ["slept 0.01s", "hi"]
+    assert contents[2] == "Error: broken failed: RuntimeError('boom')"
+    assert contents[3] == "Error: unknown tool missing"
+    assert contents[4].startswith("Error: invalid arguments for echo")
+
+
+def test_a_slow_tool_times_out_alone():
+    messages = asyncio.run(tools.run_tool_calls([call(0, "slow", '{"seconds": 10}'), call(1, "echo", '{"text": "hi"}')]))
+    assert [message["content"] for message in messages] == ["Error: slow timed out after 0.05s", "hi"]
+    assert cancelled == [10]
+
+
+def test_the_turn_timeout_cancels_unfinished_tools(monkeypatch):
+    monkeypatch.setattr(tools, "TOOL_CALLS_TIMEOUT", 0.05)
+    monkeypatch.setitem(tools.TOOL_REGISTRY, "slow", Tool("slow", "", {}, slow, 10))
+
+    async def run():
+        messages = await tools.run_tool_calls([call(0, "slow", '{"seconds": 10}'), call(1, "echo", '{"text": "hi"}')])
+        await asyncio.sleep(0)
+        return messages
+
+    messages = asyncio.run(run())
+    assert [message["content"] for message in messages] == ["Error: slow did not finish within 0.05s", "hi"]
+    assert cancelled == [10]
+
+
+def test_cancelling_the_turn_cancels_its_tools():
+    async def run():
+        turn = asyncio.create_task(tools.run_tool_calls([call(0, "slow", '{"seconds": 0.5}'), call(1, "slow", '{"seconds": 0.6}')]))
+        await asyncio.sleep(0.01)
+        assert started == [0.5, 0.6]
+        turn.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await turn
+        await asyncio.sleep(0)
+        assert sorted(cancelled) == [0.5, 0.6]
+
+    asyncio.run(run())
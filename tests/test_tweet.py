@@ -0,0 +1,226 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import Forbidden
+
+import tweet
+from leader import digest_processing_key, processing_key
+
+CHAT_ID = 100
+DIGEST_CHAT_ID = 200
+
+
+def record(post_id: int, text: str = "hello", username: str = "alice") -> dict:
+    return {
+        "id": str(post_id),
+        "url": f"https://x.com/{username}/status/{post_id}",
+        "text": text,
+        "created_timestamp": 1700000000 + post_id,
+        "author": {"name": username.title(), "screen_name": username}
+    }
+
+
+class FakeBot:
+    def __init__(self, fail_on: set[int] | None = None, error: Exception | None = None):
+        self.messages: list[tuple[int, str]] = []
+        self.calls = 0
+        self.fail_on = fail_on or set()
+        self.error = error or RuntimeError("network error")
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls += 1
+        if self.calls in self.fail_on:
+            raise self.error
+        self.messages.append((chat_id, text))
+
+    async def send_media_group(self, chat_id, media, caption=None, **kwargs):
+        await self.send_message(chat_id, caption)
+
+
+@pytest.fixture
+def delivered(monkeypatch):
+    """(tweet id, chat id) of every tweet delivered right away; chats in `fail_for` fail once."""
+    sent = []
+    fail_for = set()
+
+    async def deliver_tweet(tweet_record, context, user_id, chat_id, reply_to_message_id=None, can_ignore=False, caption=None):
+        if chat_id in fail_for:
+            fail_for.discard(chat_id)
+            raise RuntimeError("Telegram is down")
+        sent.append((tweet_record["id"], chat_id))
+
+    async def tweet_caption(tweet_record, user_id):
+        return tweet_record["text"]
+
+    monkeypatch.setattr(tweet, "deliver_tweet", deliver_tweet)
+    monkeypatch.setattr(tweet, "tweet_caption", tweet_caption)
+    return SimpleNamespace(sent=sent, fail_for=fail_for)
+
+
+async def subscribe(redis, username: str, *chat_ids: int) -> None:
+    await redis.sadd(f"tweets:targets:user:{username}", *chat_ids)
+
+
+def test_send_tweets_retries_only_the_chats_that_failed(redis, delivered):
+    async def run():
+        await subscribe(redis, "alice", CHAT_ID, CHAT_ID + 1, DIGEST_CHAT_ID)
+        await redis.set(f"user:{DIGEST_CHAT_ID}:twitter_digest", 60)
+        await redis.rpush("tweets:urls:queue", json.dumps(record(1)))
+        delivered.fail_for.add(CHAT_ID + 1)
+
+        await tweet.send_tweets(None)
+        assert delivered.sent == [("1", CHAT_ID)]
+        requeued = json.loads(await redis.lindex("tweets:urls:queue", 0))
+        assert sorted(requeued["done"]) == [CHAT_ID, DIGEST_CHAT_ID]
+        assert await redis.llen(processing_key()) == 0
+
+        await tweet.send_tweets(None)
+        assert delivered.sent == [("1", CHAT_ID), ("1", CHAT_ID + 1)]
+        assert await redis.llen("tweets:urls:queue") == 0
+        buffered = [json.loads(item) for item in await redis.lrange(f"tweets:digest:{DIGEST_CHAT_ID}", 0, -1)]
+        assert buffered == [record(1)]
+
+    asyncio.run(run())
+
+
+def test_send_tweets_fetches_legacy_urls_for_digests(redis, delivered, monkeypatch):
+    async def get_tweet_info(url):
+        post_id = int(url.rsplit("/", 1)[1])
+        return {"code": 404} if post_id == 404 else {"code": 200, "tweet": record(post_id)}
+
+    monkeypatch.setattr(tweet, "get_tweet_info", get_tweet_info)
+
+    async def run():
+        await subscribe(redis, "alice", CHAT_ID, DIGEST_CHAT_ID)
+        await redis.set(f"user:{DIGEST_CHAT_ID}:twitter_digest", 60)
+        await redis.rpush("tweets:urls:queue", "https://x.com/alice/status/7", "https://x.com/alice/status/404")
+
+        await tweet.send_tweets(None)
+        assert delivered.sent == [("7", CHAT_ID)]
+        assert [json.loads(item)["id"] for item in await redis.lrange(f"tweets:digest:{DIGEST_CHAT_ID}", 0, -1)] == ["7"]
+        assert await redis.llen("tweets:urls:queue") == 0
+        assert await redis.llen(processing_key()) == 0
+
+    asyncio.run(run())
+
+
+async def buffer(redis, count: int, text: str = "hello") -> None:
+    for post_id in range(count):
+        await tweet.buffer_for_digest(json.dumps(record(post_id, text)), DIGEST_CHAT_ID, 60)
+
+
+def test_digest_is_sent_once_due(redis):
+    async def run():
+        bot = FakeBot()
+        context = SimpleNamespace(bot=bot)
+        await buffer(redis, 3)
+
+        await tweet.flush_digests(context)
+        assert bot.messages == []
+
+        await redis.zadd("tweets:digest:due", {str(DIGEST_CHAT_ID): 0})
+        # replicas flushing at the same time send the digest once
+        await asyncio.gather(tweet.flush_digests(context), tweet.flush_digests(context))
+        assert len(bot.messages) == 1
+        assert bot.messages[0][1].count("↗") == 3
+        assert await redis.llen(f"tweets:digest:{DIGEST_CHAT_ID}") == 0
+        assert await redis.llen(digest_processing_key(DIGEST_CHAT_ID)) == 0
+
+    asyncio.run(run())
+
+
+def test_digest_resends_only_what_failed(redis):
+    async def run():
+        # long snippets, so the digest takes several messages
+        await buffer(redis, 120, "x" * 200)
+        await redis.zadd("tweets:digest:due", {str(DIGEST_CHAT_ID): 0})
+
+        bot = FakeBot(fail_on={2})
+        await tweet.flush_digests(SimpleNamespace(bot=bot))
+        first = bot.messages[0][1].count("↗")
+        remaining = await redis.llen(f"tweets:digest:{DIGEST_CHAT_ID}")
+        assert first > 0 and first + remaining == 120
+        assert await redis.zscore("tweets:digest:due", str(DIGEST_CHAT_ID)) > 0
+
+        await redis.zadd("tweets:digest:due", {str(DIGEST_CHAT_ID): 0})
+        await tweet.flush_digests(SimpleNamespace(bot=bot))
+        assert sum(text.count("↗") for _, text in bot.messages) == 120
+        assert await redis.llen(f"tweets:digest:{DIGEST_CHAT_ID}") == 0
+
+    asyncio.run(run())
+
+
+def test_digest_of_blocked_chat_is_dropped(redis):
+    async def run():
+        await buffer(redis, 2)
+        await redis.zadd("tweets:digest:due", {str(DIGEST_CHAT_ID): 0})
+
+        await tweet.flush_digests(SimpleNamespace(bot=FakeBot(fail_on={1}, error=Forbidden("bot was blocked by the user"))))
+        assert await redis.llen(f"tweets:digest:{DIGEST_CHAT_ID}") == 0
+        assert await redis.llen(digest_processing_key(DIGEST_CHAT_ID)) == 0
+        assert await redis.zscore("tweets:digest:due", str(DIGEST_CHAT_ID)) is None
+
+    asyncio.run(run())
+
+
+def test_parse_usernames_from_text():
+    usernames, rejected = tweet.parse_usernames("@Alice, bob; https://x.com/Carol/ alice not/valid")
+    assert usernames == ["alice", "bob", "carol"]
+    assert rejected == ["not/valid"]
+
+
+def test_parse_usernames_from_csv_column():
+    table = "name,Screen_Name,followers\n\"Alice, Inc.\",@alice,10\nBob,bob,20\nBob again,BOB,30\n"
+    usernames, rejected = tweet.parse_usernames("", table)
+    assert usernames == ["alice", "bob"]
+    assert rejected == []
+
+
+def test_parse_usernames_from_csv_without_header():
+    usernames, rejected = tweet.parse_usernames("dave", "alice,10\nhttps://twitter.com/bob,20\n")
+    assert usernames == ["dave", "alice", "bob"]
+    assert rejected == []
+
+
+def video(duration: float | None, *bitrates: int, hls: bool = True) -> dict:
+    variants = [{"content_type": "application/x-mpegURL", "url": "https://video.twimg.com/v.m3u8"}] if hls else []
+    variants += [
+        {"content_type": "video/mp4", "bitrate": bitrate, "url": f"https://video.twimg.com/vid/{bitrate // 1000}x{bitrate // 2000}/v.mp4"}
+        for bitrate in bitrates
+    ]
+    media = {"type": "video", "url": None, "variants": variants, "thumbnail_url": "https://pbs.twimg.com/thumb.jpg"}
+    if duration is not None:
+        media["duration"] = duration
+    return media
+
+
+def test_video_url_picks_the_best_variant_that_fits():
+    # 60s: 2176kbps is about 18MB with audio, 10368kbps about 83MB
+    media = video(60, 632000, 2176000, 10368000)
+    assert tweet.video_url(media) == "https://video.twimg.com/vid/2176x1088/v.mp4"
+    assert tweet.video_url(media, tweet.TELEGRAM_UPLOAD_MAX_BYTES) == "https://video.twimg.com/vid/2176x1088/v.mp4"
+    assert tweet.url_fetchable_video(media)
+
+
+def test_video_url_falls_back_to_the_smallest_variant():
+    media = video(3600, 632000, 2176000)
+    assert tweet.video_url(media) == "https://video.twimg.com/vid/632x316/v.mp4"
+    assert not tweet.url_fetchable_video(media)
+
+
+def test_video_url_without_mp4_or_estimate():
+    assert tweet.video_url(video(60)) is None
+    # no duration, the size can't be estimated, so the best variant is assumed to fit
+    assert tweet.video_url(video(None, 632000, 10368000)) == "https://video.twimg.com/vid/10368x5184/v.mp4"
+    # fxtwitter media have no variants, their url is an mp4
+    assert tweet.video_url({"type": "video", "url": "https://video.twimg.com/fx.mp4"}) == "https://video.twimg.com/fx.mp4"
+
+
+def test_fetchable_by_url():
+    photo = {"type": "photo", "url": "https://pbs.twimg.com/p.jpg"}
+    assert tweet.fetchable_by_url({**record(1), "media": {"all": [photo, video(60, 632000)]}})
+    assert not tweet.fetchable_by_url({**record(1), "media": {"all": [photo, video(3600, 2176000)]}})
+    assert not tweet.fetchable_by_url({**record(1), "media": {"all": [video(60)]}})
+    assert tweet.fetchable_by_url(record(1))
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from utils import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do("key", fetch) for _ in range(5)))
+        assert results == [1] * 5
+        # a later call runs again
+        assert await flights.do("key", fetch) == 2
+
+    asyncio.run(run())
+
+
+def test_errors_are_shared_with_followers():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        raise ValueError("bad page")
+
+    async def run():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do("key", fetch) for _ in range(3)), return_exceptions=True)
+        assert calls == 1
+        assert all(isinstance(result, ValueError) for result in results)
+
+    asyncio.run(run())
+
+
+def test_followers_run_again_when_the_leader_is_cancelled():
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return "page"
+
+    async def run():
+        flights = SingleFlight()
+        leader = asyncio.create_task(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.do("key", fetch))
+        await asyncio.sleep(0.01)
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        assert await follower == "page"
+        assert calls == 2
+
+    asyncio.run(run())
+
+
+def test_cancelled_follower_leaves_the_call_running():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "page"
+
+    async def run():
+        flights = SingleFlight()
+        leader = asyncio.create_task(flights.do("key", fetch))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flights.do("key", fetch))
+        await asyncio.sleep(0.01)
+
+        follower.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await follower
+        assert await leader == "page"
+
+    asyncio.run(run())